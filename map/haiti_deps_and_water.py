@@ -1,12 +1,65 @@
 import os
+import html
 import folium
 import pandas as pd
-import json
-from folium import GeoJson
-from folium import IFrame
+from folium.plugins import FastMarkerCluster
+from branca.element import MacroElement
+from jinja2 import Template
+from map_layers import build_layer
+from sample_join import join_samples
+
+# The department and river layers are pre-simplified into per-zoom files under
+# layers/ that the page fetches, so the page has to be served, e.g. with
+# python -m http.server, instead of opened as a file.
+LAYER_DIR = 'layers'
+# Isolate sample,latitude,longitude[,source] file and its department and river join table
+SAMPLES = 'samples.csv'
+SAMPLE_TABLE = 'sample_locations.csv'
+SOURCE_COLORS = {'clinical': '#d7301f', 'environmental': '#2b8cbe'}
+
+
+class ZoomLayers(MacroElement):
+    """Loads the per-zoom file of each layer that fits the map zoom, swapping it on zoomend"""
+    _template = Template(u"""
+        {% macro script(this, kwargs) %}
+        (function(map) {
+            function zoomLayer(name, zIndex, files, style) {
+                var levels = Object.keys(files).map(Number).sort(function(a, b) { return a - b; });
+                var requests = {}, shown = null, layer = null;
+                map.createPane(name).style.zIndex = zIndex;
+                function update() {
+                    var zoom = map.getZoom(), level = levels[0];
+                    levels.forEach(function(l) { if (l <= zoom) { level = l; } });
+                    if (level === shown) { return; }
+                    shown = level;
+                    if (!requests[level]) {
+                        requests[level] = fetch(files[level]).then(function(response) { return response.json(); });
+                    }
+                    requests[level].then(function(data) {
+                        if (shown !== level) { return; }
+                        if (layer) { map.removeLayer(layer); }
+                        layer = L.geoJson(data, {pane: name, style: style}).addTo(map);
+                    });
+                }
+                map.on('zoomend', update);
+                update();
+            }
+            {% for name, files, style in this.layers %}
+            zoomLayer({{ name|tojson }}, {{ 400 + loop.index }}, {{ files|tojson }}, {{ style }});
+            {% endfor %}
+        })({{ this._parent.get_name() }});
+        {% endmacro %}
+        """)
+
+    def __init__(self):
+        super(ZoomLayers, self).__init__()
+        self._name = 'ZoomLayers'
+        self.layers = []
+
+    def add_layer(self, name, files, style):
+        """files maps the zoom levels to the file paths, style is a Leaflet style function in JavaScript"""
+        self.layers.append((name, dict((str(zoom), filename.replace(os.sep, '/')) for zoom, filename in files.items()), style))
 
-haiti = json.load(open('haiti.geojson', 'r+', encoding='utf-8'))
-water = json.load(open('hti_dom_watcrsl_rvr_osm.geojson', 'r+', encoding='utf=8'))
 
 attr = ('&copy; <a href="http://www.openstreetmap.org/copyright">OpenStreetMap</a> '
         'contributors, &copy; <a href="http://cartodb.com/attributions">CartoDB</a>')
@@ -14,16 +67,28 @@ tiles = 'http://{s}.basemaps.cartocdn.com/light_nolabels/{z}/{x}/{y}.png'
 
 m = folium.Map(location=[19, -72], zoom_start=9, attr=attr, tiles=tiles)
 
-folium.GeoJson(haiti, style_function=lambda x:
-	{'color' : x['properties']['stroke'], 'weight' :
-	x['properties']['stroke-width'], 'strokeOpacity': x['properties']['stroke-opacity'],
-	'fillColor' : x['properties']['fill'], 'fillOpacity': x['properties']['fill-opacity']}
-	).add_to(m)
+layers = ZoomLayers()
+layers.add_layer('departments', build_layer('haiti.geojson', 'haiti', LAYER_DIR), """function(x) {
+	return {'color' : x.properties['stroke'], 'weight' :
+	x.properties['stroke-width'], 'strokeOpacity': x.properties['stroke-opacity'],
+	'fillColor' : x.properties['fill'], 'fillOpacity': x.properties['fill-opacity']}; }""")
+# The river style does not use any feature property
+layers.add_layer('water', build_layer('hti_dom_watcrsl_rvr_osm.geojson', 'water', LAYER_DIR, properties=[]), """function(x) {
+  return {'color' : '#58bbff', 'stroke' : '#58bbff', 'fill' : '#58bbff', 'strokeWidth' : '0.25',
+  'strokeOpacity': '0.75', 'fillColor' : '#58bbff', 'fillOpacity': '0.25'}; }""")
+layers.add_to(m)
 
-folium.GeoJson(water, style_function=lambda x:
-  {'color' : '#58bbff', 'stroke' : '#58bbff', 'fill' : '#58bbff', 'strokeWidth' : '0.25', 
-  'strokeOpacity': '0.75', 'fillColor' : '#58bbff', 'fillOpacity': '0.25'}
-  ).add_to(m)
+if os.path.exists(SAMPLES):
+    samples = join_samples(pd.read_csv(SAMPLES), 'haiti.geojson', 'hti_dom_watcrsl_rvr_osm.geojson', LAYER_DIR)
+    samples.to_csv(SAMPLE_TABLE, index=False)
+    sources = samples['source'] if 'source' in samples else pd.Series('', index=samples.index)
+    popups = ['<b>{}</b><br>{}<br>{} ({:.0f} m)'.format(html.escape(str(sample)), html.escape(department), html.escape(river), distance)
+        for sample, department, river, distance in zip(samples['sample'], samples['department'], samples['river'], samples['river_distance_m'].fillna(0))]
+    colors = [SOURCE_COLORS.get(str(source).lower(), '#636363') for source in sources]
+    FastMarkerCluster(list(zip(samples['latitude'], samples['longitude'], popups, colors)), callback="""function(row) {
+        var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {radius: 5, color: row[3], fillOpacity: 0.8});
+        marker.bindPopup(row[2]);
+        return marker; }""").add_to(m)
 
 
-m.save('index.html')
\ No newline at end of file
+m.save('index.html')
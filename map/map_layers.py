@@ -0,0 +1,195 @@
+"""Pre-simplified, per-zoom GeoJSON layers for the Haiti map.
+
+Every source GeoJSON file is simplified with the Douglas-Peucker algorithm
+at the tolerance of one screen pixel at each zoom level in ZOOM_LEVELS and
+its coordinates are rounded to that resolution. The results are written as
+compact per-zoom files named after the source file hash, so they are only
+rebuilt when the source file or the settings change, and the map page loads
+the file of its current zoom level instead of embedding every vertex.
+"""
+import os
+import re
+import json
+import math
+import glob
+import hashlib
+
+# Zoom levels with their own simplified file; a map zoom uses the closest level below it
+ZOOM_LEVELS = [7, 9, 11, 13]
+# Bumped when the simplification changes, so the cached files are rebuilt
+LAYER_VERSION = 1
+
+
+def zoom_tolerance(zoom):
+    """Width of a screen pixel in degrees at a Leaflet zoom level"""
+    return 360.0 / (256 << zoom)
+
+
+def zoom_digits(zoom):
+    """Decimal places that keep the rounding error below a tenth of a pixel"""
+    return int(math.ceil(-math.log10(zoom_tolerance(zoom) / 10)))
+
+
+def file_hash(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def simplify_line(points, tolerance):
+    """Douglas-Peucker simplification of a list of coordinates, keeping both ends"""
+    if len(points) < 3:
+        return points
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    max_distance = tolerance * tolerance
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        x1, y1 = points[first][0], points[first][1]
+        dx = points[last][0] - x1
+        dy = points[last][1] - y1
+        norm = dx * dx + dy * dy
+        farthest, index = max_distance, None
+        for idx in range(first + 1, last):
+            x = points[idx][0] - x1
+            y = points[idx][1] - y1
+            if norm:
+                cross = x * dy - y * dx
+                distance = cross * cross / norm
+            else:
+                distance = x * x + y * y
+            if distance > farthest:
+                farthest, index = distance, idx
+        if index is not None:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def quantize_line(points, digits):
+    """Round coordinates to the zoom resolution, dropping the points that fall together"""
+    line = []
+    for point in points:
+        point = [round(point[0], digits), round(point[1], digits)]
+        if not line or point != line[-1]:
+            line.append(point)
+    return line
+
+
+def simplify_ring(ring, tolerance, digits):
+    """Simplified polygon ring, or None for a ring that collapses below a pixel"""
+    ring = quantize_line(simplify_line(ring, tolerance), digits)
+    if len(ring) < 4 or ring[0] != ring[-1]:
+        return None
+    return ring
+
+
+def simplify_polygon(rings, tolerance, digits):
+    """Simplified polygon, or None if its outer ring collapses. Collapsed holes are dropped"""
+    outer = simplify_ring(rings[0], tolerance, digits)
+    if outer is None:
+        return None
+    polygon = [outer]
+    for ring in rings[1:]:
+        ring = simplify_ring(ring, tolerance, digits)
+        if ring is not None:
+            polygon.append(ring)
+    return polygon
+
+
+def simplify_geometry(geometry, tolerance, digits):
+    """Simplified copy of a GeoJSON geometry, or None if nothing of it is left at this zoom"""
+    if geometry is None:
+        return None
+    kind = geometry['type']
+    coordinates = geometry.get('coordinates')
+    if kind == 'Point':
+        simplified = quantize_line([coordinates], digits)[0]
+    elif kind == 'MultiPoint':
+        simplified = quantize_line(coordinates, digits)
+    elif kind == 'LineString':
+        simplified = quantize_line(simplify_line(coordinates, tolerance), digits)
+    elif kind == 'MultiLineString':
+        simplified = [quantize_line(simplify_line(line, tolerance), digits) for line in coordinates]
+    elif kind == 'Polygon':
+        simplified = simplify_polygon(coordinates, tolerance, digits)
+    elif kind == 'MultiPolygon':
+        simplified = [polygon for polygon in (simplify_polygon(rings, tolerance, digits) for rings in coordinates) if polygon]
+    elif kind == 'GeometryCollection':
+        geometries = [simplify_geometry(part, tolerance, digits) for part in geometry['geometries']]
+        geometries = [part for part in geometries if part is not None]
+        return {'type': kind, 'geometries': geometries} if geometries else None
+    else:
+        raise ValueError("Unknown GeoJSON geometry type: {}".format(kind))
+    if kind == 'MultiLineString':
+        simplified = [line for line in simplified if len(line) > 1]
+    if simplified is None or (kind != 'Point' and not simplified):
+        return None
+    return {'type': kind, 'coordinates': simplified}
+
+
+def simplify_collection(collection, zoom, properties=None):
+    """
+    FeatureCollection of the features that are still visible at a zoom
+    level. properties is the list of feature properties to keep, all of
+    them if it is None.
+    """
+    tolerance = zoom_tolerance(zoom)
+    digits = zoom_digits(zoom)
+    features = []
+    for feature in collection['features']:
+        geometry = simplify_geometry(feature.get('geometry'), tolerance, digits)
+        if geometry is None:
+            continue
+        feature_properties = feature.get('properties') or {}
+        if properties is not None:
+            feature_properties = dict((key, feature_properties[key]) for key in properties if key in feature_properties)
+        features.append({'type': 'Feature', 'properties': feature_properties, 'geometry': geometry})
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def build_layer(source, name, out_dir, properties=None, zoom_levels=ZOOM_LEVELS):
+    """
+    Write the per-zoom files of a source GeoJSON file into out_dir and return
+    a zoom level -> file path dictionary. The file names carry a hash of the
+    source file and the settings; existing files with the same hash are
+    reused and the ones of earlier hashes of the layer are removed.
+    """
+    sha1 = hashlib.sha1(file_hash(source).encode('ascii'))
+    sha1.update(json.dumps([LAYER_VERSION, properties, zoom_levels]).encode('utf-8'))
+    key = sha1.hexdigest()[:12]
+    files = dict((zoom, os.path.join(out_dir, '{}.{}.z{}.geojson'.format(name, key, zoom))) for zoom in zoom_levels)
+    if not all(os.path.exists(filename) for filename in files.values()):
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        with open(source, encoding='utf-8') as fh:
+            collection = json.load(fh)
+        # Each level is simplified from the next finer one, which has far fewer points than the source
+        for zoom in sorted(zoom_levels, reverse=True):
+            collection = simplify_collection(collection, zoom, properties)
+            tmp_file = files[zoom] + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as fh:
+                # json.dumps uses the C encoder, json.dump does not
+                fh.write(json.dumps(collection, separators=(',', ':'), ensure_ascii=False))
+            os.rename(tmp_file, files[zoom])
+    pattern = re.compile(re.escape(name) + r'\.[0-9a-f]{12}\.z\d+\.geojson$')
+    for filename in glob.glob(os.path.join(out_dir, name + '.*.geojson')):
+        if pattern.search(filename) and filename not in files.values():
+            os.remove(filename)
+    return files
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Write pre-simplified per-zoom files of GeoJSON layers")
+    parser.add_argument('sources', nargs='+', help="Source GeoJSON files")
+    parser.add_argument('-o', '--out-dir', dest='out_dir', default='layers', help="Output directory. Default is layers")
+    args = parser.parse_args()
+    for source in args.sources:
+        name = os.path.splitext(os.path.basename(source))[0]
+        for zoom, filename in sorted(build_layer(source, name, args.out_dir).items()):
+            print("{} z{}: {} ({} bytes)".format(source, zoom, filename, os.path.getsize(filename)))
@@ -0,0 +1,280 @@
+"""Department and nearest watercourse of every sample location.
+
+The department polygon edges and the river segments are put into grid
+indexes, built once per pair of source files and cached next to the map
+layers. Points are located in their departments with a crossing number test
+against the edges of their grid row only, and matched to the nearest river
+segment by searching the grid cells in growing rings around them. Both
+queries run on numpy arrays of all the sample points at once.
+
+Coordinates are projected to an equirectangular plane around LATITUDE, so
+distances are in metres and good to well under a percent over Haiti.
+"""
+import os
+import re
+import json
+import glob
+import math
+import hashlib
+import numpy as np
+import pandas as pd
+from map_layers import file_hash
+
+# Bumped when the index layout changes, so the cached indexes are rebuilt
+INDEX_VERSION = 1
+# Grid cell size in projected degrees, about 1 km
+CELL_SIZE = 0.01
+# Projection centre latitude and metres per degree
+LATITUDE = 19.0
+METRES_PER_DEGREE = 111320.0
+# Point x segment pairs compared at once by nearest_segments
+PAIR_BATCH = 1 << 22
+
+
+def project(lon, lat):
+    return np.asarray(lon, dtype=np.float64) * math.cos(math.radians(LATITUDE)), np.asarray(lat, dtype=np.float64)
+
+
+def geometry_lines(geometry):
+    """Coordinate lists of the lines and polygon rings of a GeoJSON geometry"""
+    if geometry is None:
+        return []
+    kind = geometry['type']
+    coordinates = geometry.get('coordinates')
+    if kind == 'LineString':
+        return [coordinates]
+    if kind in ('MultiLineString', 'Polygon'):
+        return coordinates
+    if kind == 'MultiPolygon':
+        return [ring for polygon in coordinates for ring in polygon]
+    if kind == 'GeometryCollection':
+        return [line for part in geometry['geometries'] for line in geometry_lines(part)]
+    return []
+
+
+def collection_segments(collection):
+    """x1, y1, x2, y2 arrays of the projected segments of a FeatureCollection and the feature of each"""
+    parts = []
+    features = []
+    for idx, feature in enumerate(collection['features']):
+        for line in geometry_lines(feature.get('geometry')):
+            if len(line) < 2:
+                continue
+            x, y = project([point[0] for point in line], [point[1] for point in line])
+            parts.append(np.column_stack([x[:-1], y[:-1], x[1:], y[1:]]))
+            features.append(np.full(len(line) - 1, idx, dtype=np.int32))
+    if not parts:
+        return np.zeros((0, 4)), np.zeros(0, dtype=np.int32)
+    return np.vstack(parts), np.concatenate(features)
+
+
+def expand(counts):
+    """Index and position of every copy when item i is repeated counts[i] times"""
+    items = np.repeat(np.arange(len(counts)), counts)
+    return items, np.arange(len(items)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+
+def bucket_index(buckets, items, num_buckets):
+    """CSR offsets and items of a bucket -> items mapping given as parallel arrays"""
+    order = np.argsort(buckets, kind='stable')
+    return np.searchsorted(buckets[order], np.arange(num_buckets + 1)), items[order]
+
+
+def build_index(departments_file, rivers_file):
+    """
+    Grid index arrays of the department edges, bucketed by grid row, and the
+    river segments, bucketed by grid cell, with the department and river
+    names.
+    """
+    with open(departments_file, encoding='utf-8') as fh:
+        departments = json.load(fh)
+    with open(rivers_file, encoding='utf-8') as fh:
+        rivers = json.load(fh)
+    edges, edge_department = collection_segments(departments)
+    segments, segment_river = collection_segments(rivers)
+    bounds = np.vstack([edges[:, [0, 1]], edges[:, [2, 3]], segments[:, [0, 1]], segments[:, [2, 3]]])
+    origin = bounds.min(axis=0) - CELL_SIZE
+    columns, rows = (np.ceil((bounds.max(axis=0) - origin) / CELL_SIZE).astype(int) + 2)
+    # Horizontal edges never cross a horizontal ray
+    edges_kept = edges[:, 1] != edges[:, 3]
+    edges, edge_department = edges[edges_kept], edge_department[edges_kept]
+    first = np.floor((np.minimum(edges[:, 1], edges[:, 3]) - origin[1]) / CELL_SIZE).astype(int)
+    last = np.floor((np.maximum(edges[:, 1], edges[:, 3]) - origin[1]) / CELL_SIZE).astype(int)
+    items, position = expand(last - first + 1)
+    row_offsets, row_edges = bucket_index(first[items] + position, items, rows)
+    # Each segment goes into every cell of its bounding box
+    cell_x0 = np.floor((np.minimum(segments[:, 0], segments[:, 2]) - origin[0]) / CELL_SIZE).astype(int)
+    cell_x1 = np.floor((np.maximum(segments[:, 0], segments[:, 2]) - origin[0]) / CELL_SIZE).astype(int)
+    cell_y0 = np.floor((np.minimum(segments[:, 1], segments[:, 3]) - origin[1]) / CELL_SIZE).astype(int)
+    cell_y1 = np.floor((np.maximum(segments[:, 1], segments[:, 3]) - origin[1]) / CELL_SIZE).astype(int)
+    width = cell_x1 - cell_x0 + 1
+    items, position = expand(width * (cell_y1 - cell_y0 + 1))
+    cells = (cell_y0[items] + position // width[items]) * columns + cell_x0[items] + position % width[items]
+    cell_offsets, cell_segments = bucket_index(cells, items, columns * rows)
+    department_names = [feature['properties'].get('adm1_en', '') for feature in departments['features']]
+    department_codes = [feature['properties'].get('adm1code', '') for feature in departments['features']]
+    river_names = []
+    for idx, feature in enumerate(rivers['features']):
+        properties = feature.get('properties') or {}
+        river_names.append(properties.get('name') or properties.get('osm_id') or str(idx))
+    return {
+        'grid': np.array([origin[0], origin[1], columns, rows], dtype=np.float64),
+        'edges': edges, 'edge_department': edge_department,
+        'row_offsets': row_offsets, 'row_edges': row_edges,
+        'segments': segments, 'segment_river': segment_river,
+        'cell_offsets': cell_offsets, 'cell_segments': cell_segments,
+        'department_names': np.array(department_names, dtype=str),
+        'department_codes': np.array(department_codes, dtype=str),
+        'river_names': np.array([str(name) for name in river_names], dtype=str),
+    }
+
+
+def load_index(departments_file, rivers_file, cache_dir):
+    """The grid index of the source files, from the cache in cache_dir if it is there"""
+    sha1 = hashlib.sha1(file_hash(departments_file).encode('ascii'))
+    sha1.update(file_hash(rivers_file).encode('ascii'))
+    sha1.update(json.dumps([INDEX_VERSION, CELL_SIZE, LATITUDE]).encode('utf-8'))
+    cache_file = os.path.join(cache_dir, 'index.{}.npz'.format(sha1.hexdigest()[:12]))
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            return dict((name, cached[name]) for name in cached.files)
+    index = build_index(departments_file, rivers_file)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    tmp_file = cache_file + '.tmp.npz'
+    np.savez(tmp_file, **index)
+    os.rename(tmp_file, cache_file)
+    for filename in glob.glob(os.path.join(cache_dir, 'index.*.npz')):
+        if re.search(r'index\.[0-9a-f]{12}\.npz$', filename) and filename != cache_file:
+            os.remove(filename)
+    return index
+
+
+def locate_departments(index, x, y):
+    """Department of every point, -1 outside all of them, by an even-odd crossing test per grid row"""
+    origin_x, origin_y, columns, rows = index['grid']
+    edges = index['edges']
+    num_departments = len(index['department_names'])
+    result = np.full(len(x), -1, dtype=np.int64)
+    point_rows = np.floor((y - origin_y) / CELL_SIZE).astype(int)
+    inside_grid = (point_rows >= 0) & (point_rows < int(rows))
+    order = np.argsort(np.where(inside_grid, point_rows, -1), kind='stable')
+    order = order[inside_grid[order]]
+    row_starts = np.searchsorted(point_rows[order], np.arange(int(rows) + 1))
+    for row in np.flatnonzero(np.diff(row_starts)):
+        points = order[row_starts[row]:row_starts[row + 1]]
+        row_edges = index['row_edges'][index['row_offsets'][row]:index['row_offsets'][row + 1]]
+        if not len(row_edges):
+            continue
+        x1, y1, x2, y2 = edges[row_edges].T
+        px = x[points, None]
+        py = y[points, None]
+        straddles = (y1 > py) != (y2 > py)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            crossing_x = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+        crossings = (straddles & (px < crossing_x)).astype(np.int64)
+        membership = np.zeros((len(row_edges), num_departments), dtype=np.int64)
+        membership[np.arange(len(row_edges)), index['edge_department'][row_edges]] = 1
+        inside = (crossings.dot(membership) % 2).astype(bool)
+        result[points] = np.where(inside.any(axis=1), inside.argmax(axis=1), -1)
+    return result
+
+
+def segment_distances(x, y, segments):
+    """Distances of points to the segments paired with them"""
+    x1, y1, x2, y2 = segments.T
+    dx = x2 - x1
+    dy = y2 - y1
+    length = dx * dx + dy * dy
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.clip(np.where(length > 0, ((x - x1) * dx + (y - y1) * dy) / length, 0), 0, 1)
+    return np.hypot(x - x1 - t * dx, y - y1 - t * dy)
+
+
+def nearest_segments(index, x, y):
+    """
+    Nearest river segment of every point and its distance, -1 and inf if there
+    are no rivers. The cells around the points are searched in rings of growing
+    Chebyshev radius k until the nearest segment found is closer than any
+    segment in ring k + 1 can be.
+    """
+    origin_x, origin_y, columns, rows = index['grid']
+    columns, rows = int(columns), int(rows)
+    offsets = index['cell_offsets']
+    cell_segments = index['cell_segments']
+    segments = index['segments']
+    best = np.full(len(x), np.inf)
+    nearest = np.full(len(x), -1, dtype=np.int64)
+    cx = np.floor((x - origin_x) / CELL_SIZE).astype(int)
+    cy = np.floor((y - origin_y) / CELL_SIZE).astype(int)
+    active = np.arange(len(x)) if len(cell_segments) else np.arange(0)
+    # Beyond this radius the rings of every point are off the grid
+    max_radius = max(columns, rows) + max([0] + [int(value) for value in (-cx.min(), cx.max() - columns, -cy.min(), cy.max() - rows)] if len(x) else [0])
+    radius = 0
+    while len(active) and radius <= max_radius:
+        if radius == 0:
+            ring = [(0, 0)]
+        else:
+            ring = [(dx, dy) for dx in range(-radius, radius + 1) for dy in (-radius, radius)]
+            ring += [(dx, dy) for dx in (-radius, radius) for dy in range(1 - radius, radius)]
+        pair_points = []
+        pair_segments = []
+        for dx, dy in ring:
+            ring_x = cx[active] + dx
+            ring_y = cy[active] + dy
+            valid = (ring_x >= 0) & (ring_x < columns) & (ring_y >= 0) & (ring_y < rows)
+            cells = ring_y[valid] * columns + ring_x[valid]
+            starts = offsets[cells]
+            items, position = expand(offsets[cells + 1] - starts)
+            pair_points.append(active[valid][items])
+            pair_segments.append(cell_segments[starts[items] + position])
+        if pair_points:
+            pair_points = np.concatenate(pair_points)
+            pair_segments = np.concatenate(pair_segments)
+            for start in range(0, len(pair_points), PAIR_BATCH):
+                points = pair_points[start:start + PAIR_BATCH]
+                candidates = pair_segments[start:start + PAIR_BATCH]
+                distances = segment_distances(x[points], y[points], segments[candidates])
+                order = np.lexsort((distances, points))
+                first = np.ones(len(order), dtype=bool)
+                first[1:] = points[order][1:] != points[order][:-1]
+                closest = order[first]
+                closer = distances[closest] < best[points[closest]]
+                best[points[closest][closer]] = distances[closest][closer]
+                nearest[points[closest][closer]] = candidates[closest][closer]
+        # Every segment outside rings 0..radius is at least radius cells away
+        active = active[best[active] > radius * CELL_SIZE]
+        radius += 1
+    return nearest, best
+
+
+def join_samples(samples, departments_file, rivers_file, cache_dir):
+    """
+    Add the department, department code, nearest river and river distance in
+    metres of every sample to a data frame with latitude and longitude
+    columns.
+    """
+    index = load_index(departments_file, rivers_file, cache_dir)
+    x, y = project(samples['longitude'].values, samples['latitude'].values)
+    departments = locate_departments(index, x, y)
+    segments, distances = nearest_segments(index, x, y)
+    # Index -1, no department or river, picks the appended empty name
+    rivers = np.append(index['segment_river'], -1)[segments]
+    joined = samples.copy()
+    joined['department'] = np.append(index['department_names'], '')[departments]
+    joined['department_code'] = np.append(index['department_codes'], '')[departments]
+    joined['river'] = np.append(index['river_names'], '')[rivers]
+    joined['river_distance_m'] = np.where(segments >= 0, np.round(distances * METRES_PER_DEGREE, 1), np.nan)
+    return joined
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Join sample locations to their department and nearest river")
+    parser.add_argument('samples', help="CSV file with sample, latitude and longitude columns")
+    parser.add_argument('-o', '--output', dest='outfile', default='sample_locations.csv', help="Output CSV file. Default is sample_locations.csv")
+    parser.add_argument('--departments', default='haiti.geojson', help="Department GeoJSON file. Default is haiti.geojson")
+    parser.add_argument('--rivers', default='hti_dom_watcrsl_rvr_osm.geojson', help="River GeoJSON file. Default is hti_dom_watcrsl_rvr_osm.geojson")
+    parser.add_argument('--cache-dir', dest='cache_dir', default='layers', help="Directory of the cached index. Default is layers")
+    args = parser.parse_args()
+    join_samples(pd.read_csv(args.samples), args.departments, args.rivers, args.cache_dir).to_csv(args.outfile, index=False)
@@ -0,0 +1,580 @@
+#!/usr/bin/env python
+"""Checkpointed driver for the bam_pipeline.sh stages. Every sample gets its
+fastqc, trimmomatic, bowtie2, picard, GATK and samtools tasks with declared
+input and output files, the samples are joined by freebayes and the SNP
+alignment is extracted with vcf_fa_extractor.py in-process. Tasks whose
+outputs are up to date by mtime or content hash are skipped, the others are
+run as soon as their inputs are ready and their threads and memory fit into
+the --cores/--memory budget. Per task timings are logged and can be written
+as JSON.
+
+Example:
+    ./bam_pipeline.py -w reads/ --cores 32 --memory 120 -o cholera.vcf --extractor-args "-q 20 -d 3"
+    ./bam_pipeline.py -w test/ --stub --stub-seconds 0.2 --cores 4 --memory 16 -o test.vcf
+"""
+import os, sys, re, glob, json, time, shlex, pipes, hashlib, argparse, logging, subprocess, threading, multiprocessing, Queue
+
+import vcf_fa_extractor
+
+__version="1.0"
+
+TOOLS = {'fastqc': 'fastqc', 'trimmomatic': 'trimmomatic', 'bowtie2': 'bowtie2', 'samtools': 'samtools',
+         'picard': 'picard', 'gatk': 'GenomeAnalysisTK', 'freebayes': 'freebayes'}
+
+# Per sample stages in the bam_pipeline.sh order: name, command, inputs, outputs, threads, memory in Gb.
+# {s} is the sample and {threads} the number of threads the task gets.
+SAMPLE_STAGES = [
+    ('fastqc', '{fastqc} -t {threads} -f fastq {s}_1.fastq.gz {s}_2.fastq.gz',
+        ['{s}_1.fastq.gz', '{s}_2.fastq.gz'], ['{s}_1_fastqc.zip', '{s}_2_fastqc.zip'], 2, 1),
+    ('trimmomatic', '{trimmomatic} PE -threads {threads} {s}_1.fastq.gz {s}_2.fastq.gz {s}_pair_1.fastq.gz U_{s}_1.fastq.gz {s}_pair_2.fastq.gz U_{s}_2.fastq.gz '
+        'ILLUMINACLIP:{adapters}:2:30:10 LEADING:3 TRAILING:3 SLIDINGWINDOW:4:15 MINLEN:20',
+        ['{s}_1.fastq.gz', '{s}_2.fastq.gz'], ['{s}_pair_1.fastq.gz', 'U_{s}_1.fastq.gz', '{s}_pair_2.fastq.gz', 'U_{s}_2.fastq.gz'], 4, 2),
+    ('fastqc_trimmed', '{fastqc} -t {threads} -f fastq {s}_pair_1.fastq.gz {s}_pair_2.fastq.gz',
+        ['{s}_pair_1.fastq.gz', '{s}_pair_2.fastq.gz'], ['{s}_pair_1_fastqc.zip', '{s}_pair_2_fastqc.zip'], 2, 1),
+    ('bowtie2', 'set -o pipefail; {bowtie2} -p {threads} -x {bowtie2_index} -1 {s}_pair_1.fastq.gz -2 {s}_pair_2.fastq.gz -I 0 -X 1200 --un-conc-gz {s}_unmapped '
+        '| {samtools} view -bS - | {samtools} sort -O bam -T tmp{s}.tmp > {s}_sorted.bam',
+        ['{s}_pair_1.fastq.gz', '{s}_pair_2.fastq.gz'], ['{s}_sorted.bam'], 8, 4),
+    ('read_groups', '{picard} AddOrReplaceReadGroups I={s}_sorted.bam O={s}_re.bam RGID=ID_{s} RGLB=LB_{s} RGPL=ILLUMINA RGPU=ILLUMINA RGSM=SM_{s}',
+        ['{s}_sorted.bam'], ['{s}_re.bam'], 1, 10),
+    ('mark_duplicates', '{picard} MarkDuplicates INPUT={s}_re.bam OUTPUT={s}_nodups.bam METRICS_FILE=marked_dup_metrics_{s}.txt ASSUME_SORTED=true '
+        'REMOVE_DUPLICATES=true READ_NAME_REGEX="[a-zA-Z0-9]+:[0-9]:([0-9]+):([0-9]+):([0-9]+).*" OPTICAL_DUPLICATE_PIXEL_DISTANCE=100',
+        ['{s}_re.bam'], ['{s}_nodups.bam', 'marked_dup_metrics_{s}.txt'], 1, 10),
+    ('index_nodups', '{samtools} index {s}_nodups.bam',
+        ['{s}_nodups.bam'], ['{s}_nodups.bam.bai'], 1, 1),
+    ('realigner_targets', '{gatk} -T RealignerTargetCreator -nt {threads} -R {reference} -I {s}_nodups.bam -o forIndelRealigner_{s}.intervals',
+        ['{s}_nodups.bam', '{s}_nodups.bam.bai'], ['forIndelRealigner_{s}.intervals'], 2, 10),
+    ('indel_realigner', '{gatk} -T IndelRealigner -R {reference} -I {s}_nodups.bam -targetIntervals forIndelRealigner_{s}.intervals -o {s}_realn.bam',
+        ['{s}_nodups.bam', '{s}_nodups.bam.bai', 'forIndelRealigner_{s}.intervals'], ['{s}_realn.bam'], 1, 10),
+    ('fix_mate', '{picard} FixMateInformation I={s}_realn.bam O={s}_fix.bam SORT_ORDER=coordinate',
+        ['{s}_realn.bam'], ['{s}_fix.bam'], 1, 10),
+    ('index_fix', '{samtools} index {s}_fix.bam',
+        ['{s}_fix.bam'], ['{s}_fix.bam.bai'], 1, 1),
+    ('alignment_metrics', '{picard} CollectAlignmentSummaryMetrics R={reference} I={s}_fix.bam O=AlignmentSummaryMetrics_{s}.txt ASSUME_SORTED=true MAX_INSERT_SIZE=100000',
+        ['{s}_fix.bam'], ['AlignmentSummaryMetrics_{s}.txt'], 1, 10),
+    ('index_stats', '{picard} BamIndexStats I={s}_fix.bam > BamIndexStats_{s}.txt',
+        ['{s}_fix.bam', '{s}_fix.bam.bai'], ['BamIndexStats_{s}.txt'], 1, 10),
+    ('depth_of_coverage', '{gatk} -T DepthOfCoverage -R {reference} -o {s} --outputFormat table -I {s}_fix.bam',
+        ['{s}_fix.bam', '{s}_fix.bam.bai'], ['{s}.sample_summary'], 1, 10),
+]
+FREEBAYES = ('{freebayes} -L {bam_list} -f {reference} -T 0.001 -p 1 -i -X -n 0 -E 3 --min-repeat-size 5 -m 1 -q 20 -R 0 -Y 0 '
+             '-e 1000 -F 0.5 -C 2 -3 0 -G 1 -! 0 > {vcf}')
+STAGE_NAMES = [stage[0] for stage in SAMPLE_STAGES] + ['freebayes', 'extract']
+
+
+def get_arguments(argv=None):
+    parser = argparse.ArgumentParser(usage='%(prog)s [options] -o output.vcf', description="Run the bam_pipeline.sh stages as a checkpointed, resource limited task graph")
+    parser.add_argument('-w', '--workdir', dest='workdir', default='.', help="Directory with the <sample>_1.fastq.gz and <sample>_2.fastq.gz files, all outputs are written there. Default is the current directory")
+    parser.add_argument('--samples', dest='samples', nargs='+', help="Samples to process. Default is every <sample>_1.fastq.gz in the working directory")
+    parser.add_argument('-o', '--output', dest='vcf', help="freebayes vcf output file")
+    parser.add_argument('--fasta', dest='fasta', help="SNP alignment written by vcf_fa_extractor.py. Default is the vcf name with a .fa extension")
+    parser.add_argument('--extractor-args', dest='extractor_args', default='', help="Extra vcf_fa_extractor.py options, e.g. \"-q 20 -d 3\"")
+    parser.add_argument('--reference', dest='reference', default='/ufrc/salemi/tpaisie/cholera/ref_seq/v_cholerae_o1_2010el_1786.fa', help="Reference fasta file of the GATK, picard and freebayes stages")
+    parser.add_argument('--bowtie2-index', dest='bowtie2_index', default='/ufrc/data/reference/bowtie2/v_cholerae_o1_2010el_1786', help="bowtie2 index of the reference")
+    parser.add_argument('--adapters', dest='adapters', default='/apps/trimmomatic/0.36/adapters/NexteraPE-PE.fa', help="trimmomatic adapter file")
+    parser.add_argument('--tool', dest='tools', action='append', default=[], metavar='TOOL=COMMAND', help="Command of a tool, e.g. gatk='gatk3 -Xms1g'. Tools: {}".format(", ".join(sorted(TOOLS))))
+    parser.add_argument('--cores', dest='cores', type=int, default=multiprocessing.cpu_count(), help="Cores the tasks can use at the same time. Default is all cores")
+    parser.add_argument('--memory', dest='memory', type=float, help="Memory in Gb the tasks can use at the same time. Default is the physical memory")
+    parser.add_argument('--stage-threads', dest='stage_threads', action='append', default=[], metavar='STAGE=N', help="Threads of a stage's tasks")
+    parser.add_argument('--stage-memory', dest='stage_memory', action='append', default=[], metavar='STAGE=GB', help="Memory in Gb of a stage's tasks, the -Xmx of the java tools")
+    parser.add_argument('--check', dest='check', choices=['mtime', 'hash'], default='mtime', help="Treat a task as up to date when its inputs and outputs have the recorded mtime and size or the recorded content hash. Default is mtime")
+    parser.add_argument('--state', dest='state', default='.bam_pipeline_state.json', help="Checkpoint file in the working directory. Default is .bam_pipeline_state.json")
+    parser.add_argument('--timings', dest='timings', help="Write the per task timings to this JSON file")
+    parser.add_argument('-k', '--keep-going', action='store_true', dest='keep_going', default=False, help="Keep running the tasks that do not depend on a failed task")
+    parser.add_argument('-n', '--dry-run', action='store_true', dest='dry_run', default=False, help="Only list the tasks that would run")
+    parser.add_argument('--stub', action='store_true', default=False, help="Run stub commands that write placeholder outputs instead of the tools, to test the pipeline locally")
+    parser.add_argument('--stub-seconds', dest='stub_seconds', type=float, default=0, help="Seconds every stub command takes. Default is 0")
+    parser.add_argument('--run-stub', dest='run_stub', help=argparse.SUPPRESS)
+    parser.add_argument('-l', '--logfile', dest='logfile', help="Log file")
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help="Verbose output")
+    parser.add_argument('-g', '--debug', action='store_true', default=False, help=argparse.SUPPRESS)
+    parser.add_argument('--version', action='version', version='%(prog)s Version: {version}'.format(version=__version))
+    args = parser.parse_args(argv)
+    if args.run_stub:
+        return args
+    logger = setup_logger(args)
+    args.logger = logger
+    if not args.vcf:
+        parser.print_help()
+        sys.exit(1)
+    if not os.path.isdir(args.workdir):
+        sys.exit("Cannot access the working directory {}".format(args.workdir))
+    if not args.fasta:
+        args.fasta = os.path.splitext(args.vcf)[0] + ".fa"
+    args.tools = parse_settings(args.tools, 'tool', str, TOOLS)
+    args.stage_threads = parse_settings(args.stage_threads, 'stage', int, STAGE_NAMES)
+    args.stage_memory = parse_settings(args.stage_memory, 'stage', float, STAGE_NAMES)
+    if args.memory is None:
+        args.memory = physical_memory()
+    if args.cores < 1 or args.memory <= 0:
+        sys.exit("The core and memory budget has to be positive.")
+    if args.debug:
+        logger.info("Debugging output is on")
+    return args
+
+
+def parse_settings(settings, kind, convert, names):
+    """NAME=VALUE option values as a dictionary"""
+    values = {}
+    for setting in settings:
+        name, _, value = setting.partition('=')
+        if name not in names or not value:
+            sys.exit("Unknown {} setting {}, use one of {}".format(kind, setting, ", ".join(sorted(names))))
+        try:
+            values[name] = convert(value)
+        except ValueError:
+            sys.exit("Bad {} setting {}".format(kind, setting))
+    return values
+
+
+def physical_memory():
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / float(1 << 30)
+    except (ValueError, OSError, AttributeError):
+        return 8.0
+
+
+class Task(object):
+    """
+    A pipeline task. command is a shell command, or None for the in-process
+    vcf_fa_extractor.py call with extractor_argv. deps are the tasks that
+    write the inputs.
+    """
+    def __init__(self, name, stage, rank, command, inputs, outputs, threads, memory, java=False, extractor_argv=None):
+        self.name = name
+        self.stage = stage
+        self.rank = rank
+        self.command = command
+        self.inputs = inputs
+        self.outputs = outputs
+        self.threads = threads
+        self.memory = memory
+        self.java = java
+        self.extractor_argv = extractor_argv
+        self.deps = set()
+        self.process = None
+
+    def __repr__(self):
+        return "Task({})".format(self.name)
+
+
+def find_samples(args):
+    """Samples with a <sample>_1.fastq.gz file that is not a trimmomatic output"""
+    samples = []
+    for filename in sorted(glob.glob('*_1.fastq.gz')):
+        sample = filename[:-len('_1.fastq.gz')]
+        if not sample.endswith('_pair') and not sample.startswith('U_'):
+            samples.append(sample)
+    return samples
+
+
+def write_bam_list(filename, bams):
+    """Write the freebayes bam list, keeping the file and its mtime if it did not change"""
+    content = "".join([bam + "\n" for bam in bams])
+    if os.path.exists(filename):
+        with open(filename) as fh:
+            if fh.read() == content:
+                return
+    with open(filename, 'w') as fh:
+        fh.write(content)
+
+
+def stub_command(args, stage, inputs, outputs, samples=None):
+    """Shell command of a stub task that writes the outputs from the inputs"""
+    spec = {'stage': stage, 'inputs': inputs, 'outputs': outputs, 'seconds': args.stub_seconds, 'samples': samples}
+    return " ".join([pipes.quote(part) for part in (sys.executable, os.path.abspath(__file__), '--run-stub', json.dumps(spec))])
+
+
+def build_tasks(args, samples):
+    """The per sample stage tasks, freebayes and the extractor task, with their dependencies"""
+    logger = args.logger
+    fields = dict(TOOLS)
+    fields.update(args.tools)
+    fields.update({'reference': args.reference, 'bowtie2_index': args.bowtie2_index, 'adapters': args.adapters})
+    tasks = []
+    for rank, (stage, command, inputs, outputs, threads, memory) in enumerate(SAMPLE_STAGES):
+        threads = min(args.stage_threads.get(stage, threads), args.cores)
+        memory = args.stage_memory.get(stage, memory)
+        for sample in samples:
+            values = dict(fields, s=sample, threads=threads)
+            task_inputs = [name.format(**values) for name in inputs]
+            task_outputs = [name.format(**values) for name in outputs]
+            if args.stub:
+                task_command = stub_command(args, stage, task_inputs, task_outputs)
+            else:
+                task_command = command.format(**values)
+            java = command.startswith('{picard}') or command.startswith('{gatk}')
+            tasks.append(Task("{}:{}".format(stage, sample), stage, rank, task_command, task_inputs, task_outputs, threads, memory, java))
+    bams = ["{}_fix.bam".format(sample) for sample in samples]
+    bam_list = os.path.splitext(args.vcf)[0] + "_bams.txt"
+    write_bam_list(bam_list, bams)
+    inputs = [bam_list] + bams + [bam + ".bai" for bam in bams]
+    if args.stub:
+        command = stub_command(args, 'freebayes', inputs, [args.vcf], samples)
+    else:
+        command = FREEBAYES.format(bam_list=bam_list, vcf=args.vcf, **fields)
+    rank = len(SAMPLE_STAGES)
+    tasks.append(Task('freebayes', 'freebayes', rank, command, inputs, [args.vcf],
+        min(args.stage_threads.get('freebayes', 1), args.cores), args.stage_memory.get('freebayes', 4)))
+    extractor_argv = shlex.split(args.extractor_args) + ['-i', args.vcf, '-o', args.fasta]
+    tasks.append(Task('extract', 'extract', rank + 1, "vcf_fa_extractor.py " + " ".join(extractor_argv), [args.vcf], [args.fasta],
+        1, args.stage_memory.get('extract', 2), extractor_argv=extractor_argv))
+    producers = {}
+    for task in tasks:
+        for output in task.outputs:
+            if output in producers:
+                sys.exit("{} and {} both write {}".format(producers[output].name, task.name, output))
+            producers[output] = task
+        if task.memory > args.memory:
+            sys.exit("{} needs {} Gb, more than the memory budget of {} Gb".format(task.name, task.memory, args.memory))
+    for task in tasks:
+        for path in task.inputs:
+            if path in producers:
+                task.deps.add(producers[path])
+            elif not os.path.exists(path) and not args.dry_run:
+                sys.exit("Missing input file {} of {}".format(path, task.name))
+    if args.verbose:
+        logger.info("{} tasks for {} samples".format(len(tasks), len(samples)))
+    return tasks
+
+
+def file_sha1(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), ''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class Signatures(object):
+    """
+    File signatures: size and mtime, plus the content hash with --check hash.
+    A hash is only computed again when the size or mtime of a file changed.
+    """
+    def __init__(self, check):
+        self.check = check
+        self.known = {}
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        stat = os.stat(path)
+        signature = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        if self.check == 'hash':
+            with self.lock:
+                known = self.known.get(path)
+            if known and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime:
+                signature['sha1'] = known['sha1']
+            else:
+                signature['sha1'] = file_sha1(path)
+                with self.lock:
+                    self.known[path] = signature
+        return signature
+
+    def remember(self, entry):
+        """Reuse the hashes of a checkpoint entry for the files that did not change"""
+        if self.check == 'hash':
+            with self.lock:
+                for files in (entry.get('inputs', {}), entry.get('outputs', {})):
+                    for path, signature in files.items():
+                        if 'sha1' in signature:
+                            self.known.setdefault(path, signature)
+
+    def same(self, path, recorded):
+        if recorded is None or not os.path.exists(path):
+            return False
+        signature = self.get(path)
+        if self.check == 'hash':
+            return signature['sha1'] == recorded.get('sha1')
+        return signature['size'] == recorded['size'] and signature['mtime'] == recorded['mtime']
+
+
+def is_up_to_date(args, task, state, signatures):
+    """
+    True if the outputs of a task exist and its command, inputs and outputs
+    match its checkpoint entry. Without an entry, --check mtime accepts
+    outputs that are newer than the inputs, like make.
+    """
+    if not all([os.path.exists(path) for path in task.outputs]):
+        return False
+    entry = state.get(task.name)
+    if entry is None:
+        if args.check != 'mtime' or not all([os.path.exists(path) for path in task.inputs]):
+            return False
+        newest_input = max([os.path.getmtime(path) for path in task.inputs] or [0])
+        return min([os.path.getmtime(path) for path in task.outputs]) >= newest_input
+    if entry.get('command') != task.command:
+        return False
+    files = [(path, entry['inputs'].get(path)) for path in task.inputs] + [(path, entry['outputs'].get(path)) for path in task.outputs]
+    return all([signatures.same(path, recorded) for path, recorded in files])
+
+
+def load_state(args, signatures):
+    try:
+        with open(args.state) as fh:
+            state = json.load(fh)
+    except (IOError, ValueError):
+        return {}
+    if state.get('check') != args.check:
+        return {}
+    for entry in state['tasks'].values():
+        signatures.remember(entry)
+    return state['tasks']
+
+
+def save_state(args, state):
+    tmp_file = args.state + '.tmp'
+    with open(tmp_file, 'w') as fh:
+        json.dump({'version': __version, 'check': args.check, 'tasks': state}, fh, indent=1, sort_keys=True)
+    os.rename(tmp_file, args.state)
+
+
+def task_log(task):
+    if not os.path.isdir('logs'):
+        os.makedirs('logs')
+    return os.path.join('logs', task.name.replace(':', '_') + '.log')
+
+
+def run_command(task, signatures, results):
+    """Thread entry point: run a task's command and report its status, times and output signatures"""
+    start = time.time()
+    env = dict(os.environ)
+    if task.java:
+        env['_JAVA_OPTIONS'] = "-Xmx{}g".format(int(task.memory) or 1)
+    try:
+        with open(task_log(task), 'w') as log:
+            task.process = subprocess.Popen(task.command, shell=True, executable='/bin/bash', stdout=log, stderr=subprocess.STDOUT, env=env)
+            # wait4 gives the CPU time and peak memory of the command and its children
+            _, status, usage = os.wait4(task.process.pid, 0)
+            task.process.returncode = status
+        cpu = usage.ru_utime + usage.ru_stime
+        error = None if status == 0 else "exit status {}".format(os.WEXITSTATUS(status) if os.WIFEXITED(status) else status)
+        outputs = {}
+        if error is None:
+            missing = [path for path in task.outputs if not os.path.exists(path)]
+            if missing:
+                error = "did not write {}".format(", ".join(missing))
+            else:
+                outputs = dict([(path, signatures.get(path)) for path in task.outputs])
+        results.put((task, error, start, time.time() - start, cpu, usage.ru_maxrss, outputs))
+    except (OSError, IOError) as e:
+        results.put((task, str(e), start, time.time() - start, 0, 0, {}))
+
+
+def run_extractor(task, signatures):
+    """Call vcf_fa_extractor.py in this process"""
+    start = time.time()
+    times = os.times()
+    try:
+        vcf_fa_extractor.main(task.extractor_argv)
+        error = None
+    except SystemExit as e:
+        error = None if e.code in (0, None) else "vcf_fa_extractor.py exited with {}".format(e.code)
+    cpu = sum(os.times()[:2]) - sum(times[:2])
+    outputs = {}
+    if error is None:
+        outputs = dict([(path, signatures.get(path)) for path in task.outputs if os.path.exists(path)])
+    return task, error, start, time.time() - start, cpu, 0, outputs
+
+
+def run_tasks(args, tasks, state, signatures):
+    """
+    Run the tasks that are not up to date as their dependencies finish. A
+    ready task starts when its threads and memory fit into what the running
+    tasks leave of --cores and --memory; tasks of later stages go first, so
+    samples are finished rather than every sample started. Returns the task
+    timings.
+    """
+    logger = args.logger
+    pipeline_start = time.time()
+    order = dict([(task, idx) for idx, task in enumerate(tasks)])
+    pending = set(tasks)
+    finished = set()
+    running = set()
+    failed = []
+    timings = []
+    free_cores = args.cores
+    free_memory = args.memory
+    results = Queue.Queue()
+
+    def record(task, status, start=None, wall=0, cpu=0, max_rss=0):
+        timings.append({'task': task.name, 'stage': task.stage, 'status': status, 'threads': task.threads, 'memory_gb': task.memory,
+                        'start': round(start - pipeline_start, 3) if start else None, 'wall': round(wall, 3), 'cpu': round(cpu, 3), 'max_rss_kb': max_rss})
+
+    def complete(task, error, start, wall, cpu, max_rss, outputs):
+        if error:
+            failed.append(task)
+            logger.error("{} failed: {}, see {}".format(task.name, error, task_log(task)))
+            record(task, 'failed', start, wall, cpu, max_rss)
+            return
+        state[task.name] = {'command': task.command, 'inputs': dict([(path, signatures.get(path)) for path in task.inputs]),
+                            'outputs': outputs, 'wall': wall}
+        save_state(args, state)
+        finished.add(task)
+        record(task, 'done', start, wall, cpu, max_rss)
+        logger.info("{} done in {:.1f} s ({:.1f} s CPU)".format(task.name, wall, cpu))
+
+    try:
+        while pending or running:
+            started = False
+            ready = sorted([task for task in pending if task.deps <= finished], key=lambda task: (-task.rank, order[task]))
+            for task in ready:
+                if failed and not args.keep_going:
+                    break
+                if is_up_to_date(args, task, state, signatures):
+                    pending.remove(task)
+                    finished.add(task)
+                    record(task, 'skipped')
+                    started = True
+                    if args.verbose:
+                        logger.info("{} is up to date".format(task.name))
+                elif task.extractor_argv is not None:
+                    if running:
+                        continue
+                    pending.remove(task)
+                    logger.info("Running {}".format(task.command))
+                    complete(*run_extractor(task, signatures))
+                    started = True
+                elif task.threads <= free_cores and task.memory <= free_memory:
+                    pending.remove(task)
+                    running.add(task)
+                    free_cores -= task.threads
+                    free_memory -= task.memory
+                    if args.verbose:
+                        logger.info("Starting {} with {} threads and {} Gb".format(task.name, task.threads, task.memory))
+                    if args.debug:
+                        logger.debug(task.command)
+                    thread = threading.Thread(target=run_command, args=(task, signatures, results))
+                    thread.daemon = True
+                    thread.start()
+                    started = True
+            if started:
+                continue
+            if not running:
+                break
+            # A long timeout keeps the wait interruptible with Ctrl-C
+            result = results.get(True, 1e6)
+            task = result[0]
+            running.remove(task)
+            free_cores += task.threads
+            free_memory += task.memory
+            complete(*result)
+    except KeyboardInterrupt:
+        for task in running:
+            if task.process is not None and task.process.returncode is None:
+                task.process.terminate()
+        sys.exit("Interrupted, the finished tasks are checkpointed in {}".format(args.state))
+    if pending:
+        logger.error("{} tasks did not run because of the failed tasks: {}".format(len(pending), ", ".join(sorted([task.name for task in pending]))))
+    return timings, failed
+
+
+def dry_run(args, tasks, state, signatures):
+    """Print the tasks that would run: the ones that are not up to date and everything that depends on them"""
+    will_run = set()
+    for task in tasks:
+        if task.deps & will_run or not is_up_to_date(args, task, state, signatures):
+            will_run.add(task)
+            print "{0:<40} {1:>3} threads {2:>6} Gb  {3}".format(task.name, task.threads, task.memory, task.command)
+    print "{} of {} tasks would run".format(len(will_run), len(tasks))
+
+
+def report_timings(args, timings):
+    """Log the per stage totals and write the per task timings"""
+    logger = args.logger
+    stages = {}
+    for timing in timings:
+        stage = stages.setdefault(timing['stage'], {'done': 0, 'skipped': 0, 'failed': 0, 'wall': 0.0, 'cpu': 0.0})
+        stage[timing['status']] += 1
+        stage['wall'] += timing['wall']
+        stage['cpu'] += timing['cpu']
+    for name in STAGE_NAMES:
+        if name in stages:
+            stage = stages[name]
+            logger.info("{:<20} {} run, {} skipped, {} failed, {:.1f} s wall, {:.1f} s CPU".format(
+                name, stage['done'], stage['skipped'], stage['failed'], stage['wall'], stage['cpu']))
+    if args.timings:
+        with open(args.timings, 'w') as fh:
+            json.dump({'version': __version, 'cores': args.cores, 'memory_gb': args.memory, 'stages': stages, 'tasks': timings},
+                      fh, indent=1, sort_keys=True)
+
+
+def stub_vcf(filename, samples):
+    """A small freebayes-like vcf with deterministic calls for the stub freebayes task"""
+    with open(filename, 'w') as fh:
+        fh.write("##fileformat=VCFv4.1\n##source=bam_pipeline.py stub\n")
+        fh.write("\t".join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] + samples) + "\n")
+        for site in range(20):
+            calls = [str(int(hashlib.sha1("{}:{}".format(sample, site)).hexdigest(), 16) % 2) + ":30" for sample in samples]
+            fh.write("\t".join(['stub', str(100 + site * 50), '.', 'A', 'G', '100', '.', 'DP=300', 'GT:DP'] + calls) + "\n")
+
+
+def run_stub(spec):
+    """Write the outputs of a stub task: a hash of the stage and its inputs, or a vcf for freebayes"""
+    spec = json.loads(spec)
+    time.sleep(spec['seconds'])
+    sha1 = hashlib.sha1(spec['stage'])
+    for path in spec['inputs']:
+        sha1.update(file_sha1(path))
+    for path in spec['outputs']:
+        if path.endswith('.vcf'):
+            stub_vcf(path, spec['samples'])
+        else:
+            with open(path, 'w') as fh:
+                fh.write("{} {}\n".format(spec['stage'], sha1.hexdigest()))
+
+
+def setup_logger(args):
+    """
+    Set up logging to a file or stdout
+    Arguments:
+    * logfile - file to write logs to
+    * log level - verbose or debug
+    """
+    formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
+    log = logging.getLogger(__name__)
+    if args.logfile:
+        file_log = logging.FileHandler(args.logfile)
+        file_log.setFormatter(formatter)
+        log.addHandler(file_log)
+    console_log = logging.StreamHandler(stream=sys.stdout)
+    console_log.setFormatter(formatter)
+    if args.debug:
+        console_log.setLevel(logging.DEBUG)
+        log.setLevel('DEBUG')
+    else:
+        console_log.setLevel(logging.INFO)
+        log.setLevel('INFO')
+    log.addHandler(console_log)
+    return log
+
+
+def main():
+    args = get_arguments()
+    if args.run_stub:
+        run_stub(args.run_stub)
+        sys.exit(0)
+    logger = args.logger
+    if args.logfile:
+        args.logfile = os.path.abspath(args.logfile)
+    if args.timings:
+        args.timings = os.path.abspath(args.timings)
+    os.chdir(args.workdir)
+    samples = args.samples or find_samples(args)
+    if not samples:
+        sys.exit("No <sample>_1.fastq.gz files in {}".format(args.workdir))
+    logger.info("Processing {} samples with {} cores and {:.1f} Gb".format(len(samples), args.cores, args.memory))
+    tasks = build_tasks(args, samples)
+    signatures = Signatures(args.check)
+    state = load_state(args, signatures)
+    if args.dry_run:
+        dry_run(args, tasks, state, signatures)
+        sys.exit(0)
+    timings, failed = run_tasks(args, tasks, state, signatures)
+    report_timings(args, timings)
+    if failed:
+        sys.exit("{} tasks failed: {}".format(len(failed), ", ".join([task.name for task in failed])))
+    logger.info("All tasks completed successfully")
+    sys.exit(0)
+
+
+if __name__=='__main__':
+    main()
@@ -5,30 +5,98 @@ Author: Oleksandr Moskalenko <om@rc.ufl.edu>
 Version: 1.4
 Date: 2016-03-10
 """
-import os, sys, operator, logging, argparse
+import os, sys, operator, logging, argparse, gzip, re, struct, zlib, multiprocessing, collections
+import hashlib, json, shutil, tempfile, time, contextlib, mmap, threading, Queue, csv
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+try:
+    import resource
+except ImportError:
+    resource = None
 
 __version="1.4"
 
+# Genotype matrix codes for '.' calls and for alleles that are not integers
+MISSING_GT = -1
+INVALID_GT = -2
+# Largest coordinate addressable by the tabix binning scheme
+TABIX_MAX_POS = 1 << 29
+# Number of records between the progress checks of track_progress
+PROGRESS_BATCH = 10000
+# BGZF blocks inflated together by a ParallelBgzfReader thread, about 1 Mb of text
+BGZF_BATCH_BLOCKS = 16
+# Samples per side of a distance matrix tile and packed 64 site words per tile pass
+DISTANCE_TILE = 64
+DISTANCE_CHUNK = 512
+# SnpEff data table columns and the rows per parquet row group / arrow record batch
+DATA_TABLE_HEADER = ['Chrom', 'Position', 'Effect', 'Effect_Impact',
+    'Functional_Class', 'Codon_Change', 'Amino_Acid_change',
+    'Amino_Acid_length', 'Gene_Name', 'Gene_BioType', 'Coding',
+    'Transcript', 'Exon', 'SampleOne (yes/no)', 'SampleTwo (yes/no)']
+TABLE_BATCH_ROWS = 65536
+
 args = ''
+# iter_variants callers that do not set up logging get no handler warnings
+logging.getLogger(__name__).addHandler(logging.NullHandler())
 
 
-def get_arguments():
+def get_arguments(argv=None):
     parser = argparse.ArgumentParser(usage='%(prog)s [options] -i input_file [-o output_file]', epilog="You must at least provide the input file name")
     parser.add_argument('-i', '--input', dest='infile', help="Input vcf file")
     parser.add_argument('-o', '--output', dest='outfile', help="Output fasta file")
     parser.add_argument('-l', '--logfile', dest=None, help="Log file")
     parser.add_argument('-t', '--table', dest='table', help="Output a tab-delimited sample data table to a file")
+    parser.add_argument('--table-format', dest='table_format', choices=['csv', 'parquet', 'arrow'], default='csv', help="Format of the data table. parquet and arrow (IPC file) tables have integer Position and Amino_Acid_length columns and get a per gene summary next to them. Default is csv")
     parser.add_argument('-q', '--quality', dest='quality', type=int, default=-1, help="QUAL cutoff, optionsl")
     parser.add_argument('-d', '--distance', dest='distance', type=int, default=-1, help="Distance filter (minimal distance between bases)")
+    parser.add_argument('--cluster', dest='cluster', type=int, nargs=2, metavar=('K', 'W'), help="Cluster filter: discard every SNP in a group of K or more SNPs spanning less than W bases")
+    parser.add_argument('--samples', dest='samples', help="Only extract the samples listed in this file, one sample name per line")
+    parser.add_argument('--exclude-samples', dest='exclude_samples', help="Do not extract the samples listed in this file, one sample name per line")
+    parser.add_argument('--drop-invariant', action='store_true', dest='drop_invariant', default=False, help="Drop the sites where all the extracted samples have the same allele or no call")
+    parser.add_argument('--min-gq', dest='min_gq', type=float, help="Replace the calls with a GQ below this value by '?'")
+    parser.add_argument('--min-dp', dest='min_dp', type=int, help="Replace the calls with a DP below this read depth by '?'")
+    parser.add_argument('--min-alt-frac', dest='min_alt_frac', type=float, help="Replace the ALT calls supported by less than this fraction of the RO and AO reads by '?'")
+    parser.add_argument('--discarded', dest='discarded', help="Write the CHROM, POS and filter of every discarded site to this file")
     parser.add_argument('-s', '--snpeff', dest='snpeff', help="Parse SnpEFF produced extended INFO field and output a codon alignment into the specified file.")
     parser.add_argument('--genotype', dest='genotype', type=int, default=1, help="Which genotype identifier to choose in 1/2. Default is 1")
     parser.add_argument('-n', '--nostop', action='store_true', dest='nostop', default=False, help="Output empty ref and codon for a position if the SnpEFF Effect is 'STOP_GAINED'.")
+    parser.add_argument('--stream', action='store_true', default=False, help="Parse, filter and convert the vcf file in a single pass without holding the parsed records in memory.")
+    parser.add_argument('-r', '--region', dest='region', action='append', help="Only extract records in the CHROM[:start-end] region of a bgzip compressed and tabix indexed vcf file. Can be given multiple times.")
+    parser.add_argument('--cache', action='store_true', default=False, help="Cache the parsed vcf file in a sidecar directory next to the input and reuse it on reruns")
+    parser.add_argument('--cache-dir', dest='cache_dir', help="Keep the parsed vcf caches in this shared directory. Implies --cache")
+    parser.add_argument('--cache-max-size', dest='cache_max_size', type=int, default=0, help="Evict the least recently used caches when --cache-dir grows over this many Mb. Default is no limit")
+    parser.add_argument('--threads', dest='threads', type=int, default=2, help="Number of threads inflating a bgzip compressed input while it is parsed. 0 reads it with the gzip module. Default is 2")
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=1, help="Number of worker processes used to parse the vcf file. Default is 1")
+    parser.add_argument('--metrics', dest='metrics', help="Write the per stage wall and CPU times, throughput, peak memory and site counts of the run to this JSON file")
+    parser.add_argument('--progress', dest='progress', type=int, default=60, help="Report the parsing progress every this many seconds. 0 turns the reports off. Default is 60")
+    parser.add_argument('--distance-matrix', dest='distance_matrix', help="Write the pairwise SNP distances of the reference and the samples to this file")
+    parser.add_argument('--distance-format', dest='distance_format', choices=['csv', 'phylip'], default='csv', help="Format of the distance matrix. Default is csv")
+    parser.add_argument('--distance-missing', dest='distance_missing', choices=['ignore', 'count', 'scale'], default='ignore', help="Sites with a '.' call in one sample of a pair are ignored, counted as a difference or ignored with the distance scaled up to all sites. Default is ignore")
+    parser.add_argument('--state', dest='state', help="Alignment state file with the CHROM, POS and REF of every alignment column, written next to the fasta output and read by --append")
+    parser.add_argument('--append', action='store_true', default=False, help="Merge the samples of the input into the existing fasta output described by --state instead of replacing it")
+    parser.add_argument('--backfill', dest='backfill', choices=['missing', 'reference'], default='missing', help="Fill the sites a sample was not called at with '?' or with the reference allele in --append mode. Default is missing")
+    parser.add_argument('--beast-template', dest='beast_templates', nargs='+', metavar='XML', help="BEAST xml templates to write the alignment into. Their <taxa> and <alignment> sections are replaced, everything else is copied")
+    parser.add_argument('--beast-dir', dest='beast_dir', help="Directory for the generated BEAST xml files, named like their templates. Default is the directory of the fasta output")
+    parser.add_argument('--beast-taxa', dest='beast_taxa', help="Tab-delimited file with a header of the taxa to write into the BEAST xml files: a taxon column, optional sample (name in the vcf) and date columns and a column per taxon attribute. Default is the template taxa that have a sequence")
+    parser.add_argument('--beast-alignment', dest='beast_alignment', choices=['fasta', 'codon'], default='fasta', help="Write the fasta or the -s codon alignment into the BEAST xml files. Default is fasta")
+    parser.add_argument('--reference', dest='reference', help="Reference genome fasta file for --full-genome")
+    parser.add_argument('--full-genome', action='store_true', dest='full_genome', default=False, help="Write whole genome pseudo-sequences, the --reference sequences with the sample alleles applied, to the fasta output instead of the variable sites")
+    parser.add_argument('--missing-char', dest='missing_char', default='?', help="Character for the '.' calls in the --full-genome output, e.g. N. Default is ?")
+    parser.add_argument('--backend', dest='backend', choices=['python', 'numpy'], default='python', help="Genotype conversion backend. The numpy backend decodes the genotypes into a sites x samples matrix. Default is python")
     parser.add_argument('-v', '--verbose', action='store_true', default=False, help="Verbose output")
     parser.add_argument('-g', '--debug', action='store_true', default=False, help=argparse.SUPPRESS)
     parser.add_argument('--version', action='version', version='%(prog)s Version: {version}'.format(version=__version))
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     logger = setup_logger(args)
     args.logger = logger
+    args.stats = Metrics(logger, args.progress)
     if (not args.infile):
         parser.print_help()
         sys.exit(1)
@@ -38,7 +106,7 @@ def get_arguments():
     if not args.outfile:
         if args.verbose:
             logger.info("It looks like you provided the input file as an argument. The output filename will be automatically generated. No quality filtering will be performed.")
-        args.outfile = os.path.splitext(args.infile)[0] + ".fa"
+        args.outfile = os.path.splitext(strip_gz_suffix(args.infile))[0] + ".fa"
     if args.verbose:
         logger.info("Input file: {}".format(args.infile))
         logger.info("Output file: {}".format(args.outfile))
@@ -50,6 +118,65 @@ def get_arguments():
             logger.info("Distance filter: {}".format(args.distance))
         else:
             logger.info("Distance filter is not set")
+        if args.cluster:
+            logger.info("Cluster filter: {} SNPs within {} bases".format(*args.cluster))
+    for sample_file in (args.samples, args.exclude_samples):
+        if sample_file and not os.access(sample_file, os.R_OK):
+            sys.exit("Cannot access the sample list file {}".format(sample_file))
+    if args.min_alt_frac is not None and not 0 <= args.min_alt_frac <= 1:
+        sys.exit("--min-alt-frac has to be between 0 and 1.")
+    args.masking = args.min_gq is not None or args.min_dp is not None or args.min_alt_frac is not None
+    if args.region and not os.access(args.infile + '.tbi', os.R_OK):
+        sys.exit("Region queries require a tabix index: {}.tbi".format(args.infile))
+    if args.cluster and (args.cluster[0] < 2 or args.cluster[1] < 1):
+        sys.exit("The cluster filter needs K >= 2 SNPs and a window of W >= 1 bases.")
+    if args.progress < 0:
+        sys.exit("The progress interval can not be negative.")
+    if args.threads < 0:
+        sys.exit("The number of threads can not be negative.")
+    if args.workers < 1:
+        sys.exit("The number of workers must be at least 1.")
+    if args.workers > 1 and (args.stream or args.region):
+        sys.exit("--workers can not be combined with --stream or --region.")
+    if args.cache_dir:
+        args.cache = True
+    if args.cache and (args.stream or args.region):
+        sys.exit("--cache can not be combined with --stream or --region.")
+    if args.cache and np is None:
+        sys.exit("The parsed vcf cache requires the numpy module.")
+    if (args.state or args.append) and args.stream:
+        sys.exit("--state and --append can not be combined with --stream.")
+    if args.append and not args.state:
+        sys.exit("--append needs the --state file of the existing alignment.")
+    if args.full_genome:
+        if not args.reference or not os.access(args.reference, os.R_OK):
+            sys.exit("--full-genome needs a readable --reference fasta file.")
+        if args.stream or args.state:
+            sys.exit("--full-genome can not be combined with --stream, --state or --append.")
+        if np is None:
+            sys.exit("The full genome output requires the numpy module.")
+        if len(args.missing_char) != 1:
+            sys.exit("--missing-char has to be a single character.")
+    if args.beast_templates:
+        for template in args.beast_templates:
+            if not os.access(template, os.R_OK):
+                sys.exit("Cannot access the BEAST template {}".format(template))
+        if args.full_genome:
+            sys.exit("--beast-template can not be combined with --full-genome.")
+        if args.beast_alignment == 'codon' and not args.snpeff:
+            sys.exit("--beast-alignment codon needs the -s codon alignment.")
+        if args.beast_taxa and not os.access(args.beast_taxa, os.R_OK):
+            sys.exit("Cannot access the BEAST taxa file {}".format(args.beast_taxa))
+        if not args.beast_dir:
+            args.beast_dir = os.path.dirname(os.path.abspath(args.outfile))
+    if args.distance_matrix and args.stream:
+        sys.exit("--distance-matrix can not be combined with --stream.")
+    if args.distance_matrix and np is None:
+        sys.exit("The distance matrix requires the numpy module.")
+    if args.table and args.table_format != 'csv' and pyarrow is None:
+        sys.exit("The parquet and arrow data tables require the pyarrow module.")
+    if args.backend == 'numpy' and np is None:
+        sys.exit("The numpy backend requires the numpy module.")
     if args.debug:
         logger.info("Debugging output is on")
     return (args)
@@ -70,117 +197,658 @@ def get_header(verbose, fh):
             sys.exit(1)
 
 
-def parse_snpeff_info(args, data):
+def strip_gz_suffix(filename):
+    if filename.endswith('.gz'):
+        return filename[:-3]
+    return filename
+
+
+def open_input(filename, threads=0):
+    """
+    Open a plain text or a gzip/bgzip compressed vcf file for reading. BGZF
+    files are inflated by a ParallelBgzfReader if threads are given.
+    """
+    with open(filename, 'rb') as fh:
+        magic = fh.read(2)
+    if magic == '\x1f\x8b':
+        if threads and is_bgzf(filename):
+            return ParallelBgzfReader(filename, threads)
+        return gzip.open(filename, 'rb')
+    return open(filename, 'r')
+
+
+def read_bgzf_header(fh):
+    """
+    Read the gzip header of a BGZF block from the current position of a
+    binary file handle. Returns the total size of the block and the length
+    of the extra field. The size is 0 at the end of the file.
+    """
+    header = fh.read(12)
+    if not header:
+        return 0, 0
+    if len(header) < 12 or header[:4] != '\x1f\x8b\x08\x04':
+        sys.exit("Input is not a BGZF (bgzip) compressed file.")
+    xlen = struct.unpack('<H', header[10:12])[0]
+    extra = fh.read(xlen)
+    pos = 0
+    while pos < xlen:
+        si1, si2, slen = struct.unpack('<BBH', extra[pos:pos + 4])
+        if si1 == 66 and si2 == 67:
+            return struct.unpack('<H', extra[pos + 4:pos + 6])[0] + 1, xlen
+        pos += 4 + slen
+    sys.exit("Input is not a BGZF (bgzip) compressed file.")
+
+
+def read_bgzf_block(fh):
+    """
+    Read one BGZF block from the current position of a binary file handle.
+    Returns the total size of the block and its raw deflate data. The size
+    is 0 at the end of the file.
+    """
+    block_size, xlen = read_bgzf_header(fh)
+    if not block_size:
+        return 0, ''
+    cdata = fh.read(block_size - xlen - 20)
+    fh.read(8)
+    return block_size, cdata
+
+
+def is_bgzf(filename):
+    with open(filename, 'rb') as fh:
+        header = fh.read(16)
+    return header[:4] == '\x1f\x8b\x08\x04' and header[12:14] == 'BC'
+
+
+def bgzf_block_offsets(filename):
+    """File offsets of all BGZF blocks, found by hopping over the block headers"""
+    offsets = []
+    with open(filename, 'rb') as fh:
+        offset = 0
+        while True:
+            fh.seek(offset)
+            block_size, xlen = read_bgzf_header(fh)
+            if not block_size:
+                break
+            offsets.append(offset)
+            offset += block_size
+    return offsets, offset
+
+
+def inflate_bgzf_block(cdata):
+    return zlib.decompress(cdata, -15)
+
+
+class BgzfReader(object):
+    """
+    Random access line reader for BGZF compressed files. Positions are BGZF
+    virtual offsets: the file offset of a compressed block shifted left by
+    16 bits and or'ed with the offset in the uncompressed block.
+    """
+
+    def __init__(self, filename):
+        self.fh = open(filename, 'rb')
+        self.block_offset = 0
+        self.next_block_offset = 0
+        self.buffer = ''
+        self.within = 0
+        self.seek(0)
+
+    def _load_block(self, offset):
+        self.fh.seek(offset)
+        block_size, cdata = read_bgzf_block(self.fh)
+        self.block_offset = offset
+        self.next_block_offset = offset + block_size
+        self.buffer = inflate_bgzf_block(cdata) if block_size else ''
+        self.within = 0
+        return block_size
+
+    def seek(self, virtual_offset):
+        self._load_block(virtual_offset >> 16)
+        self.within = virtual_offset & 0xFFFF
+
+    def tell(self):
+        return (self.block_offset << 16) | self.within
+
+    def readline(self):
+        chunks = []
+        while True:
+            if self.within >= len(self.buffer):
+                if not self._load_block(self.next_block_offset):
+                    break
+                continue
+            end = self.buffer.find('\n', self.within)
+            if end == -1:
+                chunks.append(self.buffer[self.within:])
+                self.within = len(self.buffer)
+            else:
+                chunks.append(self.buffer[self.within:end + 1])
+                self.within = end + 1
+                break
+        # Step onto the next block so that tell() matches the index offsets
+        while self.within >= len(self.buffer) and self.block_offset != self.next_block_offset:
+            if not self._load_block(self.next_block_offset):
+                break
+        return ''.join(chunks)
+
+    def close(self):
+        self.fh.close()
+
+
+def inflate_bgzf_batch(batch):
+    return ''.join([inflate_bgzf_block(cdata) for cdata in batch])
+
+
+class ParallelBgzfReader(object):
+    """
+    Sequential line reader for BGZF files. A feeder thread reads batches of
+    compressed blocks and hands them to 'threads' inflating threads (zlib
+    releases the GIL), so decompression overlaps the parsing of the lines.
+    The pending batches are passed on in file order through a bounded queue,
+    which caps the memory held to a few batches per thread. Iterates like a
+    file object; seek() only supports rewinding to the start.
+    """
+
+    def __init__(self, filename, threads, queue_size=None):
+        self.filename = filename
+        self.threads = threads
+        self.queue_size = queue_size or threads * 4
+        self.fh = None
+        self._start()
+
+    def _start(self):
+        self.fh = open(self.filename, 'rb')
+        self.tasks = Queue.Queue()
+        self.queue = Queue.Queue(self.queue_size)
+        self.stopped = threading.Event()
+        self.workers = [threading.Thread(target=self._inflate) for idx in range(self.threads)]
+        self.feeder = threading.Thread(target=self._feed)
+        for thread in self.workers + [self.feeder]:
+            thread.daemon = True
+            thread.start()
+        self.lines = self._read_lines()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                continue
+
+    def _feed(self):
+        """Read the compressed batches. A task is [batch, text or error, done event]."""
+        try:
+            while not self.stopped.is_set():
+                batch = []
+                while len(batch) < BGZF_BATCH_BLOCKS:
+                    block_size, cdata = read_bgzf_block(self.fh)
+                    if not block_size:
+                        break
+                    batch.append(cdata)
+                if not batch:
+                    break
+                task = [batch, None, threading.Event()]
+                self.tasks.put(task)
+                self._put(task)
+        except (Exception, SystemExit) as error:
+            task = [None, error, threading.Event()]
+            task[2].set()
+            self._put(task)
+        self._put(None)
+
+    def _inflate(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            try:
+                task[1] = inflate_bgzf_batch(task[0])
+            except Exception as error:
+                task[1] = error
+            task[0] = None
+            task[2].set()
+
+    def _read_lines(self):
+        remainder = ''
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            task[2].wait()
+            if isinstance(task[1], SystemExit):
+                sys.exit(task[1].code)
+            if isinstance(task[1], Exception):
+                raise task[1]
+            lines = task[1].split('\n')
+            task[1] = None
+            lines[0] = remainder + lines[0]
+            remainder = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if remainder:
+            yield remainder
+
+    def __iter__(self):
+        return self.lines
+
+    def next(self):
+        return next(self.lines)
+
+    def seek(self, offset, whence=0):
+        if offset != 0 or whence != 0:
+            raise IOError("ParallelBgzfReader can only seek to the start of the file")
+        self.close()
+        self._start()
+
+    def close(self):
+        if self.fh is None:
+            return
+        self.stopped.set()
+        # Make room in the queue for a feeder that waits to put a batch
+        while self.feeder.is_alive():
+            try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                pass
+            self.feeder.join(0.01)
+        for thread in self.workers:
+            self.tasks.put(None)
+        for thread in self.workers:
+            thread.join()
+        self.fh.close()
+        self.fh = None
+
+
+def read_tabix_index(filename):
+    """
+    Parse a tabix (.tbi) index into a dictionary of sequence name ->
+    (bins, linear index), where bins maps a bin number to its list of
+    (start, end) virtual offset chunks.
+    """
+    fh = gzip.open(filename, 'rb')
+    data = fh.read()
+    fh.close()
+    if data[:4] != 'TBI\x01':
+        sys.exit("{} is not a tabix index.".format(filename))
+    n_ref, fmt, col_seq, col_beg, col_end, meta, skip, l_nm = struct.unpack('<8i', data[4:36])
+    if fmt & 0xFFFF != 2:
+        sys.exit("{} is not a tabix index of a vcf file.".format(filename))
+    names = data[36:36 + l_nm].split('\x00')[:n_ref]
+    offset = 36 + l_nm
+    index = {}
+    for name in names:
+        bins = {}
+        n_bin = struct.unpack('<i', data[offset:offset + 4])[0]
+        offset += 4
+        for i in range(n_bin):
+            bin_number, n_chunk = struct.unpack('<Ii', data[offset:offset + 8])
+            offset += 8
+            chunks = struct.unpack('<{}Q'.format(2 * n_chunk), data[offset:offset + 16 * n_chunk])
+            offset += 16 * n_chunk
+            bins[bin_number] = zip(chunks[::2], chunks[1::2])
+        n_intv = struct.unpack('<i', data[offset:offset + 4])[0]
+        offset += 4
+        linear_index = struct.unpack('<{}Q'.format(n_intv), data[offset:offset + 8 * n_intv])
+        offset += 8 * n_intv
+        index[name] = (bins, linear_index)
+    return names, index
+
+
+def reg2bins(beg, end):
+    """Tabix/BAI bins overlapping the zero based [beg, end) interval"""
+    end -= 1
+    bins = [0]
+    for shift, offset in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+        bins.extend(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+    return bins
+
+
+def parse_region(region):
+    """Parse CHROM[:start[-end]] into a chromosome and a zero based [beg, end) interval"""
+    match = re.match(r'^(.+):([0-9,]+)(?:-([0-9,]+))?$', region)
+    if not match:
+        return region, 0, TABIX_MAX_POS
+    chrom = match.group(1)
+    start = int(match.group(2).replace(',', ''))
+    if match.group(3):
+        end = int(match.group(3).replace(',', ''))
+    else:
+        end = TABIX_MAX_POS
+    if start < 1 or end < start:
+        sys.exit("Invalid region: {}".format(region))
+    return chrom, start - 1, end
+
+
+def merge_regions(names, regions):
+    """Sort the regions in the index order and merge the overlapping ones"""
+    order = dict((name, idx) for idx, name in enumerate(names))
+    intervals = sorted(regions, key=lambda region: (order[region[0]], region[1], region[2]))
+    merged = []
+    for chrom, beg, end in intervals:
+        if merged and merged[-1][0] == chrom and beg <= merged[-1][2]:
+            merged[-1][2] = max(merged[-1][2], end)
+        else:
+            merged.append([chrom, beg, end])
+    return merged
+
+
+def tabix_chunks(index, chrom, beg, end):
+    """Merged virtual offset chunks of the BGZF blocks that cover a region"""
+    bins, linear_index = index[chrom]
+    if linear_index:
+        min_offset = linear_index[min(beg >> 14, len(linear_index) - 1)]
+    else:
+        min_offset = 0
+    chunks = []
+    for bin_number in reg2bins(beg, end):
+        for chunk in bins.get(bin_number, []):
+            if chunk[1] > min_offset:
+                chunks.append(chunk)
+    chunks.sort()
+    merged = []
+    for chunk_beg, chunk_end in chunks:
+        if merged and chunk_beg <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], chunk_end)
+        else:
+            merged.append([chunk_beg, chunk_end])
+    return merged
+
+
+def fetch_regions(args, filename, regions):
+    """
+    Yield the vcf lines of a bgzip compressed and tabix indexed file that
+    overlap the given CHROM[:start-end] regions, in the genomic order of the
+    index. Only the BGZF blocks listed in the index for each region are read.
+    """
+    logger = args.logger
+    names, index = read_tabix_index(filename + '.tbi')
+    intervals = []
+    for region in regions:
+        chrom, beg, end = parse_region(region)
+        if chrom not in index:
+            logger.warning("Sequence '{}' is not in the tabix index, skipping region {}".format(chrom, region))
+            continue
+        intervals.append((chrom, beg, end))
+    reader = BgzfReader(filename)
+    try:
+        for chrom, beg, end in merge_regions(names, intervals):
+            if args.verbose:
+                logger.info("Reading region {}:{}-{}".format(chrom, beg + 1, end))
+            for chunk_beg, chunk_end in tabix_chunks(index, chrom, beg, end):
+                reader.seek(chunk_beg)
+                while reader.tell() < chunk_end:
+                    line = reader.readline()
+                    if not line:
+                        break
+                    if line.startswith('#'):
+                        continue
+                    fields = line.split('\t', 4)
+                    if fields[0] != chrom:
+                        continue
+                    record_beg = int(fields[1]) - 1
+                    if record_beg >= end:
+                        break
+                    if record_beg + len(fields[3]) > beg:
+                        yield line
+    finally:
+        reader.close()
+
+
+def parse_snpeff_info(args, data, alt=''):
     """
     INFO=<ID=EFF,Number=.,Type=String,Description="Predicted effects for this variant.Format: 'Effect ( Effect_Impact | Functional_Class | Codon_Change | Amino_Acid_change| Amino_Acid_length | Gene_Name | Gene_BioType | Coding | Transcript | Exon  | GenotypeNum [ | ERRORS | WARNINGS ] )' ">
     INFO AB=0;ABP=0;AC=2;AF=0.0322581;AN=62;AO=6;BasesToClosestVariant=32;CIGAR=1X;DP=10291;DPRA=1.19446;EPP=3.0103;EPPR=130.21;HWE=-0;LEN=1;MEANALT=1;MQM=32.5;MQMR=41.7045;NS=62;NUMALT=1;ODDS=5.116;PAIRED=0.333333;PAIREDR=0.769163;RO=10280;RPP=4.45795;RPPR=22031.4;RUN=1;SAP=3.0103;SRP=127.6;TYPE=snp;XAI=0;XAM=0.0188826;XAS=0.0188826;XRI=0.000124714;XRM=0.00114359;XRS=0.00101888;technology.ILLUMINA=1;EFF=SYNONYMOUS_CODING(LOW|SILENT|ggT/ggC|G91|716|Vch1786_I0103||CODING|Vch1786_I0103|1|1)
     SNPEff record:
         EFF=NON_SYNONYMOUS_CODING(MODERATE|MISSENSE|aCc/aTc|T34I|197|Vch1786_I0077||CODING|Vch1786_I0077|1|1)
+    Newer SnpEff versions write ANN instead of EFF:
+        ANN=T|missense_variant|MODERATE|Vch1786_I0077|Vch1786_I0077|transcript|Vch1786_I0077|protein_coding|1/1|c.101C>T|p.Thr34Ile|101/594|101/594|34/197||
+    Only the requested key is located in the INFO string and only the first
+    effect of it is parsed. ANN has no codon change, so ANN records only
+    contribute to the data table.
     """
     logger = args.logger
-    info_list = data.split(";")
-    snpeff_output = []
-    table_output = []
-    empty_snpeff_info_list = [''] * 13
-    alt_allele = ""
-    #output for the sample table file
-    #Effect (Effect_Impact | Functional_Class | Codon_Change | Amino_Acid_change| Amino_Acid_length | Gene_Name | Gene_BioType | Coding | Transcript | Exon)
-    for info_item in info_list:
-        if info_item.startswith("EFF"):
-            if args.debug:
-                logger.debug("EFF record:")
-                print(info_item)
-            effect = info_item.split("=")[1].split("(")[0]
-            effect_data_src = info_item.split("(")[1][:-1]
-            effect_data_list = effect_data_src.split("|")
-            allele_change_str_src = effect_data_list[2]
-            [ ref_codon, alt_codon ] = allele_change_str_src.split("/")
-            ref_codon.strip()
-            alt_codon.strip()
-            # table output
-            # Effect_Impact | Functional_Class | Codon_Change | Amino_Acid_change| Amino_Acid_length | Gene_Name | Gene_BioType | Coding | Transcript | Exon | SampleOne | SampleTwo
-            table_output.append(effect)
-            table_output.extend(effect_data_list[:10])
-            if effect_data_list[10] == '1':
-                table_output.extend(['yes','no'])
-            elif effect_data_list[10] == '2':
-                table_output.extend(['no','yes'])
-            if args.verbose:
-                logger.debug("Table data")
-                print table_output
-            break
-    else:
-        [ ref_codon, alt_codon ] = ['', '']
-        table_output=empty_snpeff_info_list
+    ref_codon, alt_codon, table_output = parse_effect(data, alt)
     if args.debug:
-        log.debug( "EFF Parser output: '{0}' - '{1}' - '{2}'".format(ref_codon, alt_codon, table_output))
+        logger.debug("EFF Parser output: '{0}' - '{1}' - '{2}'".format(ref_codon, alt_codon, table_output))
     return (ref_codon, alt_codon, table_output)
 
 
-def parse_input(args, header, fh):
+def parse_effect(info, alt=''):
+    """Codons and data table fields of the EFF or, failing that, the ANN annotation in an INFO string"""
+    ref_codon = alt_codon = ''
+    eff = get_info_value(info, 'EFF')
+    if eff is not None:
+        ref_codon, alt_codon, table_output = parse_eff_value(eff)
+    else:
+        ann = get_info_value(info, 'ANN')
+        if ann is not None:
+            table_output = parse_ann_value(ann, alt)
+        else:
+            table_output = [''] * 13
+    return ref_codon, alt_codon, table_output
+
+
+def get_info_value(info, key):
+    """Value of a key in a vcf INFO string, found with a single substring search"""
+    if info.startswith(key + '='):
+        start = len(key) + 1
+    else:
+        start = info.find(';' + key + '=')
+        if start == -1:
+            return None
+        start += len(key) + 2
+    end = info.find(';', start)
+    if end == -1:
+        end = len(info)
+    return info[start:end]
+
+
+def parse_eff_value(eff):
     """
-    Example header:
+    Codons and data table fields of the first effect in an EFF value
+    Effect ( Effect_Impact | Functional_Class | Codon_Change | Amino_Acid_change| Amino_Acid_length | Gene_Name | Gene_BioType | Coding | Transcript | Exon | GenotypeNum [ | ERRORS | WARNINGS ] )
+    """
+    effect, _, effect_data_src = eff.partition(',')[0].partition('(')
+    if effect_data_src.endswith(')'):
+        effect_data_src = effect_data_src[:-1]
+    effect_data_list = effect_data_src.split('|')
+    effect_data_list.extend([''] * (11 - len(effect_data_list)))
+    ref_codon, _, alt_codon = effect_data_list[2].partition('/')
+    table_output = [effect]
+    table_output.extend(effect_data_list[:10])
+    if effect_data_list[10] == '1':
+        table_output.extend(['yes', 'no'])
+    elif effect_data_list[10] == '2':
+        table_output.extend(['no', 'yes'])
+    return ref_codon.strip(), alt_codon.strip(), table_output
 
-    #CHROM  POS     ID      REF     ALT     QUAL    FILTER  INFO    FORMAT
-    WCH0162_SM      SJN1 1_SM       SJN15_SM        SJN12_SM        SJN01_SM
-    SJN13_SM        WCH0155_SM      SJN02_SM        WCH0172_SM      SJN0 3_SM
-    WCH0170_SM      SJN04_SM        WCH0149_SM      SJN05_SM        WCH0164_SM
-    SJN06_SM        WCH0182_SM       SJN08_SM       SJN07_SM        WCH0151_SM
-    WCH0150_SM      WCH0127_SM      SJN16_SM        SJN14_SM        SJN10_S M
-    SJN09_SM        SJN17_SM
 
-    Example INFO with the SnpEff extensions:
-        INFO=<ID=EFF,Number=.,Type=String,Description="Predicted effects for this variant.Format: 'Effect ( Effect_Impact | Functional_Class | Codon_Change | Amino_Acid_change| Amino_Acid_length | Gene_Name | Gene_BioType | Coding | Transcript | Exon  | GenotypeNum [ | ERRORS | WARNINGS ] )' ">
+ANN_FUNCTIONAL_CLASS = {'missense_variant': 'MISSENSE', 'synonymous_variant': 'SILENT', 'stop_gained': 'NONSENSE'}
+
+
+def parse_ann_value(ann, alt):
+    """
+    Data table fields of the first annotation in an ANN value, in the EFF
+    column order
+    Allele | Annotation | Annotation_Impact | Gene_Name | Gene_ID | Feature_Type | Feature_ID | Transcript_BioType | Rank | HGVS.c | HGVS.p | cDNA.pos / cDNA.length | CDS.pos / CDS.length | AA.pos / AA.length | Distance | ERRORS / WARNINGS / INFO
+    """
+    fields = ann.partition(',')[0].split('|')
+    fields.extend([''] * (16 - len(fields)))
+    effect = fields[1]
+    if fields[7] == 'protein_coding':
+        coding = 'CODING'
+    elif fields[7]:
+        coding = 'NON_CODING'
+    else:
+        coding = ''
+    table_output = [effect, fields[2], ANN_FUNCTIONAL_CLASS.get(effect.split('&')[0], ''),
+        fields[9], fields[10], fields[13].partition('/')[2], fields[3], fields[7],
+        coding, fields[6], fields[8].partition('/')[0]]
+    alt_alleles = alt.split(',')
+    if fields[0] in alt_alleles:
+        if alt_alleles.index(fields[0]) == 0:
+            table_output.extend(['yes', 'no'])
+        else:
+            table_output.extend(['no', 'yes'])
+    return table_output
+
+
+def is_stop_gained(effect):
+    """True for the EFF 'STOP_GAINED' and the ANN 'stop_gained' effects"""
+    return effect.split('&')[0].upper() == 'STOP_GAINED'
+
+
+def read_sample_file(filename):
+    """Sample names from a file with one name per line. Blank lines and # comments are skipped."""
+    names = []
+    with open(filename) as fh:
+        for line in fh:
+            name = line.strip()
+            if name and not name.startswith('#'):
+                names.append(name)
+    return names
+
+
+def select_columns(args, header):
+    """
+    Indices of the samples chosen with --samples and --exclude-samples among
+    the sample columns, in the vcf order, or None to keep every sample.
     """
-#    example = """gi|87125858|gb| CP000255.1|	2863880	.	A	G	2960.84	.	AB=0;ABP=0;AC=6;AF=0.222222;AN=27;AO=102 ;CIGAR=1X;DP=7273;DPRA=0.509969;EPP=215.9;EPPR=4.53721;HWE=-0;LEN=1;MEANALT= 1;MQM=13.8725;MQMR=54.9476;NS=27;NUMALT=1;ODDS=74.4167;PAIRED=0.990196;PAIRE DR=0.992468;RO=7169;RPP=215.9;RPPR=15070.6;RUN=1;SAP=224.5;SRP=3.11965;TYPE= snp;XAI=0.00886278;XAM=0.00929294;XAS=0.000430161;XRI=1.23666e-05;XRM=0.0008 01506;XRS=0.000789139;technology.ILLUMINA=1;BVAR	GT:GQ:DP:RO:QR:AO:QA:GL	0:5 0000:414:414:15906:0:0:0,-1431.92	0:50000:334:334:12912:0:0:0,-1162.47	1:500 00:29:0:0:29:1056:-95.4041,0	0:50000:269:269:10281:0:0:0,-925.672	1:50000:14 :0:0:14:519:-47.0807,0	0:50000:441:441:16891:0:0:0,-1520.57	0:50000:311:311: 11916:0:0:0,-1072.82	1:50000:15:1:40:14:493:-44.7221,-4	0:50000:334:333:1278 3:1:24:-2.4,-1150.85	1:50000:14:0:0:14:521:-47.2621,0	0:50000:345:345:13321: 0:0:0,-1199.28	0:50000:181:181:6920:0:0:0,-623.182	0:50000:336:336:12882:0:0 :0,-1159.76	0:50000:423:423:16229:0:0:0,-1460.99	0:50000:283:283:10902:0:0:0 ,-981.565	1:50000:16:2:65:14:529:-47.9879,-6.175	0:50000:514:514:19905:0:0:0 ,-1791.84	0:50000:377:374:14472:3:118:-11.0133,-1302.87	0:50000:368:367:1410 1:1:39:-3.9,-1269.47	0:50000:267:267:10237:0:0:0,-921.713	0:50000:226:226:87 00:0:0:0,-783.385	1:50000:10:0:0:10:362:-32.942,0	0:50000:377:376:14405:1:9: -0.9,-1296.83	0:50000:334:333:12842:1:41:-4.1,-1156.17	0:50000:262:262:10073 :0:0:0,-906.954	0:50000:495:493:19004:0:0:-3.895,-1714.43	0:50000:284:284:10 969:0:0:0,-987.596"""
     logger = args.logger
-    all_data = []
-    all_data_table = []
-    no_eff_data_sample_names = []
-    output_header = list(operator.itemgetter(0,1,3,4,5)(header))
-    output_header.extend(['EFF_REF', 'EFF_ALT'])
-#    samples = operator.itemgetter(slice(9,None))(header)
+    if not args.samples and not args.exclude_samples:
+        return None
     samples = header[9:]
-    if args.verbose:
-        logger.info("Number of samples in the header: {0}".format(len(samples)))
-    output_header.extend(samples)
-    if args.debug:
-        logger.debug("Output header: {}".format(", ".join(output_header)))
-    if args.table:
-        data_table_header = [ 'Chrom', 'Position', 'Effect', 'Effect_Impact',
-            'Functional_Class', 'Codon_Change', 'Amino_Acid_change',
-            'Amino_Acid_length', 'Gene_Name', 'Gene_BioType', 'Coding',
-            'Transcript', 'Exon', 'SampleOne (yes/no)', 'SampleTwo (yes/no)']
-        all_data_table.append(data_table_header)
-        if args.debug:
-            logger.info("Output table header:")
-            logger.info(", ".join(data_table_header))
+    if args.samples:
+        wanted = set(read_sample_file(args.samples))
+        missing = wanted.difference(samples)
+        if missing:
+            logger.error("Samples missing from the vcf file: {}".format(", ".join(sorted(missing))))
+            sys.exit("Every sample in the --samples file has to be in the vcf file.")
     else:
-        if args.verbose:
-            logger.info("Not producing the data table")
-    all_data.append(output_header)
-    datum_len = len(output_header)
-    for line in fh:
+        wanted = set(samples)
+    if args.exclude_samples:
+        excluded = set(read_sample_file(args.exclude_samples))
+        if args.verbose and excluded.difference(samples):
+            logger.info("Excluded samples not in the vcf file: {}".format(", ".join(sorted(excluded.difference(samples)))))
+        wanted.difference_update(excluded)
+    columns = [idx for idx, sample in enumerate(samples) if sample in wanted]
+    if not columns:
+        sys.exit("No samples are left after the sample selection.")
+    if args.verbose:
+        logger.info("Extracting {} of {} samples".format(len(columns), len(samples)))
+    return columns
+
+
+def select_samples_header(args, header):
+    """Names of the samples kept by select_columns"""
+    if args.columns is None:
+        return header[9:]
+    return [header[9 + idx] for idx in args.columns]
+
+
+def format_fields(format_str, formats):
+    """Indices of the GT, GQ, DP, RO and AO fields of a FORMAT string, looked up once per distinct FORMAT"""
+    fields = formats.get(format_str)
+    if fields is None:
+        keys = format_str.strip().split(':')
+        fields = formats[format_str] = tuple([keys.index(key) if key in keys else None for key in ('GT', 'GQ', 'DP', 'RO', 'AO')])
+    return fields
+
+
+def mask_calls(args, fields, sample_columns, masked_calls):
+    """
+    GT values of the sample columns with the calls that fail --min-gq,
+    --min-dp or --min-alt-frac replaced by '.'. A '.' GQ or DP fails the
+    cutoff, a FORMAT without the field does not. The ALT fraction of a call
+    is the AO of its allele over RO plus all AO values. masked_calls counts
+    the masked calls per column.
+    """
+    gt_idx, gq_idx, dp_idx, ro_idx, ao_idx = fields
+    if gt_idx is None:
+        return ['.'] * len(sample_columns)
+    calls = []
+    for idx, column in enumerate(sample_columns):
+        values = column.strip().split(':')
+        call = values[gt_idx] if gt_idx < len(values) else '.'
+        if call != '.' and call_fails(args, call, values, fields):
+            call = '.'
+            masked_calls[idx] += 1
+        calls.append(call)
+    return calls
+
+
+def call_fails(args, call, values, fields):
+    gt_idx, gq_idx, dp_idx, ro_idx, ao_idx = fields
+    try:
+        if args.min_gq is not None and gq_idx is not None:
+            if gq_idx >= len(values) or values[gq_idx] == '.' or float(values[gq_idx]) < args.min_gq:
+                return True
+        if args.min_dp is not None and dp_idx is not None:
+            if dp_idx >= len(values) or values[dp_idx] == '.' or int(values[dp_idx]) < args.min_dp:
+                return True
+        if args.min_alt_frac is not None and ro_idx is not None and ao_idx is not None:
+            allele = parse_snp(args, call)
+            if allele > 0:
+                if max(ro_idx, ao_idx) >= len(values):
+                    return True
+                alt_obs = [int(value) for value in values[ao_idx].split(',')]
+                total = int(values[ro_idx]) + sum(alt_obs)
+                if allele > len(alt_obs) or not total or float(alt_obs[allele - 1]) / total < args.min_alt_frac:
+                    return True
+    except ValueError:
+        return True
+    return False
+
+
+def report_masked_calls(args, samples, masked_calls):
+    """Log the masked calls per sample and add them to the run metrics"""
+    logger = args.logger
+    counts = collections.OrderedDict([(sample, masked_calls[idx]) for idx, sample in enumerate(samples)])
+    args.stats.counters['masked_calls'] = sum(counts.values())
+    args.stats.masked_calls = counts
+    if args.verbose:
+        logger.info("Masked {} calls with the GQ/DP/ALT fraction cutoffs".format(sum(counts.values())))
+        for sample, count in counts.items():
+            logger.info("    {}: {}".format(sample, count))
+
+
+def parse_lines(args, lines, all_data, all_data_table, no_eff_data_sample_names, masked_calls=None):
+    """
+    Parse vcf data lines into parse_input records, appending them to the
+    record, data table and "no EFF data" lists. Header lines are skipped.
+    With the --min-gq/--min-dp/--min-alt-frac masks the masked calls are
+    counted per sample column in the masked_calls Counter.
+    """
+    logger = args.logger
+    columns = args.columns
+    formats = {}
+    # Columns after the last selected sample are left unsplit
+    split_limit = 10 + columns[-1] if columns else -1
+    for line in lines:
         stop_gained = False
         if not line.startswith('#'):
             try:
                 all_samples_data = []
                 data_table = []
-                raw_record = line.strip().split('\t')
+                raw_record = line.strip().split('\t', split_limit)
                 common_sample_data = list(operator.itemgetter(0,1,3,4,5)(raw_record))
 #                if args.debug:
 #                    logger.debug("{}".format(", ".join(common_sample_data)))
                 all_samples_data.extend(common_sample_data)
                 data_table.extend(common_sample_data[:2])
-                all_samples_data_raw = raw_record[9:]
+                if columns:
+                    all_samples_data_raw = [raw_record[9 + idx] for idx in columns]
+                else:
+                    all_samples_data_raw = raw_record[9:]
                 info_data_raw_str = raw_record[7]
+                if args.snpeff or args.table:
+                    ref_codon, alt_codon, table_output = parse_snpeff_info(args, info_data_raw_str, raw_record[4])
+                    data_table.extend(table_output)
                 if args.snpeff:
-                    ref_codon, alt_codon, table_output = parse_snpeff_info(args, info_data_raw_str)
                     if not ref_codon and not alt_codon:
                         no_eff_data_sample_names.append("_".join(all_samples_data[:2]))
-                    data_table.extend(table_output)
                     if args.nostop:
-                        if table_output[0] == 'STOP_GAINED':
+                        if is_stop_gained(table_output[0]):
                             stop_gained = True
                     #Replace alt with SNPEFF codon in common data if asked for at index [3]
                     if stop_gained:
@@ -189,80 +857,1238 @@ def parse_input(args, header, fh):
                         all_samples_data.extend([ref_codon, alt_codon])
                 else:
                     all_samples_data.extend(['', ''])
-                for i in all_samples_data_raw:
-                    all_samples_data.append(i.strip().split(':')[0])
+                if args.masking:
+                    all_samples_data.extend(mask_calls(args, format_fields(raw_record[8], formats), all_samples_data_raw, masked_calls))
+                else:
+                    for i in all_samples_data_raw:
+                        all_samples_data.append(i.strip().split(':')[0])
 #                all_samples_data.append(info_data_raw_str)
                 all_data.append(all_samples_data)
                 all_data_table.append(data_table)
             except IOError, IndexError:
                 logger.error("Bad data: {}".format(line))
                 continue
-    fh.close()
+
+
+def parse_input(args, header, fh):
+    """
+    Example header:
+
+    #CHROM  POS     ID      REF     ALT     QUAL    FILTER  INFO    FORMAT
+    WCH0162_SM      SJN1 1_SM       SJN15_SM        SJN12_SM        SJN01_SM
+    SJN13_SM        WCH0155_SM      SJN02_SM        WCH0172_SM      SJN0 3_SM
+    WCH0170_SM      SJN04_SM        WCH0149_SM      SJN05_SM        WCH0164_SM
+    SJN06_SM        WCH0182_SM       SJN08_SM       SJN07_SM        WCH0151_SM
+    WCH0150_SM      WCH0127_SM      SJN16_SM        SJN14_SM        SJN10_S M
+    SJN09_SM        SJN17_SM
+
+    Example INFO with the SnpEff extensions:
+        INFO=<ID=EFF,Number=.,Type=String,Description="Predicted effects for this variant.Format: 'Effect ( Effect_Impact | Functional_Class | Codon_Change | Amino_Acid_change| Amino_Acid_length | Gene_Name | Gene_BioType | Coding | Transcript | Exon  | GenotypeNum [ | ERRORS | WARNINGS ] )' ">
+    """
+#    example = """gi|87125858|gb| CP000255.1|	2863880	.	A	G	2960.84	.	AB=0;ABP=0;AC=6;AF=0.222222;AN=27;AO=102 ;CIGAR=1X;DP=7273;DPRA=0.509969;EPP=215.9;EPPR=4.53721;HWE=-0;LEN=1;MEANALT= 1;MQM=13.8725;MQMR=54.9476;NS=27;NUMALT=1;ODDS=74.4167;PAIRED=0.990196;PAIRE DR=0.992468;RO=7169;RPP=215.9;RPPR=15070.6;RUN=1;SAP=224.5;SRP=3.11965;TYPE= snp;XAI=0.00886278;XAM=0.00929294;XAS=0.000430161;XRI=1.23666e-05;XRM=0.0008 01506;XRS=0.000789139;technology.ILLUMINA=1;BVAR	GT:GQ:DP:RO:QR:AO:QA:GL	0:5 0000:414:414:15906:0:0:0,-1431.92	0:50000:334:334:12912:0:0:0,-1162.47	1:500 00:29:0:0:29:1056:-95.4041,0	0:50000:269:269:10281:0:0:0,-925.672	1:50000:14 :0:0:14:519:-47.0807,0	0:50000:441:441:16891:0:0:0,-1520.57	0:50000:311:311: 11916:0:0:0,-1072.82	1:50000:15:1:40:14:493:-44.7221,-4	0:50000:334:333:1278 3:1:24:-2.4,-1150.85	1:50000:14:0:0:14:521:-47.2621,0	0:50000:345:345:13321: 0:0:0,-1199.28	0:50000:181:181:6920:0:0:0,-623.182	0:50000:336:336:12882:0:0 :0,-1159.76	0:50000:423:423:16229:0:0:0,-1460.99	0:50000:283:283:10902:0:0:0 ,-981.565	1:50000:16:2:65:14:529:-47.9879,-6.175	0:50000:514:514:19905:0:0:0 ,-1791.84	0:50000:377:374:14472:3:118:-11.0133,-1302.87	0:50000:368:367:1410 1:1:39:-3.9,-1269.47	0:50000:267:267:10237:0:0:0,-921.713	0:50000:226:226:87 00:0:0:0,-783.385	1:50000:10:0:0:10:362:-32.942,0	0:50000:377:376:14405:1:9: -0.9,-1296.83	0:50000:334:333:12842:1:41:-4.1,-1156.17	0:50000:262:262:10073 :0:0:0,-906.954	0:50000:495:493:19004:0:0:-3.895,-1714.43	0:50000:284:284:10 969:0:0:0,-987.596"""
+    logger = args.logger
+    all_data = []
+    all_data_table = []
+    no_eff_data_sample_names = []
+    output_header = list(operator.itemgetter(0,1,3,4,5)(header))
+    output_header.extend(['EFF_REF', 'EFF_ALT'])
+#    samples = operator.itemgetter(slice(9,None))(header)
+    args.columns = select_columns(args, header)
+    samples = select_samples_header(args, header)
+    if args.verbose:
+        logger.info("Number of samples in the header: {0}".format(len(samples)))
+    output_header.extend(samples)
+    if args.debug:
+        logger.debug("Output header: {}".format(", ".join(output_header)))
+    if args.table:
+        # The cache keeps the table in memory, otherwise the rows are written as they are parsed
+        if args.cache:
+            all_data_table.append(list(DATA_TABLE_HEADER))
+        else:
+            all_data_table = DataTableWriter(args)
+        if args.debug:
+            logger.info("Output table header:")
+            logger.info(", ".join(DATA_TABLE_HEADER))
+    else:
+        if args.verbose:
+            logger.info("Not producing the data table")
+    all_data.append(output_header)
+    datum_len = len(output_header)
+    args.masked_calls = collections.Counter()
+    if args.workers > 1:
+        fh.close()
+        parse_lines_parallel(args, args.infile, all_data, all_data_table, no_eff_data_sample_names, args.masked_calls)
+    else:
+        parse_lines(args, track_progress(args.stats, fh), all_data, all_data_table, no_eff_data_sample_names, args.masked_calls)
+        fh.close()
+    if args.masking:
+        report_masked_calls(args, samples, args.masked_calls)
     if args.verbose:
         num_all_entries = len(all_data) - 1
         if args.verbose:
             logger.info("Read {} entries from the input file.".format(num_all_entries))
     for item in all_data:
         if len(item) != datum_len:
-            log.error("Wrong record length: {}".format(", ".join(item)))
+            logger.error("Wrong record length: {}".format(", ".join(item)))
     return all_data, all_data_table, no_eff_data_sample_names
 
 
-def write_fasta_file(verbose, filename, data):
-    if verbose:
-        print "Writing fasta data to {0} file".format(filename)
-    try:
-        fh = open(filename, 'w')
-    except:
-        sys.exit("Cannot open fasta alignment file for writing.")
-    reference_list = data["reference"]
-    reference_fa = "".join(reference_list)
-    fh.write('>reference\n')
-    fh.write(reference_fa)
-    fh.write("\n")
-    for specimen in data:
-        if specimen != 'reference':
-            specimen_name = ">" + specimen + "\n"
-            specimen_fa = "".join(data[specimen]) + "\n"
-            fh.write(specimen_name)
-            fh.write(specimen_fa)
-    fh.close()
+def split_input(args, filename):
+    """
+    Split a vcf file into parse tasks for the worker processes. Plain text
+    files are cut into line aligned byte ranges, BGZF files into ranges of
+    compressed blocks.
+    """
+    num_chunks = args.workers * 4
+    if is_bgzf(filename):
+        offsets, file_end = bgzf_block_offsets(filename)
+        step = max(1, -(-len(offsets) // num_chunks))
+        tasks = []
+        for idx in range(0, len(offsets), step):
+            prev_offset = offsets[idx - 1] if idx else None
+            end = offsets[idx + step] if idx + step < len(offsets) else file_end
+            tasks.append(('bgzf', filename, offsets[idx], end, prev_offset))
+        return tasks
+    size = os.path.getsize(filename)
+    boundaries = [0]
+    with open(filename, 'rb') as fh:
+        for idx in range(1, num_chunks):
+            fh.seek(max(size * idx // num_chunks - 1, boundaries[-1]))
+            fh.readline()
+            if fh.tell() > boundaries[-1]:
+                boundaries.append(fh.tell())
+    boundaries.append(size)
+    return [('text', filename, start, end, None) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+
+
+def read_chunk(task):
+    """Read the complete lines that start in a parse task's byte or block range"""
+    kind, filename, start, end, prev_offset = task
+    fh = open(filename, 'rb')
+    try:
+        fh.seek(start)
+        if kind == 'text':
+            data = fh.read(end - start)
+        else:
+            blocks = []
+            while fh.tell() < end:
+                blocks.append(inflate_bgzf_block(read_bgzf_block(fh)[1]))
+            data = ''.join(blocks)
+            # A line that starts in the previous range belongs to it
+            if prev_offset is not None:
+                fh.seek(prev_offset)
+                if not inflate_bgzf_block(read_bgzf_block(fh)[1]).endswith('\n'):
+                    data = data[data.find('\n') + 1:] if '\n' in data else ''
+                fh.seek(end)
+            # Finish the last line from the following blocks
+            tail = []
+            while data and not data.endswith('\n'):
+                block_size, cdata = read_bgzf_block(fh)
+                if not block_size:
+                    break
+                block = inflate_bgzf_block(cdata)
+                newline = block.find('\n')
+                if newline != -1:
+                    tail.append(block[:newline + 1])
+                    break
+                tail.append(block)
+            data += ''.join(tail)
+    finally:
+        fh.close()
+    lines = data.split('\n')
+    if lines and not lines[-1]:
+        lines.pop()
+    return lines
+
+
+def parse_chunk(task):
+    """Worker process entry point: parse one range of the input file"""
+    args = task[0]
+    args.logger = logging.getLogger(__name__)
+    all_data = []
+    all_data_table = []
+    no_eff_data_sample_names = []
+    masked_calls = collections.Counter()
+    lines = read_chunk(task[1:])
+    parse_lines(args, lines, all_data, all_data_table, no_eff_data_sample_names, masked_calls)
+    num_bytes = sum([len(line) + 1 for line in lines])
+    return all_data, all_data_table, no_eff_data_sample_names, masked_calls, num_bytes
+
+
+def parse_lines_parallel(args, filename, all_data, all_data_table, no_eff_data_sample_names, masked_calls):
+    """
+    Parallel version of parse_lines. The input file is split into ranges that
+    are parsed in a pool of worker processes and the per-range results are
+    merged back in file order, so the lists end up the same as from a serial
+    parse_lines run.
+    """
+    logger = args.logger
+    worker_args = argparse.Namespace(**vars(args))
+    del worker_args.logger
+    del worker_args.stats
+    tasks = [(worker_args,) + task for task in split_input(args, filename)]
+    if args.verbose:
+        logger.info("Parsing {} chunks of the input file with {} workers".format(len(tasks), args.workers))
+    pool = multiprocessing.Pool(args.workers)
+    try:
+        for chunk_data, chunk_table, chunk_no_eff, chunk_masked, num_bytes in pool.imap(parse_chunk, tasks):
+            args.stats.advance(len(chunk_data), num_bytes)
+            all_data.extend(chunk_data)
+            all_data_table.extend(chunk_table)
+            no_eff_data_sample_names.extend(chunk_no_eff)
+            masked_calls.update(chunk_masked)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def neighbour_window(records, distance, cluster=None, discard=None):
+    """
+    Streaming distance and cluster filter over records sorted by position
+    within each chromosome. Neighbours are only compared inside a chromosome.
+    A record is discarded by the distance filter if the previous or the next
+    candidate is 'distance' or fewer bases away, and by the cluster filter
+    (K, W) if it is one of K or more consecutive records spanning less than
+    W bases. Records are held only while a later record can still change
+    their fate. Discarded records are passed to discard(record, reasons).
+    """
+    if cluster:
+        size, window = cluster
+    else:
+        size, window = 0, 0
+    pending = collections.deque()
+    chrom = None
+    for record in records:
+        pos = int(record[1])
+        if record[0] != chrom:
+            while pending:
+                entry = pending.popleft()
+                if not entry[2]:
+                    yield entry[0]
+                elif discard:
+                    discard(entry[0], entry[2])
+            chrom = record[0]
+        entry = (record, pos, set())
+        if pending and distance != -1 and pos - pending[-1][1] <= distance:
+            entry[2].add('distance')
+            pending[-1][2].add('distance')
+        while pending and pending[0][1] <= pos - window:
+            released = pending.popleft()
+            if not released[2]:
+                yield released[0]
+            elif discard:
+                discard(released[0], released[2])
+        pending.append(entry)
+        if size and len(pending) >= size:
+            for member in pending:
+                member[2].add('cluster')
+    while pending:
+        entry = pending.popleft()
+        if not entry[2]:
+            yield entry[0]
+        elif discard:
+            discard(entry[0], entry[2])
+
+
+def stream_input(args, header, fh):
+    """
+    Single pass alternative to parse_input -> filter_data -> convert_to_fasta.
+    Header lines are skipped, QUAL and distance filtering is applied on the
+    fly and genotypes are decoded straight into per-sample bytearrays, so the
+    parsed records are never held in memory. Returns the fasta and codon
+    alignment dictionaries in the form expected by the writers together with
+    the data table writer and the list of records without EFF data.
+    """
+    logger = args.logger
+    args.columns = columns = select_columns(args, header)
+    specimen = select_samples_header(args, header)
+    split_limit = 10 + columns[-1] if columns else -1
+    if args.verbose:
+        logger.info("Streaming {0} samples from the input file".format(len(specimen)))
+    seq_data = {}
+    codon_data = {}
+    for sample in specimen:
+        seq_data[sample] = bytearray()
+        if args.snpeff:
+            codon_data[sample] = bytearray()
+    seq_data["reference"] = bytearray()
+    buffers = [seq_data[sample] for sample in specimen]
+    if args.snpeff:
+        codon_data["reference"] = bytearray()
+        codon_buffers = [codon_data[sample] for sample in specimen]
+    all_data_table = DataTableWriter(args) if args.table else []
+    no_eff_data_sample_names = []
+    counts = {'read': 0, 'quality': 0, 'invariant': 0}
+    formats = {}
+    masked_calls = collections.Counter()
+    quality = float(args.quality)
+    discarded = []
+    if args.discarded:
+        discard = lambda record, reasons: discarded.append((record[0], record[1], reasons))
+    else:
+        discard = None
+
+    def records():
+        for line in track_progress(args.stats, fh):
+            if line.startswith('#'):
+                continue
+            raw_record = line.strip().split('\t', split_limit)
+            counts['read'] += 1
+            ref_codon = alt_codon = ''
+            if args.snpeff or args.table:
+                ref_codon, alt_codon, table_output = parse_snpeff_info(args, raw_record[7], raw_record[4])
+                if args.table:
+                    all_data_table.append(raw_record[:2] + table_output)
+            if args.snpeff:
+                if not ref_codon and not alt_codon:
+                    no_eff_data_sample_names.append("_".join(raw_record[:2]))
+                if args.nostop and is_stop_gained(table_output[0]):
+                    ref_codon = alt_codon = ''
+            if args.quality != -1:
+                if not float(raw_record[5].replace(' ', '')) > quality:
+                    if discard:
+                        discard(raw_record, ['quality'])
+                    continue
+            counts['quality'] += 1
+            if args.masking:
+                sample_columns = [raw_record[9 + idx] for idx in columns] if columns else raw_record[9:]
+                genotypes = mask_calls(args, format_fields(raw_record[8], formats), sample_columns, masked_calls)
+            elif columns:
+                genotypes = [raw_record[9 + idx].split(':', 1)[0] for idx in columns]
+            else:
+                genotypes = [column.split(':', 1)[0] for column in raw_record[9:]]
+            if args.drop_invariant and is_invariant(args, genotypes):
+                counts['invariant'] += 1
+                if discard:
+                    discard(raw_record, ['invariant'])
+                continue
+            yield (raw_record[0], raw_record[1], raw_record[3].strip(), raw_record[4].strip(), ref_codon.strip(), alt_codon.strip(), genotypes)
+
+    filtered_records = records()
+    if args.distance != -1 or args.cluster:
+        filtered_records = neighbour_window(filtered_records, args.distance, args.cluster, discard)
+    gt_cache = {}
+    num_written = 0
+    for chrom, pos, ref_seq, alt_seq, ref_codon, alt_codon, genotypes in filtered_records:
+        if len(genotypes) != len(specimen):
+            logger.error("Number of specimen in the header and the sequence data does not match.")
+            logger.error("Specimen - seq: {} - {}".format(len(specimen), len(genotypes)))
+            sys.exit()
+        alleles = [ref_seq] + alt_seq.split(',')
+        seq_data["reference"] += ref_seq
+        has_codons = args.snpeff and (ref_codon or alt_codon)
+        if has_codons:
+            codon_data["reference"] += ref_codon
+        for idx, snp in enumerate(genotypes):
+            genotype = gt_cache.get(snp)
+            if genotype is None:
+                genotype = gt_cache[snp] = parse_snp(args, snp)
+            if genotype == '.':
+                buffers[idx] += '?'
+            else:
+                buffers[idx] += alleles[genotype]
+            if has_codons:
+                if genotype == '.':
+                    codon_buffers[idx] += '???'
+                elif genotype == 0:
+                    codon_buffers[idx] += ref_codon
+                else:
+                    codon_buffers[idx] += alt_codon
+        num_written += 1
+    fh.close()
+    if args.masking:
+        report_masked_calls(args, specimen, masked_calls)
+    args.stats.count_sites(counts['read'], counts['read'] - counts['quality'],
+        counts['quality'] - counts['invariant'] - num_written, counts['invariant'])
+    if args.verbose:
+        logger.info("Read {} entries from the input file.".format(counts['read']))
+        if args.quality != -1:
+            logger.info("After the quality filtering {} entries remain.".format(counts['quality']))
+        if args.drop_invariant:
+            logger.info("After dropping the invariant sites {} entries remain.".format(counts['quality'] - counts['invariant']))
+        if args.distance != -1 or args.cluster:
+            logger.info("After the distance filtering {} entries remain.".format(num_written))
+    if args.discarded:
+        write_discarded(args, discarded)
+    return seq_data, codon_data, all_data_table, no_eff_data_sample_names
+
+
+class VariantRecord(object):
+    """
+    A vcf data line for the iter_variants API. CHROM, POS, REF, ALT and QUAL
+    are split out when the record is created, the INFO field, the SnpEff
+    annotation and the sample columns are only decoded on first access.
+    'samples' is the tuple of sample names the genotypes are reported for;
+    it is shared by all records of a stream.
+    """
+    __slots__ = ('chrom', 'pos', 'ref', 'alt', 'qual', 'samples', '_fields', '_columns', '_info', '_effect', '_gt')
+
+    def __init__(self, line, samples, columns=None):
+        fields = line.rstrip('\r\n').split('\t', 9)
+        if len(fields) < 8:
+            raise ValueError("Bad vcf data line: {}".format(line.rstrip()))
+        self.chrom = fields[0]
+        try:
+            self.pos = int(fields[1])
+            self.qual = None if fields[5] == '.' else float(fields[5].replace(' ', ''))
+        except ValueError:
+            raise ValueError("Bad POS or QUAL in the vcf data line: {}".format(line.rstrip()))
+        self.ref = fields[3].strip()
+        self.alt = fields[4].strip()
+        self.samples = samples
+        self._fields = fields
+        self._columns = columns
+        self._info = self._effect = self._gt = None
+
+    def __repr__(self):
+        return "VariantRecord({}:{} {}>{})".format(self.chrom, self.pos, self.ref, self.alt)
+
+    @property
+    def alleles(self):
+        return [self.ref] + self.alt.split(',')
+
+    @property
+    def info(self):
+        """The INFO field as a dictionary, flags map to True"""
+        if self._info is None:
+            info = {}
+            if self._fields[7] != '.':
+                for item in self._fields[7].split(';'):
+                    key, sep, value = item.partition('=')
+                    info[key] = value if sep else True
+            self._info = info
+        return self._info
+
+    def info_value(self, key):
+        """Value of one INFO key without decoding the whole field"""
+        if self._info is not None:
+            return self._info.get(key)
+        return get_info_value(self._fields[7], key)
+
+    @property
+    def effect(self):
+        """(ref_codon, alt_codon, table_fields) of the EFF or ANN annotation, see parse_effect"""
+        if self._effect is None:
+            self._effect = parse_effect(self._fields[7], self.alt)
+        return self._effect
+
+    def sample_columns(self):
+        """The raw sample columns of the selected samples"""
+        if len(self._fields) < 10:
+            return []
+        columns = self._fields[9].split('\t')
+        if self._columns is not None:
+            columns = [columns[idx] for idx in self._columns]
+        return columns
+
+    def format_values(self, key):
+        """Values of a FORMAT key for the selected samples, None for samples that lack it"""
+        keys = self._fields[8].split(':') if len(self._fields) > 8 else []
+        if key not in keys:
+            return [None] * len(self.samples)
+        field = keys.index(key)
+        values = []
+        for column in self.sample_columns():
+            parts = column.split(':')
+            values.append(parts[field] if field < len(parts) and parts[field] != '.' else None)
+        return values
+
+    @property
+    def gt(self):
+        """The GT strings of the selected samples"""
+        if self._gt is None:
+            self._gt = [column.split(':', 1)[0] for column in self.sample_columns()]
+        return self._gt
+
+    @property
+    def genotypes(self):
+        """decode_gt allele index pairs of the selected samples"""
+        return [decode_gt(snp) for snp in self.gt]
+
+    def bases(self, genotype=1):
+        """
+        Allele of every selected sample, '?' for '.' calls. genotype picks the
+        first or the second allele of diploid calls as with --genotype.
+        Raises ValueError for calls that are not '.' or a valid allele index.
+        """
+        alleles = self.alleles
+        which = 0 if genotype == 1 else 1
+        bases = []
+        for snp in self.gt:
+            allele = decode_gt(snp)[which]
+            if allele == MISSING_GT:
+                bases.append('?')
+            elif 0 <= allele < len(alleles):
+                bases.append(alleles[allele])
+            else:
+                raise ValueError("Genotype '{}' at {}:{} is not '.' or an allele index".format(snp, self.chrom, self.pos))
+        return bases
+
+
+def iter_variants(path, regions=None, samples=None):
+    """
+    Yield a VariantRecord for every data line of a plain, gzip or bgzip
+    compressed vcf file. regions is a list of CHROM[:start-end] strings and
+    needs a tabix index; samples restricts the genotypes to these sample
+    names, see select_samples. Records can be passed through the
+    quality_stage, distance_stage and select_samples generators.
+    Bad input raises ValueError.
+    """
+    fh = open_input(path)
+    try:
+        sample_names = None
+        for line in fh:
+            if line.startswith('#CHROM'):
+                sample_names = tuple(line.rstrip('\r\n').split('\t')[9:])
+                break
+            if not line.startswith('##'):
+                break
+        if sample_names is None:
+            raise ValueError("Could not find the #CHROM header in {}. Is this a VCF file?".format(path))
+        if regions:
+            if not os.access(path + '.tbi', os.R_OK):
+                raise ValueError("Region queries require a tabix index: {}.tbi".format(path))
+            fh.close()
+            lines = fetch_regions(argparse.Namespace(logger=logging.getLogger(__name__), verbose=False), path, regions)
+        else:
+            lines = fh
+        records = (VariantRecord(line, sample_names) for line in lines if not line.startswith('#'))
+        if samples is not None:
+            records = select_samples(records, samples)
+        for record in records:
+            yield record
+    finally:
+        fh.close()
+
+
+def select_samples(records, names):
+    """Restrict the genotypes of the records to the named samples, in the given order"""
+    names = tuple(names)
+    mapping = None
+    for record in records:
+        if mapping is None or mapping[0] is not record.samples:
+            columns = record._columns if record._columns is not None else range(len(record.samples))
+            missing = [name for name in names if name not in record.samples]
+            if missing:
+                raise ValueError("Samples not in the vcf file: {}".format(", ".join(missing)))
+            positions = dict((name, idx) for idx, name in enumerate(record.samples))
+            mapping = (record.samples, [columns[positions[name]] for name in names])
+        record.samples = names
+        record._columns = mapping[1]
+        record._gt = None
+        yield record
+
+
+def quality_stage(records, quality):
+    """Keep the records with a QUAL above the cutoff, as the -q filter"""
+    for record in records:
+        if record.qual is not None and record.qual > quality:
+            yield record
+
+
+def distance_stage(records, distance=-1, cluster=None, discard=None):
+    """
+    The -d distance and --cluster K W filters on a record stream, see
+    neighbour_window. discard(record, reasons) is called for the dropped
+    records.
+    """
+    loci = ((record.chrom, record.pos, record) for record in records)
+    if discard:
+        dropped = lambda locus, reasons: discard(locus[2], reasons)
+    else:
+        dropped = None
+    for locus in neighbour_window(loci, distance, cluster, dropped):
+        yield locus[2]
+
+
+def write_sequence(fh, sequence):
+    """Write a sequence held either as a list of bases or as a bytearray"""
+    if isinstance(sequence, bytearray):
+        fh.write(sequence)
+    else:
+        fh.write("".join(sequence))
+    fh.write("\n")
+
+
+def write_fasta_file(verbose, filename, data):
+    if verbose:
+        print "Writing fasta data to {0} file".format(filename)
+    try:
+        fh = open(filename, 'w')
+    except:
+        sys.exit("Cannot open fasta alignment file for writing.")
+    fh.write('>reference\n')
+    write_sequence(fh, data["reference"])
+    for specimen in data:
+        if specimen != 'reference':
+            specimen_name = ">" + specimen + "\n"
+            fh.write(specimen_name)
+            write_sequence(fh, data[specimen])
+    fh.close()
+
+
+def write_codon_alignment_output(verbose, filename, data):
+    if verbose:
+        print "Writing the fasta formatted codon alignment file to '%s' file\n" % filename
+    try:
+        fh = open(filename, 'w')
+    except:
+        sys.exit("Cannot open codon alignment file for writing.")
+    fh.write('>reference\n')
+    write_sequence(fh, data["reference"])
+    for specimen in data:
+        if specimen != 'reference':
+            specimen_name = ">" + specimen + "\n"
+            fh.write(specimen_name)
+            write_sequence(fh, data[specimen])
+    fh.close()
+
+
+def index_reference(ref_map):
+    """Name, first and end byte offset of every sequence in a memory-mapped fasta file"""
+    contigs = []
+    start = ref_map.find('>')
+    while start != -1:
+        line_end = ref_map.find('\n', start)
+        if line_end == -1:
+            break
+        name = ref_map[start + 1:line_end].split()[0]
+        next_start = ref_map.find('\n>', line_end)
+        end = next_start + 1 if next_start != -1 else len(ref_map)
+        contigs.append((name, line_end + 1, end))
+        start = next_start + 1 if next_start != -1 else -1
+    return contigs
+
+
+def write_full_genome(args, samples, sites, selected):
+    """
+    Write the --reference sequences, concatenated in file order, as the
+    'reference' record and a copy with the alleles of every sample applied
+    as the sample records. The output file is sized up front and memory
+    mapped: every sample record starts as a copy of the reference record and
+    the offsets of the ALT and '.' calls are patched, one sample at a time.
+    '.' calls and alleles that change the length of the REF allele become
+    --missing-char.
+    sites are the (CHROM, POS, REF, ALT) of the rows of the sites x samples
+    allele matrix selected.
+    """
+    logger = args.logger
+    try:
+        ref_fh = open(args.reference, 'rb')
+        ref_map = mmap.mmap(ref_fh.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, ValueError, mmap.error):
+        sys.exit("Could not memory map the reference fasta file {}".format(args.reference))
+    contigs = index_reference(ref_map)
+    if not contigs:
+        sys.exit("No sequences found in the reference fasta file {}".format(args.reference))
+    ref_bytes = np.frombuffer(ref_map, dtype=np.uint8)
+    contig_offsets = {}
+    contig_bases = []
+    genome_length = 0
+    for name, start, end in contigs:
+        region = ref_bytes[start:end]
+        bases = region[(region != ord('\n')) & (region != ord('\r'))]
+        contig_offsets[name] = genome_length
+        contig_bases.append(bases)
+        genome_length += len(bases)
+    if args.verbose:
+        logger.info("Writing {} full genome sequences of {} bases to {}".format(len(samples) + 1, genome_length, args.outfile))
+    headers = [">" + name + "\n" for name in ['reference'] + list(samples)]
+    size = sum([len(header) for header in headers]) + len(headers) * (genome_length + 1)
+    try:
+        out_fh = open(args.outfile, 'w+b')
+        out_fh.truncate(size)
+        out_map = mmap.mmap(out_fh.fileno(), size)
+    except (IOError, mmap.error):
+        sys.exit("Cannot open the full genome fasta file for writing.")
+    out = np.frombuffer(out_map, dtype=np.uint8)
+    out_map[0:len(headers[0])] = headers[0]
+    ref_start = len(headers[0])
+    position = ref_start
+    for bases in contig_bases:
+        out[position:position + len(bases)] = bases
+        position += len(bases)
+    out[position] = ord('\n')
+    del contig_bases, ref_bytes
+    # Genome offsets of the sites, single base sites are patched vectorized
+    snv_rows = []
+    snv_offsets = []
+    snv_alleles = []
+    other_sites = []
+    for row, (chrom, pos, ref, alt) in enumerate(sites):
+        if chrom not in contig_offsets:
+            sys.exit("Sequence '{}' of the vcf file is not in the reference fasta file.".format(chrom))
+        offset = contig_offsets[chrom] + int(pos) - 1
+        genome_ref = out_map[ref_start + offset:ref_start + offset + len(ref)]
+        if genome_ref.upper() != ref.upper():
+            sys.exit("The REF allele {} at {}:{} does not match the reference fasta file ({}).".format(ref, chrom, pos, genome_ref))
+        alleles = [ref] + alt.split(',')
+        if max([len(allele) for allele in alleles]) == 1:
+            snv_rows.append(row)
+            snv_offsets.append(offset)
+            snv_alleles.append(alleles)
+        else:
+            other_sites.append((row, offset, alleles))
+    max_alleles = max([len(alleles) for alleles in snv_alleles] or [1])
+    snv_codes = np.zeros((len(snv_rows), max_alleles + 1), dtype=np.uint8)
+    snv_counts = np.array([len(alleles) for alleles in snv_alleles], dtype=np.int16)
+    for idx, alleles in enumerate(snv_alleles):
+        snv_codes[idx, :len(alleles)] = [ord(allele) for allele in alleles]
+    # The last column holds the missing character for the '.' calls
+    snv_codes[:, max_alleles] = ord(args.missing_char)
+    snv_rows = np.array(snv_rows, dtype=np.int64)
+    snv_offsets = np.array(snv_offsets, dtype=np.int64)
+    snv_index = np.arange(len(snv_rows))
+    position = ref_start + genome_length + 1
+    for column, header in enumerate(headers[1:]):
+        out_map[position:position + len(header)] = header
+        seq_start = position + len(header)
+        out[seq_start:seq_start + genome_length] = out[ref_start:ref_start + genome_length]
+        calls = selected[snv_rows, column]
+        if (calls >= snv_counts).any():
+            site = snv_rows[np.argmax(calls >= snv_counts)]
+            sys.exit("Genotype of {} at {}:{} is not an allele of the site.".format(header[1:].strip(), sites[site][0], sites[site][1]))
+        changed = calls != 0
+        out[seq_start + snv_offsets[changed]] = snv_codes[snv_index[changed], np.where(calls < 0, max_alleles, calls)[changed]]
+        for row, offset, alleles in other_sites:
+            call = selected[row, column]
+            if call == 0:
+                continue
+            if call < 0 or call >= len(alleles) or len(alleles[call]) != len(alleles[0]):
+                allele = args.missing_char * len(alleles[0])
+            else:
+                allele = alleles[call]
+            out_map[seq_start + offset:seq_start + offset + len(allele)] = allele
+        out[seq_start + genome_length] = ord('\n')
+        position = seq_start + genome_length + 1
+    del out
+    out_map.close()
+    out_fh.close()
+    ref_map.close()
+    ref_fh.close()
+
+
+def sequence_string(sequence):
+    if isinstance(sequence, bytearray):
+        return str(sequence)
+    return "".join(sequence)
+
+
+def read_fasta_file(filename):
+    """Sample names in file order and a name to sequence dictionary of a fasta file"""
+    names = []
+    sequences = {}
+    name = None
+    with open(filename) as fh:
+        for line in fh:
+            line = line.strip()
+            if line.startswith('>'):
+                name = line[1:]
+                names.append(name)
+                sequences[name] = []
+            elif name is not None:
+                sequences[name].append(line)
+    for name in names:
+        sequences[name] = "".join(sequences[name])
+    return names, sequences
+
+
+def write_alignment_state(filename, sites):
+    """Write the CHROM, POS and REF of the alignment columns"""
+    try:
+        fh = open(filename, 'w')
+    except IOError:
+        sys.exit("Could not open the alignment state file for writing.")
+    fh.write("#CHROM\tPOS\tREF\n")
+    for chrom, pos, ref in sites:
+        fh.write("{}\t{}\t{}\n".format(chrom, pos, ref))
+    fh.close()
+
+
+def read_alignment_state(filename):
+    sites = []
+    try:
+        with open(filename) as fh:
+            for line in fh:
+                if not line.startswith('#'):
+                    chrom, pos, ref = line.rstrip('\n').split('\t')
+                    sites.append((chrom, int(pos), ref))
+    except (IOError, ValueError):
+        sys.exit("Could not read the alignment state file {}".format(filename))
+    return sites
+
+
+def column_offsets(sites):
+    """Character offset of every alignment column, each column is as wide as its REF allele"""
+    offsets = [0]
+    for chrom, pos, ref in sites:
+        offsets.append(offsets[-1] + len(ref))
+    return offsets
+
+
+def merge_plan(sites, union_sites, fill):
+    """
+    Recipe to lay a sequence over the 'sites' columns out on the union
+    columns: (start, end) slices of the sequence for the columns it has and
+    fill(site) strings for the others, with neighbouring pieces joined.
+    """
+    offsets = column_offsets(sites)
+    column = dict([(site[:2], idx) for idx, site in enumerate(sites)])
+    plan = []
+    for site in union_sites:
+        idx = column.get(site[:2])
+        if idx is None:
+            piece = fill(site)
+            if plan and isinstance(plan[-1], str):
+                plan[-1] += piece
+            else:
+                plan.append(piece)
+        elif plan and isinstance(plan[-1], tuple) and plan[-1][1] == offsets[idx]:
+            plan[-1] = (plan[-1][0], offsets[idx + 1])
+        else:
+            plan.append((offsets[idx], offsets[idx + 1]))
+    return plan
+
+
+def apply_plan(plan, sequence):
+    return "".join([sequence[piece[0]:piece[1]] if isinstance(piece, tuple) else piece for piece in plan])
+
+
+def append_alignment(args, fasta_data, new_sites):
+    """
+    --append mode: merge the samples of fasta_data into the existing fasta
+    output and its --state file on the union of the sites. Sites one side
+    lacks are back-filled with '?' or the reference allele. Samples already
+    in the alignment are replaced. Without new sites the existing records
+    stay as they are and only the new samples are appended to the file.
+    """
+    logger = args.logger
+    if not os.path.exists(args.outfile) or not os.path.exists(args.state):
+        if args.verbose:
+            logger.info("No existing alignment in {}, writing a new one".format(args.outfile))
+        write_fasta_file(args.verbose, args.outfile, fasta_data)
+        write_alignment_state(args.state, new_sites)
+        return
+    old_sites = read_alignment_state(args.state)
+    old_names, old_sequences = read_fasta_file(args.outfile)
+    width = column_offsets(old_sites)[-1]
+    for name in old_names:
+        if len(old_sequences[name]) != width:
+            sys.exit("The sequence of {} in {} does not match the --state file columns.".format(name, args.outfile))
+    new_sequences = dict([(name, sequence_string(sequence)) for name, sequence in fasta_data.items()])
+    width = column_offsets(new_sites)[-1]
+    for name, sequence in new_sequences.items():
+        if len(sequence) != width:
+            sys.exit("Incremental mode needs alleles of the REF length, the sequence of {} has indel columns.".format(name))
+    for sites in (old_sites, new_sites):
+        if len(set([site[:2] for site in sites])) != len(sites):
+            sys.exit("Incremental mode needs a single record per CHROM and POS.")
+    old_refs = dict([(site[:2], site[2]) for site in old_sites])
+    for site in new_sites:
+        if site[:2] in old_refs and old_refs[site[:2]] != site[2]:
+            sys.exit("The REF allele at {}:{} differs from the existing alignment.".format(*site[:2]))
+    # Union of the sites, chromosomes in order of appearance and positions sorted within them
+    chrom_order = {}
+    for site in old_sites + new_sites:
+        chrom_order.setdefault(site[0], len(chrom_order))
+    union_sites = sorted(set(old_sites + new_sites), key=lambda site: (chrom_order[site[0]], site[1]))
+    if args.backfill == 'reference':
+        fill = lambda site: site[2]
+    else:
+        fill = lambda site: '?' * len(site[2])
+    new_samples = [name for name in new_sequences if name != 'reference']
+    replaced = [name for name in new_samples if name in old_sequences]
+    if args.verbose:
+        logger.info("Merging {} samples and {} sites into {} samples and {} sites".format(
+            len(new_samples), len(new_sites), len(old_names) - 1, len(old_sites)))
+        if replaced:
+            logger.info("Replacing the samples {}".format(", ".join(replaced)))
+    new_plan = merge_plan(new_sites, union_sites, fill)
+    if len(union_sites) == len(old_sites) and not replaced:
+        # No new columns: the existing records stay and the new samples are appended
+        fh = open(args.outfile, 'a')
+        for name in new_samples:
+            fh.write(">" + name + "\n")
+            fh.write(apply_plan(new_plan, new_sequences[name]) + "\n")
+        fh.close()
+    else:
+        old_plan = merge_plan(old_sites, union_sites, fill)
+        merged = collections.OrderedDict()
+        merged['reference'] = "".join([site[2] for site in union_sites])
+        for name in old_names:
+            if name != 'reference' and name not in new_sequences:
+                merged[name] = apply_plan(old_plan, old_sequences[name])
+        for name in new_samples:
+            merged[name] = apply_plan(new_plan, new_sequences[name])
+        tmp_file = args.outfile + '.tmp'
+        write_fasta_file(args.verbose, tmp_file, merged)
+        os.rename(tmp_file, args.outfile)
+    write_alignment_state(args.state, union_sites)
+
+
+def write_alignment(args, fasta_data, sites):
+    """Write the fasta output with its --state file, or merge into the existing alignment with --append"""
+    if args.append:
+        append_alignment(args, fasta_data, sites)
+    else:
+        write_fasta_file(args.verbose, args.outfile, fasta_data)
+        write_alignment_state(args.state, sites)
+
+
+# Start tags of the sections replaced in BEAST xml templates and the taxon entries of <taxa>
+BEAST_SECTION = re.compile(r'^(\s*)<(taxa|alignment)\s[^>]*\bid="[^"]*"[^>]*>')
+BEAST_TAXON = re.compile(r'<taxon\s+id="([^"]*)"[^>]*?(/?)>')
+BEAST_DATE_SUFFIX = re.compile(r'_\d+(\.\d+)?$')
+
+
+def read_beast_taxa(filename):
+    """
+    Taxa of a --beast-taxa file as (taxon id, sample name, date, attributes)
+    tuples in file order. The sample defaults to the taxon id, every column
+    besides taxon, sample and date is a taxon attribute.
+    """
+    with open(filename) as fh:
+        rows = [line.rstrip('\r\n').split('\t') for line in fh if line.strip()]
+    if not rows or 'taxon' not in rows[0]:
+        sys.exit("The BEAST taxa file {} needs a header with a taxon column.".format(filename))
+    header = rows[0]
+    taxa = []
+    for row in rows[1:]:
+        row.extend([''] * (len(header) - len(row)))
+        fields = dict(zip(header, row))
+        attributes = [(name, value) for name, value in zip(header, row) if name not in ('taxon', 'sample', 'date')]
+        taxa.append((fields['taxon'], fields.get('sample') or fields['taxon'], fields.get('date', ''), attributes))
+    return taxa
+
+
+def beast_taxon_lines(indent, taxon, date, attributes):
+    """A <taxon> entry in the BEAUti layout"""
+    lines = ['{0}<taxon id="{1}">\n'.format(indent, taxon)]
+    if date:
+        lines.append('{0}\t<date value="{1}" direction="forwards" units="years"/>\n'.format(indent, date))
+    for name, value in attributes:
+        lines.append('{0}\t<attr name="{1}">\n{0}\t\t{2}\n{0}\t</attr>\n'.format(indent, name, value))
+    lines.append('{0}</taxon>\n'.format(indent))
+    return lines
+
+
+def select_beast_taxa(template_taxa, taxa, alignment):
+    """
+    Taxon ids, sequence names and <taxon> lines of the taxa to write. Without
+    a --beast-taxa file these are the template taxa that have a sequence,
+    named like the taxon id with or without its BEAUti _date suffix.
+    """
+    selected = []
+    if taxa is not None:
+        for taxon, sample, date, attributes in taxa:
+            if sample not in alignment:
+                raise ValueError("No sequence for the taxon {} ({})".format(taxon, sample))
+            selected.append((taxon, sample, date, attributes))
+        return selected
+    for taxon, lines in template_taxa.items():
+        for sample in (taxon, BEAST_DATE_SUFFIX.sub('', taxon)):
+            if sample in alignment:
+                selected.append((taxon, sample, None, lines))
+                break
+    return selected
+
+
+def update_count_comment(line, ntax, nchar=None):
+    """Update the ntax/nchar counts of a BEAUti comment keeping its width"""
+    new_line = re.sub(r'ntax=\d+', 'ntax={}'.format(ntax), line)
+    if nchar is not None:
+        new_line = re.sub(r'nchar=\d+', 'nchar={}'.format(nchar), new_line)
+    diff = len(new_line) - len(line)
+    if diff:
+        new_line = re.sub(r'( +)-->', lambda match: ' ' * max(1, len(match.group(1)) - diff) + '-->', new_line, 1)
+    return new_line
+
+
+beast_data = None
+
+
+def init_beast_worker(data):
+    global beast_data
+    beast_data = data
+
+
+def write_beast_xml(task):
+    """
+    Copy a BEAST xml template line by line, replacing its first <taxa> and
+    <alignment> elements with the taxa and sequences of the alignment in
+    beast_data. The template taxon entries are collected while <taxa> is
+    skipped, so only that section is held in memory. The ntax/nchar comments
+    before the sections are updated. Returns the output file name and the
+    taxon and character counts.
+    """
+    template, outfile = task
+    alignment, taxa = beast_data
+    nchar = len(alignment['reference'])
+    tmp_file = outfile + '.tmp'
+    pending = []
+    template_taxa = collections.OrderedDict()
+    taxon_lines = None
+    section = None
+    selected = None
+    done = set()
+    try:
+        with open(template) as fh, open(tmp_file, 'w') as out:
+            for line in fh:
+                if section == 'taxa':
+                    if line.strip() == '</taxa>':
+                        selected = select_beast_taxa(template_taxa, taxa, alignment)
+                        for comment in pending:
+                            out.write(update_count_comment(comment, len(selected)))
+                        out.write(start_line)
+                        for taxon, sample, date, lines in selected:
+                            if date is None:
+                                out.writelines(lines)
+                            else:
+                                out.writelines(beast_taxon_lines(indent + '\t', taxon, date, lines))
+                        out.write(line)
+                        pending = []
+                        section = None
+                        continue
+                    match = BEAST_TAXON.search(line)
+                    if match and taxon_lines is None:
+                        taxon_lines = template_taxa[match.group(1)] = []
+                        if match.group(2):
+                            taxon_lines.append(line)
+                            taxon_lines = None
+                            continue
+                    if taxon_lines is not None:
+                        taxon_lines.append(line)
+                        if line.strip() == '</taxon>':
+                            taxon_lines = None
+                    continue
+                if section == 'alignment':
+                    if line.strip() == '</alignment>':
+                        for taxon, sample, date, lines in selected:
+                            out.write('{0}\t<sequence>\n{0}\t\t<taxon idref="{1}"/>\n{0}\t\t'.format(indent, taxon))
+                            write_sequence(out, alignment[sample])
+                            out.write('{0}\t</sequence>\n'.format(indent))
+                        out.write(line)
+                        section = None
+                    continue
+                stripped = line.strip()
+                if not stripped or stripped.startswith('<!--'):
+                    pending.append(line)
+                    continue
+                match = BEAST_SECTION.match(line)
+                if match and match.group(2) not in done and not stripped.endswith('/>'):
+                    indent, section = match.groups()
+                    done.add(section)
+                    start_line = line
+                    if section == 'alignment':
+                        if selected is None:
+                            raise ValueError("{}: the <alignment> comes before the <taxa> section".format(template))
+                        for comment in pending:
+                            out.write(update_count_comment(comment, len(selected), nchar))
+                        out.write(start_line)
+                        pending = []
+                    continue
+                out.writelines(pending)
+                pending = []
+                out.write(line)
+            out.writelines(pending)
+        if done != set(['taxa', 'alignment']):
+            raise ValueError("{}: no <taxa id=...> and <alignment id=...> sections to replace".format(template))
+    except ValueError:
+        os.remove(tmp_file)
+        raise
+    os.rename(tmp_file, outfile)
+    return outfile, len(selected), nchar
+
+
+def write_beast_xmls(args, alignment):
+    """
+    Write the alignment into every --beast-template. The templates are
+    written in a pool of --workers processes if more than one worker is
+    requested.
+    """
+    logger = args.logger
+    if not os.path.isdir(args.beast_dir):
+        os.makedirs(args.beast_dir)
+    taxa = read_beast_taxa(args.beast_taxa) if args.beast_taxa else None
+    tasks = [(template, os.path.join(args.beast_dir, os.path.basename(template))) for template in args.beast_templates]
+    data = (alignment, taxa)
+    workers = min(args.workers, len(tasks))
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, init_beast_worker, (data,))
+        results = pool.imap(write_beast_xml, tasks)
+    else:
+        pool = None
+        init_beast_worker(data)
+        results = (write_beast_xml(task) for task in tasks)
+    try:
+        for outfile, ntax, nchar in results:
+            if args.verbose:
+                logger.info("Wrote {} taxa x {} sites to the BEAST xml file {}".format(ntax, nchar, outfile))
+    except (ValueError, IOError) as e:
+        sys.exit("Could not write the BEAST xml files: {}".format(e))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        init_beast_worker(None)
+
+
+class DataTableWriter(object):
+    """
+    Writes the -t data table while the input is parsed. parse_lines and
+    stream_input append the rows to it like to a list. csv tables go through
+    the csv module, so EFF fields with commas or quotes are quoted. parquet
+    and arrow tables are written in TABLE_BATCH_ROWS row batches with integer
+    Position and Amino_Acid_length columns; the per gene summary is written
+    next to them by close().
+    """
+    def __init__(self, args):
+        self.logger = args.logger
+        self.verbose = args.verbose
+        self.filename = args.table
+        self.format = args.table_format
+        self.rows = 0
+        self.genes = collections.OrderedDict()
+        try:
+            if self.format == 'csv':
+                self.fh = open(self.filename, 'wb')
+                self.writer = csv.writer(self.fh, lineterminator=os.linesep)
+                self.writer.writerow(DATA_TABLE_HEADER)
+            else:
+                self.batch = []
+                self.fh, self.writer = open_columnar_writer(self.format, self.filename, data_table_schema())
+        except IOError:
+            sys.exit("Could not open the data table file for writing.\n")
 
+    def append(self, row):
+        if self.format == 'csv':
+            self.writer.writerow(row)
+        else:
+            self.count_gene(row)
+            self.batch.append(row)
+            if len(self.batch) >= TABLE_BATCH_ROWS:
+                self.flush()
+        self.rows += 1
 
-def write_codon_alignment_output(verbose, filename, data):
-    if verbose:
-        print "Writing the fasta formatted codon alignment file to '%s' file\n" % filename
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def count_gene(self, row):
+        """Per gene site, impact and functional class counts and the table row range"""
+        if len(row) < 9 or not row[8]:
+            return
+        gene = self.genes.get(row[8])
+        position = int(row[1])
+        if gene is None:
+            gene = self.genes[row[8]] = {'chrom': row[0], 'sites': 0, 'start': position, 'end': position,
+                'first_row': self.rows, 'counts': collections.Counter()}
+        gene['sites'] += 1
+        gene['start'] = min(gene['start'], position)
+        gene['end'] = max(gene['end'], position)
+        gene['last_row'] = self.rows
+        gene['counts'].update([row[3], row[4]])
+
+    def flush(self):
+        if self.batch:
+            self.writer.write_table(data_table_batch(self.batch))
+            self.batch = []
+
+    def close(self):
+        if self.format == 'csv':
+            self.fh.close()
+        else:
+            self.flush()
+            self.writer.close()
+            self.fh.close()
+            write_gene_summary(self.format, gene_summary_name(self.filename), self.genes)
+        if self.verbose:
+            self.logger.info("Wrote {} rows to the data table {}".format(self.rows, self.filename))
+
+
+def data_table_schema():
+    fields = []
+    for name in DATA_TABLE_HEADER:
+        if name in ('Position', 'Amino_Acid_length'):
+            fields.append(pyarrow.field(name, pyarrow.int64()))
+        else:
+            fields.append(pyarrow.field(name, pyarrow.string()))
+    return pyarrow.schema(fields)
+
+
+def table_integer(value):
+    return int(value) if value.isdigit() else None
+
+
+def data_table_batch(rows):
+    """Arrow table of data table rows. Short EFF rows get nulls in the missing columns"""
+    schema = data_table_schema()
+    width = len(DATA_TABLE_HEADER)
+    columns = [[] for _ in range(width)]
+    for row in rows:
+        for idx in range(width):
+            columns[idx].append(row[idx] if idx < len(row) else None)
+    for name in ('Position', 'Amino_Acid_length'):
+        idx = DATA_TABLE_HEADER.index(name)
+        columns[idx] = [table_integer(value) if value else None for value in columns[idx]]
+    arrays = [pyarrow.array(column, type=field.type) for column, field in zip(columns, schema)]
+    return pyarrow.Table.from_arrays(arrays, schema=schema)
+
+
+def open_columnar_writer(table_format, filename, schema):
+    """Open a parquet or arrow IPC file. The writer does not close the file, so both are returned"""
+    fh = pyarrow.OSFile(filename, 'wb')
+    if table_format == 'parquet':
+        return fh, pyarrow.parquet.ParquetWriter(fh, schema)
+    return fh, pyarrow.RecordBatchFileWriter(fh, schema)
+
+
+def gene_summary_name(filename):
+    base, ext = os.path.splitext(filename)
+    return base + '.genes' + ext
+
+
+GENE_SUMMARY_COUNTS = [('High', 'HIGH'), ('Moderate', 'MODERATE'), ('Low', 'LOW'), ('Modifier', 'MODIFIER'),
+    ('Missense', 'MISSENSE'), ('Silent', 'SILENT'), ('Nonsense', 'NONSENSE')]
+
+
+def write_gene_summary(table_format, filename, genes):
+    """
+    Write one row per gene with its chromosome, site count, first and last
+    position, effect impact and functional class counts and the range of its
+    rows in the data table, so per gene queries can read just those rows.
+    """
+    names = list(genes.keys())
+    columns = [('Gene_Name', pyarrow.string(), names),
+        ('Chrom', pyarrow.string(), [genes[name]['chrom'] for name in names])]
+    for column, key in [('Sites', 'sites'), ('Start', 'start'), ('End', 'end'), ('First_Row', 'first_row'), ('Last_Row', 'last_row')]:
+        columns.append((column, pyarrow.int64(), [genes[name][key] for name in names]))
+    for column, key in GENE_SUMMARY_COUNTS:
+        columns.append((column, pyarrow.int64(), [genes[name]['counts'][key] for name in names]))
+    schema = pyarrow.schema([pyarrow.field(column, column_type) for column, column_type, _ in columns])
+    table = pyarrow.Table.from_arrays([pyarrow.array(values, type=column_type) for _, column_type, values in columns], schema=schema)
     try:
-        fh = open(filename, 'w')
-    except:
-        sys.exit("Cannot open codon alignment file for writing.")
-    reference_list = data["reference"]
-    reference_fa = "".join(reference_list)
-    fh.write('>reference\n')
-    fh.write(reference_fa)
-    fh.write("\n")
-    for specimen in data:
-        if specimen != 'reference':
-            specimen_name = ">" + specimen + "\n"
-            specimen_fa = "".join(data[specimen]) + "\n"
-            fh.write(specimen_name)
-            fh.write(specimen_fa)
-    fh.close()
+        fh, writer = open_columnar_writer(table_format, filename, schema)
+        writer.write_table(table)
+        writer.close()
+        fh.close()
+    except IOError:
+        sys.exit("Could not write the gene summary {}".format(filename))
 
 
 def write_data_table(args, data):
-    # Chromosome | Position | Effect | Codon_Change | Amino_acid_change | Gene_Name | Sample 1 (yes/no) | Sample 2 (yes,no) | ...
-    outfile = args.table
-    try:
-        fh = open(outfile, 'w')
-    except:
-        sys.exit("Could not open the data table file for writing.\n")
-    for line in data:
-        fh.write(",".join(line) + os.linesep)
-    fh.close()
+    """
+    Finish the data table. A DataTableWriter filled while parsing is closed,
+    an in-memory table from the cache is written out first.
+    """
+    if not isinstance(data, DataTableWriter):
+        table = DataTableWriter(args)
+        table.extend(data[1:])
+        data = table
+    data.close()
 
 
-def quality_filter(verbose, quality, original_data):
+def quality_filter(verbose, quality, original_data, discarded=None):
     qual = float(quality)
     num_original_entries = len(original_data)
     if verbose:
@@ -275,101 +2101,179 @@ def quality_filter(verbose, quality, original_data):
         entry_quality = entry_quality.replace(' ','')
         if float(entry_quality) > qual:
             filtered_data.append(entry)
+        elif discarded is not None:
+            discarded.append((entry[0], entry[1], ['quality']))
     num_filtered_entries = len(filtered_data)
     if verbose:
         print "After the quality filtering %d entries remain.\n" % (num_filtered_entries)
     return filtered_data
 
 
-def distance_filter(verbose, distance, original_data):
+def is_invariant(args, genotypes):
+    """True if the GT calls hold at most one allele, '.' calls aside"""
+    calls = set(genotypes)
+    calls.discard('.')
+    if len(calls) <= 1:
+        return True
+    if not [call for call in calls if '/' in call]:
+        return False
+    return len(set([parse_snp(args, call) for call in calls]) - set(['.'])) <= 1
+
+
+def invariant_filter(args, original_data, discarded=None):
+    """Drop the records where the extracted samples carry a single allele or no call at all"""
+    filtered_data = []
+    for entry in original_data:
+        if not is_invariant(args, entry[7:]):
+            filtered_data.append(entry)
+        elif discarded is not None:
+            discarded.append((entry[0], entry[1], ['invariant']))
+    if args.verbose:
+        print "After dropping the invariant sites %d entries remain.\n" % (len(filtered_data))
+    return filtered_data
+
+
+def neighbour_mask(chroms, positions, distance, cluster):
+    """
+    Vectorized distance and cluster filter over position arrays. Records are
+    only neighbours within a run of the same chromosome. Returns boolean
+    arrays flagging the records that fail the distance and the cluster filter.
+    """
+    num = len(positions)
+    # Gap to the next record, or None at the last record of a chromosome run
+    same_run = chroms[1:] == chroms[:-1]
+    gaps = positions[1:] - positions[:-1]
+    too_close = np.zeros(num, dtype=bool)
+    if distance != -1:
+        close = same_run & (gaps <= distance)
+        too_close[1:] |= close
+        too_close[:-1] |= close
+    dense = np.zeros(num, dtype=bool)
+    if cluster and num >= cluster[0]:
+        size, window = cluster
+        run_ids = np.concatenate(([0], np.cumsum(~same_run)))
+        spans = positions[size - 1:] - positions[:num - size + 1]
+        starts = (run_ids[size - 1:] == run_ids[:num - size + 1]) & (spans < window)
+        # Mark records start..start+size-1 of every dense group
+        marks = np.zeros(num + 1, dtype=np.int32)
+        marks[:num - size + 1] += starts
+        marks[size:] -= starts
+        dense = np.cumsum(marks[:num]) > 0
+    return too_close, dense
+
+
+def distance_filter(args, original_data, discarded=None):
+    """
+    Per chromosome distance and cluster filter. The positions are converted
+    once and the neighbour gaps are computed in one vectorized pass when
+    numpy is available; otherwise the records go through neighbour_window.
+    """
+    distance = args.distance
     num_original_entries = len(original_data)
-    if verbose:
+    if args.verbose:
         print "Received %d entries for distance filtering with a %d interval.\n" % (num_original_entries, distance)
-    filtered_data = []
-    discarded_data = []
-    distances = []
-    discarded_distances = []
-    first = original_data[0]
-    second = original_data[1]
-    last = original_data[-1]
-    before_last = original_data[-2]
-    before_before_last = original_data[-3]
-    if int(second[1]) > (int(first[1]) + distance):
-        filtered_data.append(first)
-        distances.append(first[1])
-    else:
-        discarded_data.append(first)
-        discarded_distances.append(first[1])
-    tail = original_data[0]
-    mid = original_data[1]
-    head = original_data[2]
-    for entry in original_data[3:]:
-        if (int(tail[1]) + distance) <  int(mid[1]) < (int(head[1]) - distance):
-            filtered_data.append(mid)
-            distances.append(mid[1])
+    if np is None:
+        if discarded is not None:
+            discard = lambda record, reasons: discarded.append((record[0], record[1], reasons))
         else:
-            discarded_data.append(mid)
-            discarded_distances.append(mid[1])
-        tail = mid
-        mid = head
-        head = entry
-    if int(before_last[1]) > (int(before_before_last[1]) + distance):
-        filtered_data.append(before_last)
-        distances.append(before_last[1])
+            discard = None
+        filtered_data = list(neighbour_window(original_data, distance, args.cluster, discard))
     else:
-        discarded_data.append(before_last)
-        discarded_distances.append(before_last[1])
-    if int(last[1]) > (int(before_last[1]) + distance):
-        filtered_data.append(last)
-        distances.append(last[1])
-    else:
-        discarded_data.append(last)
-        discarded_distances.append(last[1])
+        chroms = np.array([entry[0] for entry in original_data])
+        positions = np.array([int(entry[1]) for entry in original_data], dtype=np.int64)
+        too_close, dense = neighbour_mask(chroms, positions, distance, args.cluster)
+        filtered_data = [original_data[idx] for idx in np.flatnonzero(~(too_close | dense))]
+        if discarded is not None:
+            for idx in np.flatnonzero(too_close | dense):
+                reasons = []
+                if too_close[idx]:
+                    reasons.append('distance')
+                if dense[idx]:
+                    reasons.append('cluster')
+                discarded.append((original_data[idx][0], original_data[idx][1], reasons))
     num_filtered_entries = len(filtered_data)
-    num_discarded_entries = len(discarded_data)
-    if verbose:
+    num_discarded_entries = num_original_entries - num_filtered_entries
+    if args.verbose:
         print "After the distance filtering %d entries remain. %d entries were discarded\n" % (num_filtered_entries, num_discarded_entries)
     return filtered_data
 
 
-def convert_to_codon_alignment_fasta(args, specimen, filtered_data):
-    samples = {}
+def write_discarded(args, discarded):
+    """Write the sites removed by the quality, distance and cluster filters"""
+    try:
+        fh = open(args.discarded, 'w')
+    except IOError:
+        sys.exit("Could not open the discarded sites file for writing.")
+    fh.write("CHROM\tPOS\tFILTER\n")
+    for chrom, pos, reasons in discarded:
+        fh.write("{}\t{}\t{}\n".format(chrom, pos, ",".join(sorted(reasons))))
+    fh.close()
+
+
+def convert_to_codon_alignment_fasta(args, data):
+    """
+    Codon alignment of the records with EFF codons. The genotypes are decoded
+    into the same matrix as for the numpy fasta backend, '.' becomes '???',
+    the reference allele the reference codon and any ALT allele the
+    alternative codon, selected per site in genotypes_to_codons. -n
+    STOP_GAINED records already have empty codons from parse_input.
+    """
+    logger = args.logger
+    specimen = data[0][7:]
+    codon_records = []
+    for entry in data[1:]:
+        if not entry[5].strip() and not entry[6].strip():
+            if args.debug:
+                logger.debug("Empty EFF field for: {}".format(", ".join(entry)))
+            continue
+        codon_records.append(entry)
+    if args.verbose:
+        logger.info("Building the codon alignment from {} records with EFF data".format(len(codon_records)))
+    codon_lists = [['???', entry[5].strip(), entry[6].strip()] for entry in codon_records]
+    if np is None:
+        return genotypes_to_codons_python(args, specimen, codon_lists, codon_records)
+    selected = select_genotype(args, genotype_matrix(args, [data[0]] + codon_records))
+    return genotypes_to_codons(args, specimen, codon_lists, selected)
+
+
+def genotypes_to_codons(args, specimen, codon_lists, selected):
+    """
+    Build the codon sequences from the selected genotypes. codon_lists holds
+    '???', the reference and the alternative codon of every site and the
+    genotypes are mapped to those three choices in one vectorized step.
+    """
+    # '.' -> '???', 0 -> reference codon, any ALT allele -> alternative codon
+    indices = np.where(selected < 0, 0, np.where(selected == 0, 1, 2))
+    seq_data = {}
+    for sample, sequence in zip(specimen, select_alleles(codon_lists, indices)):
+        seq_data[sample] = sequence
+    seq_data["reference"] = [codons[1] for codons in codon_lists]
+    return seq_data
+
+
+def genotypes_to_codons_python(args, specimen, codon_lists, codon_records):
+    """genotypes_to_codons for installations without numpy"""
     seq_data = {}
     for sample in specimen:
-        seq_data[sample] = []
-    seq_data["reference"] = []
-    for entry in filtered_data:
-        ref_seq = entry[5].strip()
-        alt_seq = entry[6].strip()
-        print "DEBUG: EFF codons: '{0}'/'{1}'".format(ref_seq, alt_seq)
-        snps = entry[7:]
-        if len(specimen) != len(snps):
-            logger.error("Error: Number of specimen in the header and the sequence data for specimen do not match.")
-            logger.error(len(specimen), " - ", len(snps))
+        seq_data[sample] = bytearray()
+    seq_data["reference"] = [codons[1] for codons in codon_lists]
+    buffers = [seq_data[sample] for sample in specimen]
+    gt_cache = {}
+    for codons, entry in zip(codon_lists, codon_records):
+        genotypes = entry[7:]
+        if len(specimen) != len(genotypes):
+            args.logger.error("Number of specimen in the header and the sequence data does not match.")
             sys.exit()
-        if not ref_seq and not alt_seq:
-            if args.debug:
-                print "Empty EFF field for:"
-                print ", ".join(entry)
-            continue
-        seq_data["reference"].append(ref_seq)
-        for sample in specimen:
-            sample_id = specimen.index(sample)
-            snp = snps[sample_id]
-            if snp == '.':
-                snp_value = '???'
+        for buf, snp in zip(buffers, genotypes):
+            genotype = gt_cache.get(snp)
+            if genotype is None:
+                genotype = gt_cache[snp] = parse_snp(args, snp)
+            if genotype == '.':
+                buf += codons[0]
+            elif genotype == 0:
+                buf += codons[1]
             else:
-                try:
-                    snp = int(snp)
-                except:
-                    if args.debug:
-                        logger.debug("SNP: {0}".format(snp))
-                    sys.exit("Error: SNP call is not a '.' or an integer in the (0-n) range.")
-                if snp == 0:
-                    snp_value = ref_seq
-                else:
-                    snp_value = alt_seq
-            seq_data[sample].append(snp_value)
+                buf += codons[2]
     return seq_data
 
 
@@ -440,6 +2344,541 @@ def parse_snp(args, snp):
     return genotype
 
 
+def decode_gt(snp):
+    """Decode a GT value into a pair of allele indices for the genotype matrix"""
+    if snp == '.':
+        return (MISSING_GT, MISSING_GT)
+    alleles = snp.split('/')
+    decoded = []
+    for allele in (alleles[0], alleles[-1]):
+        try:
+            decoded.append(int(allele))
+        except ValueError:
+            decoded.append(INVALID_GT)
+    return tuple(decoded)
+
+
+def genotype_matrix(args, data):
+    """
+    Decode the GT column of every record into a sites x samples x 2 matrix of
+    allele indices. The last axis holds the first and the second genotype
+    identifier of a 'n/m' call, haploid calls fill both. '.' calls are stored
+    as MISSING_GT. Distinct GT strings are decoded only once.
+    """
+    specimen = data[0][7:]
+    records = data[1:]
+    gt_lookup = {}
+    codes = []
+    for entry in records:
+        genotypes = entry[7:]
+        if len(specimen) != len(genotypes):
+            args.logger.error("Number of specimen in the header and the sequence data does not match.")
+            args.logger.error("Specimen - seq: {} - {}".format(len(specimen), len(genotypes)))
+            sys.exit()
+        try:
+            codes.extend([gt_lookup[snp] for snp in genotypes])
+        except KeyError:
+            for snp in genotypes:
+                if snp not in gt_lookup:
+                    gt_lookup[snp] = decode_gt(snp)
+            codes.extend([gt_lookup[snp] for snp in genotypes])
+    matrix = np.array(codes, dtype=np.int16).reshape(len(records), len(specimen), 2)
+    return matrix
+
+
+def select_genotype(args, matrix):
+    """Pick the genotype identifier requested with --genotype from the matrix"""
+    if args.genotype == 1:
+        selected = matrix[:, :, 0]
+    else:
+        selected = matrix[:, :, 1]
+    invalid = np.argwhere(selected == INVALID_GT)
+    if len(invalid):
+        site, sample = invalid[0]
+        args.logger.error("Trouble parsing SNP of sample {0} at site {1}".format(sample + 1, site + 1))
+        sys.exit("Error: Genotype is not '.' or an integer in the (0-n) range.")
+    return selected
+
+
+def select_alleles(allele_lists, indices):
+    """
+    Vectorized allele lookup: allele_lists[site][indices[site, sample]] for all
+    sites and samples, returned as one sequence per sample. When all alleles
+    have the same length the lookup runs on a uint8 table and every sequence
+    is a bytearray, otherwise it runs on an object table and every sequence
+    is a list of alleles.
+    """
+    num_sites = len(allele_lists)
+    num_samples = indices.shape[1]
+    width = max([len(alleles) for alleles in allele_lists] or [1])
+    site_index = np.arange(num_sites)[:, np.newaxis]
+    lengths = set([len(allele) for alleles in allele_lists for allele in alleles])
+    if len(lengths) == 1:
+        size = lengths.pop()
+        if not size:
+            return [bytearray() for sample in range(num_samples)]
+        table = np.zeros((num_sites, width, size), dtype=np.uint8)
+        for site, alleles in enumerate(allele_lists):
+            table[site, :len(alleles)] = np.frombuffer("".join(alleles), dtype=np.uint8).reshape(len(alleles), size)
+        # sites x samples x bases, transposed so that every sample is contiguous
+        picked = np.ascontiguousarray(table[site_index, indices].transpose(1, 0, 2))
+        return [bytearray(row.tostring()) for row in picked]
+    table = np.empty((num_sites, width), dtype=object)
+    for site, alleles in enumerate(allele_lists):
+        table[site, :len(alleles)] = alleles
+    picked = table[site_index, indices].T
+    return [list(row) for row in picked]
+
+
+def genotypes_to_fasta(args, specimen, refs, alts, selected):
+    """
+    Build the fasta sequences from the selected genotypes. Every site gets an
+    allele table of '?', REF and the ALT alleles and the genotypes index into
+    it with one vectorized selection over all sites and samples.
+    """
+    logger = args.logger
+    allele_lists = []
+    for ref, alt in zip(refs, alts):
+        alleles = ['?', ref]
+        alleles.extend(alt.split(','))
+        allele_lists.append(alleles)
+    num_alleles = np.array([len(alleles) for alleles in allele_lists], dtype=np.int16)
+    out_of_range = selected + 1 >= num_alleles[:, np.newaxis]
+    if out_of_range.any():
+        site = np.argwhere(out_of_range)[0][0]
+        logger.error("Genotype refers to a missing ALT allele at site {0}: {1} -> {2}".format(site + 1, refs[site], alts[site]))
+        sys.exit("Error: Genotype is out of the (0-n) ALT allele range.")
+    seq_data = {}
+    for sample, sequence in zip(specimen, select_alleles(allele_lists, selected + 1)):
+        seq_data[sample] = sequence
+    seq_data["reference"] = list(refs)
+    return seq_data
+
+
+def convert_to_fasta_numpy(args, data):
+    """
+    numpy backend for convert_to_fasta. The genotypes are decoded into a
+    matrix and the allele lookup runs vectorized in genotypes_to_fasta. The
+    output is identical to convert_to_fasta.
+    """
+    logger = args.logger
+    if args.verbose:
+        logger.info("Converting SNP data to fasta sequences with the numpy backend")
+    records = data[1:]
+    selected = select_genotype(args, genotype_matrix(args, data))
+    refs = [entry[2].strip() for entry in records]
+    alts = [entry[3].strip() for entry in records]
+    return genotypes_to_fasta(args, data[0][7:], refs, alts, selected)
+
+
+def popcount(words):
+    """Number of set bits along the last axis of a uint64 array. The array is overwritten."""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    # SWAR bit count for numpy versions without bitwise_count
+    words -= (words >> np.uint64(1)) & np.uint64(0x5555555555555555)
+    words[...] = (words & np.uint64(0x3333333333333333)) + ((words >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    words += words >> np.uint64(4)
+    words &= np.uint64(0x0f0f0f0f0f0f0f0f)
+    words *= np.uint64(0x0101010101010101)
+    words >>= np.uint64(56)
+    return words.sum(axis=-1, dtype=np.int64)
+
+
+def pack_bits(mask):
+    """Pack a boolean samples x sites matrix into rows of uint64 words"""
+    packed = np.packbits(mask, axis=1)
+    padding = -packed.shape[1] % 8
+    if padding:
+        packed = np.hstack([packed, np.zeros((packed.shape[0], padding), dtype=np.uint8)])
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+def genotype_bitplanes(selected):
+    """
+    Bit-pack a sites x samples allele matrix into per sample bit vectors: the
+    called sites and one plane per ALT allele index. Two calls differ when
+    any ALT plane differs between them.
+    """
+    calls = selected.T
+    called = pack_bits(calls >= 0)
+    planes = [pack_bits(calls == allele) for allele in range(1, int(calls.max()) + 1 if calls.size else 1)]
+    return called, planes
+
+
+distance_data = None
+
+
+def init_distance_worker(data):
+    global distance_data
+    distance_data = data
+
+
+def distance_tile(task):
+    """
+    Differences between the samples of a row and a column tile, counted with
+    popcount on the packed bit vectors. Returns the tile bounds with the
+    difference counts and, depending on the missing data handling, the
+    number of sites called in both or in just one sample of each pair.
+    """
+    (row_start, row_stop), (col_start, col_stop) = task
+    called, planes, missing = distance_data
+    shape = (row_stop - row_start, col_stop - col_start)
+    differences = np.zeros(shape, dtype=np.int64)
+    extra = np.zeros(shape, dtype=np.int64)
+    for start in range(0, called.shape[1], DISTANCE_CHUNK):
+        chunk = slice(start, start + DISTANCE_CHUNK)
+        row_called = called[row_start:row_stop, chunk][:, None, :]
+        col_called = called[col_start:col_stop, chunk][None, :, :]
+        both = row_called & col_called
+        differs = np.zeros(both.shape, dtype=np.uint64)
+        for plane in planes:
+            differs |= plane[row_start:row_stop, chunk][:, None, :] ^ plane[col_start:col_stop, chunk][None, :, :]
+        differs &= both
+        differences += popcount(differs)
+        if missing == 'count':
+            extra += popcount(row_called ^ col_called)
+        elif missing == 'scale':
+            extra += popcount(both)
+    return task, differences, extra
+
+
+def distance_matrix(args, selected):
+    """
+    Pairwise SNP distance matrix of the reference and the samples of a sites
+    x samples allele matrix. The matrix is computed in tiles of
+    DISTANCE_TILE samples, in a pool of --workers processes if more than one
+    worker is requested.
+    """
+    logger = args.logger
+    num_sites = selected.shape[0]
+    with_reference = np.hstack([np.zeros((num_sites, 1), dtype=selected.dtype), selected])
+    called, planes = genotype_bitplanes(with_reference)
+    num_samples = called.shape[0]
+    bounds = [(start, min(start + DISTANCE_TILE, num_samples)) for start in range(0, num_samples, DISTANCE_TILE)]
+    tasks = [(bounds[row], bounds[col]) for row in range(len(bounds)) for col in range(row, len(bounds))]
+    if args.verbose:
+        logger.info("Computing {0} x {0} SNP distances over {1} sites in {2} tiles".format(num_samples, num_sites, len(tasks)))
+    data = (called, planes, args.distance_missing)
+    if args.distance_missing == 'scale':
+        matrix = np.zeros((num_samples, num_samples), dtype=np.float64)
+    else:
+        matrix = np.zeros((num_samples, num_samples), dtype=np.int64)
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers, init_distance_worker, (data,))
+        results = pool.imap_unordered(distance_tile, tasks)
+    else:
+        pool = None
+        init_distance_worker(data)
+        results = (distance_tile(task) for task in tasks)
+    try:
+        for ((row_start, row_stop), (col_start, col_stop)), differences, extra in results:
+            if args.distance_missing == 'count':
+                tile = differences + extra
+            elif args.distance_missing == 'scale':
+                tile = np.where(extra > 0, differences * float(num_sites) / np.maximum(extra, 1), np.nan)
+            else:
+                tile = differences
+            matrix[row_start:row_stop, col_start:col_stop] = tile
+            matrix[col_start:col_stop, row_start:row_stop] = tile.T
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        init_distance_worker(None)
+    return matrix
+
+
+def write_distance_matrix(args, names, matrix):
+    """Write the distance matrix as CSV with a header row or as a square PHYLIP distance matrix"""
+    if args.verbose:
+        args.logger.info("Writing the SNP distance matrix to {}".format(args.distance_matrix))
+    try:
+        fh = open(args.distance_matrix, 'w')
+    except IOError:
+        sys.exit("Could not open the distance matrix file for writing.")
+    if matrix.dtype.kind == 'f':
+        value_format = "{:.4f}"
+    else:
+        value_format = "{}"
+    if args.distance_format == 'phylip':
+        fh.write("{}\n".format(len(names)))
+        width = max([10] + [len(name) + 1 for name in names])
+    else:
+        fh.write("," + ",".join(names) + "\n")
+    for name, row in zip(names, matrix):
+        values = [value_format.format(value) for value in row.tolist()]
+        if args.distance_format == 'phylip':
+            fh.write(name.ljust(width) + " ".join(values) + "\n")
+        else:
+            fh.write(name + "," + ",".join(values) + "\n")
+    fh.close()
+
+
+def build_site_table(args, data, data_table):
+    """
+    Columnar form of the parse_input records: chromosome ids, positions and
+    QUAL values as arrays, the REF/ALT alleles, EFF codons and effects as
+    per site lists and the decoded genotype matrix. data_table has to hold
+    the parsed EFF columns.
+    """
+    records = data[1:]
+    chrom_names = []
+    chrom_index = {}
+    chrom_ids = np.zeros(len(records), dtype=np.int32)
+    qual = np.zeros(len(records), dtype=np.float64)
+    for site, entry in enumerate(records):
+        if entry[0] not in chrom_index:
+            chrom_index[entry[0]] = len(chrom_names)
+            chrom_names.append(entry[0])
+        chrom_ids[site] = chrom_index[entry[0]]
+        try:
+            qual[site] = float(entry[4].replace(' ', ''))
+        except ValueError:
+            qual[site] = np.nan
+    return {
+        'samples': data[0][7:],
+        'chrom_names': chrom_names,
+        'chrom_ids': chrom_ids,
+        'pos': np.array([int(entry[1]) for entry in records], dtype=np.int64),
+        'qual': qual,
+        'ref': [entry[2].strip() for entry in records],
+        'alt': [entry[3].strip() for entry in records],
+        'ref_codon': [entry[5].strip() for entry in records],
+        'alt_codon': [entry[6].strip() for entry in records],
+        'effect': [row[2] for row in data_table[1:]],
+        'genotypes': genotype_matrix(args, data),
+    }
+
+
+def filter_site_table(args, table):
+    """Quality, distance and cluster filters on a site table. Returns the indices of the kept sites."""
+    logger = args.logger
+    rows = np.arange(len(table['pos']))
+    discarded = []
+    num_quality = 0
+    if args.quality != -1:
+        passed = table['qual'] > args.quality
+        discarded.extend([(idx, ['quality']) for idx in np.flatnonzero(~passed)])
+        rows = rows[passed]
+        num_quality = len(table['pos']) - len(rows)
+        if args.verbose:
+            logger.info("After the quality filtering {} entries remain.".format(len(rows)))
+    num_invariant = 0
+    if args.drop_invariant:
+        selected = select_genotype(args, table['genotypes'][rows])
+        called = selected >= 0
+        highest = np.where(called, selected, -1).max(axis=1)
+        lowest = np.where(called, selected, np.iinfo(selected.dtype).max).min(axis=1)
+        variant = highest > lowest
+        discarded.extend([(idx, ['invariant']) for idx in rows[~variant]])
+        num_invariant = len(rows) - np.count_nonzero(variant)
+        rows = rows[variant]
+        if args.verbose:
+            logger.info("After dropping the invariant sites {} entries remain.".format(len(rows)))
+    if args.distance != -1 or args.cluster:
+        too_close, dense = neighbour_mask(table['chrom_ids'][rows], table['pos'][rows], args.distance, args.cluster)
+        for idx in np.flatnonzero(too_close | dense):
+            reasons = []
+            if too_close[idx]:
+                reasons.append('distance')
+            if dense[idx]:
+                reasons.append('cluster')
+            discarded.append((rows[idx], reasons))
+        rows = rows[~(too_close | dense)]
+        if args.verbose:
+            logger.info("After the distance filtering {} entries remain.".format(len(rows)))
+    args.stats.count_sites(len(table['pos']), num_quality, len(table['pos']) - num_quality - num_invariant - len(rows), num_invariant)
+    if args.discarded:
+        write_discarded(args, [(table['chrom_names'][table['chrom_ids'][idx]], table['pos'][idx], reasons) for idx, reasons in discarded])
+    return rows
+
+
+def site_table_to_fasta(args, table, rows):
+    selected = select_genotype(args, table['genotypes'][rows])
+    refs = [table['ref'][idx] for idx in rows]
+    alts = [table['alt'][idx] for idx in rows]
+    return genotypes_to_fasta(args, table['samples'], refs, alts, selected)
+
+
+def site_table_to_codons(args, table, rows):
+    """
+    Codon alignment from a site table. Sites without EFF codons (and with
+    -n the STOP_GAINED sites) are skipped.
+    """
+    codon_rows = []
+    codon_lists = []
+    for idx in rows:
+        ref_codon = table['ref_codon'][idx]
+        alt_codon = table['alt_codon'][idx]
+        if not ref_codon and not alt_codon:
+            continue
+        if args.nostop and is_stop_gained(table['effect'][idx]):
+            continue
+        codon_rows.append(idx)
+        codon_lists.append(['???', ref_codon, alt_codon])
+    selected = select_genotype(args, table['genotypes'][np.array(codon_rows, dtype=np.int64)])
+    return genotypes_to_codons(args, table['samples'], codon_lists, selected)
+
+
+CACHE_VERSION = 2
+CACHE_ARRAYS = ('chrom_ids', 'pos', 'qual', 'genotypes')
+CACHE_STRINGS = ('ref', 'alt', 'ref_codon', 'alt_codon', 'effect')
+
+
+def input_fingerprint(filename):
+    """
+    Content hash of the input file. Files up to 64 Mb are hashed completely,
+    larger ones through 64 evenly spaced 256 kb windows including the first
+    and the last one, which is enough to tell VCF files apart.
+    """
+    size = os.path.getsize(filename)
+    sha1 = hashlib.sha1(str(size))
+    window = 1 << 18
+    with open(filename, 'rb') as fh:
+        if size <= 256 * window:
+            for block in iter(lambda: fh.read(1 << 20), ''):
+                sha1.update(block)
+        else:
+            for idx in range(64):
+                fh.seek((size - window) * idx // 63)
+                sha1.update(fh.read(window))
+    return sha1.hexdigest()
+
+
+def cache_location(args, fingerprint):
+    if args.cache_dir:
+        return os.path.join(args.cache_dir, fingerprint)
+    return strip_gz_suffix(args.infile) + '.cache'
+
+
+def load_cache(args, cache_path, stat, fingerprint):
+    """Load a site table cache if it matches the input file's size, mtime and content hash"""
+    meta_file = os.path.join(cache_path, 'meta.json')
+    try:
+        with open(meta_file) as fh:
+            meta = json.load(fh)
+    except (IOError, ValueError):
+        return None
+    if (meta.get('version') != CACHE_VERSION or meta.get('size') != stat.st_size
+            or meta.get('mtime') != stat.st_mtime or meta.get('fingerprint') != fingerprint
+            or meta.get('mask') != [args.min_gq, args.min_dp, args.min_alt_frac]):
+        return None
+    table = {'samples': [str(sample) for sample in meta['samples']],
+             'chrom_names': [str(name) for name in meta['chrom_names']]}
+    for name in CACHE_ARRAYS:
+        table[name] = np.load(os.path.join(cache_path, name + '.npy'), mmap_mode='r')
+    with open(os.path.join(cache_path, 'sites.tsv')) as fh:
+        columns = zip(*[line.rstrip('\n').split('\t') for line in fh]) or [[]] * len(CACHE_STRINGS)
+    for name, column in zip(CACHE_STRINGS, columns):
+        table[name] = list(column)
+    with open(os.path.join(cache_path, 'table.tsv')) as fh:
+        data_table = [line.rstrip('\n').split('\t') for line in fh]
+    with open(os.path.join(cache_path, 'no_eff.txt')) as fh:
+        no_eff_data_sample_names = [line.rstrip('\n') for line in fh]
+    # The meta file mtime is the last use time for the cache eviction
+    os.utime(meta_file, None)
+    return table, data_table, no_eff_data_sample_names, collections.Counter(dict(enumerate(meta['masked'])))
+
+
+def save_cache(args, cache_path, stat, fingerprint, table, data_table, no_eff_data_sample_names, masked_calls):
+    """Write a site table cache into a temporary directory and move it into place"""
+    parent = os.path.dirname(os.path.abspath(cache_path))
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    tmp_path = tempfile.mkdtemp(prefix='.vcf_fa_cache', dir=parent)
+    for name in CACHE_ARRAYS:
+        np.save(os.path.join(tmp_path, name + '.npy'), table[name])
+    with open(os.path.join(tmp_path, 'sites.tsv'), 'w') as fh:
+        for site in zip(*[table[name] for name in CACHE_STRINGS]):
+            fh.write("\t".join(site) + "\n")
+    with open(os.path.join(tmp_path, 'table.tsv'), 'w') as fh:
+        for row in data_table:
+            fh.write("\t".join(row) + "\n")
+    with open(os.path.join(tmp_path, 'no_eff.txt'), 'w') as fh:
+        for name in no_eff_data_sample_names:
+            fh.write(name + "\n")
+    meta = {'version': CACHE_VERSION, 'input': os.path.abspath(args.infile), 'size': stat.st_size,
+            'mtime': stat.st_mtime, 'fingerprint': fingerprint, 'samples': table['samples'],
+            'chrom_names': table['chrom_names'], 'sites': len(table['pos']),
+            'mask': [args.min_gq, args.min_dp, args.min_alt_frac],
+            'masked': [masked_calls[idx] for idx in range(len(table['samples']))]}
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as fh:
+        json.dump(meta, fh)
+    if os.path.isdir(cache_path):
+        shutil.rmtree(cache_path)
+    os.rename(tmp_path, cache_path)
+
+
+def evict_cache(args, keep):
+    """Remove the least recently used caches until the cache directory fits into --cache-max-size"""
+    logger = args.logger
+    entries = []
+    total = 0
+    for name in os.listdir(args.cache_dir):
+        path = os.path.join(args.cache_dir, name)
+        meta_file = os.path.join(path, 'meta.json')
+        if not os.path.isfile(meta_file):
+            continue
+        size = sum([os.path.getsize(os.path.join(path, item)) for item in os.listdir(path)])
+        entries.append((os.path.getmtime(meta_file), size, path))
+        total += size
+    limit = args.cache_max_size * 1024 * 1024
+    for last_used, size, path in sorted(entries):
+        if total <= limit:
+            break
+        if os.path.abspath(path) == os.path.abspath(keep):
+            continue
+        if args.verbose:
+            logger.info("Evicting cache {}".format(path))
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def cached_site_table(args, header, fh):
+    """
+    Return the site table, data table and "no EFF data" list of the input,
+    from the cache when it is valid, otherwise by parsing the input and
+    caching the result. The cache always holds the EFF data, so reruns with
+    other -q, -d, --genotype, -s, -t or -n settings can use it. The masked
+    genotypes are cached, so a change of the call masks means a reparse.
+    """
+    logger = args.logger
+    stat = os.stat(args.infile)
+    fingerprint = input_fingerprint(args.infile)
+    cache_path = cache_location(args, fingerprint)
+    cached = load_cache(args, cache_path, stat, fingerprint)
+    if cached is not None:
+        fh.close()
+        if args.verbose:
+            logger.info("Using the parsed vcf cache {}".format(cache_path))
+        table, data_table, no_eff_data_sample_names, masked_calls = cached
+    else:
+        if args.verbose:
+            logger.info("Parsing the input and writing the cache {}".format(cache_path))
+        parse_args = argparse.Namespace(**vars(args))
+        parse_args.snpeff = parse_args.table = True
+        parse_args.nostop = False
+        parse_args.samples = parse_args.exclude_samples = None
+        source_data, data_table, no_eff_data_sample_names = parse_input(parse_args, header, fh)
+        masked_calls = parse_args.masked_calls
+        table = build_site_table(args, source_data, data_table)
+        save_cache(args, cache_path, stat, fingerprint, table, data_table, no_eff_data_sample_names, masked_calls)
+        if args.cache_dir and args.cache_max_size:
+            evict_cache(args, cache_path)
+    args.columns = select_columns(args, header)
+    if args.columns:
+        table = dict(table)
+        table['samples'] = select_samples_header(args, header)
+        table['genotypes'] = table['genotypes'][:, args.columns]
+        masked_calls = collections.Counter(dict([(idx, masked_calls[column]) for idx, column in enumerate(args.columns)]))
+    if args.masking:
+        report_masked_calls(args, select_samples_header(args, header), masked_calls)
+    if not args.snpeff:
+        no_eff_data_sample_names = []
+    return table, data_table, no_eff_data_sample_names
+
+
 def filter_data(args, source_data):
     logger = args.logger
     if args.verbose:
@@ -449,17 +2888,129 @@ def filter_data(args, source_data):
     reference = []
     header = source_data[0]
     original_data = source_data[1:]
+    discarded = [] if args.discarded else None
     #Quality filter
     if quality != -1:
-        quality_filtered_data = quality_filter(verbose, quality, original_data)
+        quality_filtered_data = quality_filter(args.verbose, quality, original_data, discarded)
     else:
         quality_filtered_data = original_data
+    #Invariant site filter
+    if args.drop_invariant:
+        variant_data = invariant_filter(args, quality_filtered_data, discarded)
+    else:
+        variant_data = quality_filtered_data
     #Distance filter
-    if distance != -1:
-        distance_filtered_data = distance_filter(verbose, distance, quality_filtered_data)
+    if distance != -1 or args.cluster:
+        distance_filtered_data = distance_filter(args, variant_data, discarded)
     else:
-        distance_filtered_data = quality_filtered_data
-    return (distance_filtered_data)
+        distance_filtered_data = variant_data
+    args.stats.count_sites(len(original_data), len(original_data) - len(quality_filtered_data),
+        len(variant_data) - len(distance_filtered_data), len(quality_filtered_data) - len(variant_data))
+    if args.discarded:
+        write_discarded(args, discarded)
+    return [header] + distance_filtered_data
+
+
+class Metrics(object):
+    """
+    Wall and CPU time of the extractor stages, record and site counters and
+    periodic progress reports of one run. CPU times are taken from os.times,
+    so the time spent in --workers processes is reported as child CPU time.
+    """
+    def __init__(self, logger, interval=0):
+        self.logger = logger
+        self.interval = interval
+        self.start = time.time()
+        self.last_report = self.start
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict([('records', 0), ('bytes_read', 0)])
+        self.progress = []
+        self.masked_calls = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall = time.time()
+        cpu = os.times()
+        try:
+            yield
+        finally:
+            end = os.times()
+            self.stages[name] = collections.OrderedDict([
+                ('wall_seconds', time.time() - wall),
+                ('cpu_seconds', end[0] - cpu[0] + end[1] - cpu[1]),
+                ('child_cpu_seconds', end[2] - cpu[2] + end[3] - cpu[3])])
+
+    def advance(self, records, num_bytes):
+        """Add parsed records and bytes and report the progress when the interval has passed"""
+        self.counters['records'] += records
+        self.counters['bytes_read'] += num_bytes
+        now = time.time()
+        if self.interval and now - self.last_report >= self.interval:
+            self.last_report = now
+            elapsed = now - self.start
+            self.progress.append(collections.OrderedDict([
+                ('seconds', elapsed), ('records', self.counters['records']), ('bytes_read', self.counters['bytes_read'])]))
+            self.logger.info("Parsed {} records ({:.1f} Mb) in {:.0f} s, {:.0f} records/s".format(
+                self.counters['records'], self.counters['bytes_read'] / 1048576.0, elapsed, self.counters['records'] / elapsed))
+
+    def count_sites(self, sites, discarded_quality, discarded_distance, discarded_invariant=0):
+        self.counters['sites'] = sites
+        self.counters['discarded_quality'] = discarded_quality
+        self.counters['discarded_invariant'] = discarded_invariant
+        self.counters['discarded_distance'] = discarded_distance
+        self.counters['sites_kept'] = sites - discarded_quality - discarded_invariant - discarded_distance
+
+    def report(self, args):
+        wall = time.time() - self.start
+        cpu = os.times()
+        document = collections.OrderedDict()
+        document['input'] = args.infile
+        document['input_bytes'] = os.path.getsize(args.infile)
+        document['wall_seconds'] = wall
+        document['cpu_seconds'] = cpu[0] + cpu[1]
+        document['child_cpu_seconds'] = cpu[2] + cpu[3]
+        document['stages'] = self.stages
+        document['counters'] = self.counters
+        parse_stage = self.stages.get('parse') or self.stages.get('stream')
+        if parse_stage and parse_stage['wall_seconds'] > 0 and self.counters['records']:
+            document['records_per_second'] = self.counters['records'] / parse_stage['wall_seconds']
+        else:
+            document['records_per_second'] = None
+        if resource is not None:
+            # ru_maxrss is in kilobytes on Linux
+            document['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            document['peak_rss_children_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        if self.masked_calls is not None:
+            document['masked_calls_per_sample'] = self.masked_calls
+        document['progress'] = self.progress
+        return document
+
+
+def track_progress(stats, lines):
+    """Pass the vcf lines through, counting the records and bytes for the run metrics"""
+    records = 0
+    num_bytes = 0
+    for line in lines:
+        num_bytes += len(line)
+        if not line.startswith('#'):
+            records += 1
+            if records == PROGRESS_BATCH:
+                stats.advance(records, num_bytes)
+                records = num_bytes = 0
+        yield line
+    stats.advance(records, num_bytes)
+
+
+def write_metrics(args):
+    try:
+        fh = open(args.metrics, 'w')
+    except IOError:
+        sys.exit("Could not open the metrics file for writing.")
+    document = collections.OrderedDict([('version', __version)])
+    document.update(args.stats.report(args))
+    json.dump(document, fh, indent=2, separators=(',', ': '))
+    fh.write("\n")
+    fh.close()
 
 
 def setup_logger(args):
@@ -489,24 +3040,39 @@ def setup_logger(args):
     return log
 
 
-def main():
-    args = get_arguments()
+def main(argv=None):
+    args = get_arguments(argv)
     logger = args.logger
     if sys.version_info < (2,7,0):
         print ("You need python 2.7 or later to run this script.")
         sys.exit(1)
     try:
-        input_fh = open(args.infile, 'r')
+        input_fh = open_input(args.infile, args.threads)
     except IOError:
-        print 'Cannot open input file', arg
+        sys.exit("Cannot open input file {}".format(args.infile))
+    stats = args.stats
     # CHROM, POS, ID, REF, ALT, QUAL, FILTER, INFO, FORMAT, SAMPLES*
-    header = get_header(args.verbose, input_fh)
+    with stats.stage('header'):
+        header = get_header(args.verbose, input_fh)
     if args.verbose:
         logger.info("Common data: {}".format(", ".join(header[:9])))
         logger.info("Sample names: {}".format(", ".join(header[9:])))
-    input_fh.seek(0, 0)
-    source_data, data_table, no_eff_data_samples = parse_input(args, header, input_fh)
-    specimen = source_data[0][7:]
+    if args.region:
+        input_fh.close()
+        input_fh = fetch_regions(args, args.infile, args.region)
+    else:
+        input_fh.seek(0, 0)
+    if args.stream:
+        with stats.stage('stream'):
+            fasta_data, codon_alignment, data_table, no_eff_data_samples = stream_input(args, header, input_fh)
+    elif args.cache:
+        with stats.stage('parse'):
+            site_table, data_table, no_eff_data_samples = cached_site_table(args, header, input_fh)
+    else:
+        with stats.stage('parse'):
+            source_data, data_table, no_eff_data_samples = parse_input(args, header, input_fh)
+    stats.counters['samples'] = len(args.columns) if args.columns else len(header) - 9
+    stats.counters['empty_eff'] = len(no_eff_data_samples)
     if args.debug:
         if len(no_eff_data_samples) > 0:
             print "{} samples do not have EFF data:".format(len(no_eff_data_samples))
@@ -514,18 +3080,80 @@ def main():
             print ", ".join(no_eff_data_samples)
             print "-" * 70
     if args.table:
-        write_data_table(args, data_table)
-    if args.quality != -1 or args.distance != -1 :
-        logger.info("Quality: {}".format(args.quality))
-        logger.info("Distance: {}".format(args.distance))
-        filtered_data = filter_data(args, source_data)
+        with stats.stage('table'):
+            write_data_table(args, data_table)
+    if args.stream:
+        with stats.stage('write'):
+            write_fasta_file(args.verbose, args.outfile, fasta_data)
+            if args.snpeff:
+                write_codon_alignment_output(args.verbose, args.snpeff, codon_alignment)
+    elif args.cache:
+        with stats.stage('filter'):
+            rows = filter_site_table(args, site_table)
+        with stats.stage('fasta'):
+            if args.full_genome:
+                sites = [(site_table['chrom_names'][site_table['chrom_ids'][idx]], site_table['pos'][idx], site_table['ref'][idx], site_table['alt'][idx]) for idx in rows]
+                write_full_genome(args, site_table['samples'], sites, select_genotype(args, site_table['genotypes'][rows]))
+            else:
+                fasta_data = site_table_to_fasta(args, site_table, rows)
+        if args.snpeff:
+            with stats.stage('codon'):
+                codon_alignment = site_table_to_codons(args, site_table, rows)
+        with stats.stage('write'):
+            if args.state:
+                sites = [(site_table['chrom_names'][site_table['chrom_ids'][idx]], int(site_table['pos'][idx]), site_table['ref'][idx]) for idx in rows]
+                write_alignment(args, fasta_data, sites)
+            elif not args.full_genome:
+                write_fasta_file(args.verbose, args.outfile, fasta_data)
+            if args.snpeff:
+                write_codon_alignment_output(args.verbose, args.snpeff, codon_alignment)
+        if args.distance_matrix:
+            with stats.stage('distance'):
+                matrix = distance_matrix(args, select_genotype(args, site_table['genotypes'][rows]))
+                write_distance_matrix(args, ['reference'] + list(site_table['samples']), matrix)
     else:
-        filtered_data = source_data
-    fasta_data = convert_to_fasta(args, filtered_data)
-    write_fasta_file(args.verbose, args.outfile, fasta_data)
-    if args.snpeff:
-        codon_alignment = convert_to_codon_alignment_fasta(args.verbose, specimen, filtered_data)
-        write_codon_alignment_output(args.verbose, args.snpeff, codon_alignment)
+        if args.quality != -1 or args.distance != -1 or args.cluster or args.drop_invariant:
+            logger.info("Quality: {}".format(args.quality))
+            logger.info("Distance: {}".format(args.distance))
+            with stats.stage('filter'):
+                filtered_data = filter_data(args, source_data)
+        else:
+            filtered_data = source_data
+            stats.count_sites(len(source_data) - 1, 0, 0)
+        if args.full_genome:
+            with stats.stage('fasta'):
+                sites = [(entry[0], entry[1], entry[2].strip(), entry[3].strip()) for entry in filtered_data[1:]]
+                write_full_genome(args, filtered_data[0][7:], sites, select_genotype(args, genotype_matrix(args, filtered_data)))
+        else:
+            with stats.stage('fasta'):
+                if args.backend == 'numpy':
+                    fasta_data = convert_to_fasta_numpy(args, filtered_data)
+                else:
+                    fasta_data = convert_to_fasta(args, filtered_data)
+        if args.snpeff:
+            with stats.stage('codon'):
+                codon_alignment = convert_to_codon_alignment_fasta(args, filtered_data)
+        with stats.stage('write'):
+            if args.state:
+                write_alignment(args, fasta_data, [(entry[0], int(entry[1]), entry[2].strip()) for entry in filtered_data[1:]])
+            elif not args.full_genome:
+                write_fasta_file(args.verbose, args.outfile, fasta_data)
+            if args.snpeff:
+                write_codon_alignment_output(args.verbose, args.snpeff, codon_alignment)
+        if args.distance_matrix:
+            with stats.stage('distance'):
+                matrix = distance_matrix(args, select_genotype(args, genotype_matrix(args, filtered_data)))
+                write_distance_matrix(args, ['reference'] + filtered_data[0][7:], matrix)
+    if args.beast_templates:
+        with stats.stage('beast'):
+            if args.beast_alignment == 'codon':
+                write_beast_xmls(args, codon_alignment)
+            elif args.append:
+                write_beast_xmls(args, read_fasta_file(args.outfile)[1])
+            else:
+                write_beast_xmls(args, fasta_data)
+    if args.metrics:
+        write_metrics(args)
     if args.verbose:
         print "Done processing the vcf file {0}. Good bye!\n".format(args.infile)
     sys.exit(0)
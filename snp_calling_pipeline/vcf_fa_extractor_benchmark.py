@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""Benchmark the vcf_fa_extractor.py stages on synthetic freebayes/SnpEff vcf
+files. Every samples x sites x backend combination runs in its own process so
+that the reported peak RSS belongs to that run only. Results are written as
+JSON and two result files can be compared stage by stage.
+
+Example:
+    ./vcf_fa_extractor_benchmark.py --samples 10 100 1000 --sites 1000 100000 -o bench.json
+    ./vcf_fa_extractor_benchmark.py --compare bench_old.json bench.json
+"""
+import os, sys, json, time, random, argparse, platform, resource, subprocess, tempfile
+
+import vcf_fa_extractor
+
+__version="1.0"
+
+STAGES = ['get_header', 'parse_input', 'write_data_table', 'filter_data', 'convert_to_fasta',
+          'write_fasta_file', 'convert_to_codon_alignment_fasta', 'write_codon_alignment_output']
+
+EFFECTS = [
+    ('SYNONYMOUS_CODING', 'LOW', 'SILENT', 'ggT/ggC', 'G91'),
+    ('NON_SYNONYMOUS_CODING', 'MODERATE', 'MISSENSE', 'aCc/aTc', 'T34I'),
+    ('STOP_GAINED', 'HIGH', 'NONSENSE', 'Cag/Tag', 'Q12*'),
+]
+CHROMOSOMES = [('gi|147673462|gb|CP000626.1|', 1072315), ('gi|147675431|gb|CP000627.1|', 2961149)]
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(usage='%(prog)s [options]', description="Benchmark vcf_fa_extractor.py on synthetic vcf files")
+    parser.add_argument('--samples', type=int, nargs='+', default=[10, 100], help="Numbers of samples to benchmark. Default is 10 100")
+    parser.add_argument('--sites', type=int, nargs='+', default=[1000, 10000], help="Numbers of sites to benchmark. Default is 1000 10000")
+    parser.add_argument('--backends', nargs='+', choices=['python', 'numpy', 'stream'], default=['python'], help="Conversion paths to benchmark. Default is python")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed of the vcf generator. Default is 1")
+    parser.add_argument('--workdir', help="Directory for the generated vcf and output files. Generated files are reused. Default is a temporary directory")
+    parser.add_argument('-o', '--output', dest='outfile', default='vcf_fa_extractor_benchmark.json', help="JSON result file")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="Compare two JSON result files instead of running the benchmark")
+    parser.add_argument('--run-one', nargs=4, metavar=('VCF', 'SAMPLES', 'SITES', 'BACKEND'), help=argparse.SUPPRESS)
+    parser.add_argument('--version', action='version', version='%(prog)s Version: {version}'.format(version=__version))
+    return parser.parse_args()
+
+
+def generate_vcf(filename, num_samples, num_sites, seed):
+    """
+    Write a deterministic vcf file that looks like the freebayes + SnpEff
+    output of the pipeline: haploid GT:GQ:DP:RO:QR:AO:QA:GL calls, about 5%
+    '.' calls, 10% multi-allelic sites and EFF annotations on most sites.
+    """
+    rng = random.Random(seed)
+    samples = ["HC{0:04d}_SM".format(idx) for idx in range(num_samples)]
+    fh = open(filename, 'w')
+    fh.write("##fileformat=VCFv4.1\n")
+    fh.write("##source=freeBayes v0.9.21\n")
+    for chrom, length in CHROMOSOMES:
+        fh.write("##contig=<ID={0},length={1}>\n".format(chrom, length))
+    fh.write('##INFO=<ID=EFF,Number=.,Type=String,Description="Predicted effects for this variant.Format: \'Effect ( Effect_Impact | Functional_Class | Codon_Change | Amino_Acid_change| Amino_Acid_length | Gene_Name | Gene_BioType | Coding | Transcript | Exon  | GenotypeNum [ | ERRORS | WARNINGS ] )\' ">\n')
+    fh.write("\t".join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] + samples) + "\n")
+    total_length = sum([length for chrom, length in CHROMOSOMES])
+    for chrom, length in CHROMOSOMES:
+        chrom_sites = num_sites * length // total_length
+        if chrom == CHROMOSOMES[-1][0]:
+            chrom_sites = num_sites - num_sites * CHROMOSOMES[0][1] // total_length
+        step = max(1, length // max(chrom_sites, 1))
+        pos = 0
+        for site in range(chrom_sites):
+            pos += rng.randint(1, 2 * step - 1) if step > 1 else 1
+            ref = rng.choice('ACGT')
+            num_alt = 2 if rng.random() < 0.1 else 1
+            alts = rng.sample([base for base in 'ACGT' if base != ref], num_alt)
+            depth = rng.randint(2000, 12000)
+            info = ("AB=0;ABP=0;AC={0};AF=0.1;AN={1};AO=102;CIGAR=1X;DP={2};DPRA=0.5;EPP=215.9;"
+                    "MQM=13.87;MQMR=54.9;NS={1};NUMALT={3};ODDS=74.4;RO=7169;SAP=224.5;TYPE=snp;"
+                    "technology.ILLUMINA=1").format(rng.randint(1, num_samples), num_samples, depth, num_alt)
+            if rng.random() < 0.9:
+                effect = rng.choice(EFFECTS)
+                info += ";EFF={0}({1}|{2}|{3}|{4}|{5}|Vch1786_I{6:04d}||CODING|Vch1786_I{6:04d}|1|{7})".format(
+                    effect[0], effect[1], effect[2], effect[3], effect[4], rng.randint(50, 900),
+                    rng.randint(1, 3800), rng.randint(1, num_alt))
+            calls = []
+            for sample in samples:
+                draw = rng.random()
+                if draw < 0.05:
+                    calls.append(".")
+                    continue
+                allele = 0 if draw < 0.8 else rng.randint(1, num_alt)
+                ref_obs = rng.randint(0, 400)
+                alt_obs = rng.randint(0, 400)
+                calls.append("{0}:50000:{1}:{2}:{3}:{4}:{5}:{6:.2f},{7:.2f}".format(
+                    allele, ref_obs + alt_obs, ref_obs, ref_obs * 38, alt_obs, alt_obs * 38,
+                    -rng.random() * 1500, -rng.random() * 1500))
+            fh.write("\t".join([chrom, str(pos), ".", ref, ",".join(alts), "{0:.2f}".format(rng.uniform(0, 3000)),
+                                ".", info, "GT:GQ:DP:RO:QR:AO:QA:GL"] + calls) + "\n")
+    fh.close()
+
+
+def timed(stages, name, function, *arguments):
+    wall = time.time()
+    cpu = time.clock()
+    result = function(*arguments)
+    stages[name] = {'wall': time.time() - wall, 'cpu': time.clock() - cpu}
+    return result
+
+
+def run_one(vcf, num_samples, num_sites, backend):
+    """Run the extractor stages on one vcf file and return the timings and peak RSS"""
+    base = os.path.splitext(vcf)[0] + "_" + backend
+    argv = ['-i', vcf, '-o', base + '.fa', '-t', base + '.csv', '-s', base + '_codon.fa', '-q', '20', '-d', '3']
+    if backend == 'numpy':
+        argv.extend(['--backend', 'numpy'])
+    args = vcf_fa_extractor.get_arguments(argv)
+    stages = {}
+    fh = vcf_fa_extractor.open_input(vcf)
+    header = timed(stages, 'get_header', vcf_fa_extractor.get_header, args.verbose, fh)
+    fh.seek(0, 0)
+    if backend == 'stream':
+        fasta_data, codon_data, data_table, no_eff = timed(stages, 'stream_input', vcf_fa_extractor.stream_input, args, header, fh)
+        timed(stages, 'write_data_table', vcf_fa_extractor.write_data_table, args, data_table)
+        timed(stages, 'write_fasta_file', vcf_fa_extractor.write_fasta_file, args.verbose, args.outfile, fasta_data)
+        timed(stages, 'write_codon_alignment_output', vcf_fa_extractor.write_codon_alignment_output, args.verbose, args.snpeff, codon_data)
+    else:
+        source_data, data_table, no_eff = timed(stages, 'parse_input', vcf_fa_extractor.parse_input, args, header, fh)
+        timed(stages, 'write_data_table', vcf_fa_extractor.write_data_table, args, data_table)
+        filtered_data = timed(stages, 'filter_data', vcf_fa_extractor.filter_data, args, source_data)
+        if backend == 'numpy':
+            fasta_data = timed(stages, 'convert_to_fasta', vcf_fa_extractor.convert_to_fasta_numpy, args, filtered_data)
+        else:
+            fasta_data = timed(stages, 'convert_to_fasta', vcf_fa_extractor.convert_to_fasta, args, filtered_data)
+        timed(stages, 'write_fasta_file', vcf_fa_extractor.write_fasta_file, args.verbose, args.outfile, fasta_data)
+        codon_data = timed(stages, 'convert_to_codon_alignment_fasta', vcf_fa_extractor.convert_to_codon_alignment_fasta, args, filtered_data)
+        timed(stages, 'write_codon_alignment_output', vcf_fa_extractor.write_codon_alignment_output, args.verbose, args.snpeff, codon_data)
+    return {
+        'samples': num_samples,
+        'sites': num_sites,
+        'backend': backend,
+        'input_bytes': os.path.getsize(vcf),
+        'stages': stages,
+        'total_wall': sum([stage['wall'] for stage in stages.values()]),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run_benchmark(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix='vcf_fa_benchmark')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    results = []
+    for num_samples in args.samples:
+        for num_sites in args.sites:
+            vcf = os.path.join(workdir, "synthetic_{0}x{1}_seed{2}.vcf".format(num_samples, num_sites, args.seed))
+            if not os.path.exists(vcf):
+                print "Generating {0}".format(vcf)
+                generate_vcf(vcf, num_samples, num_sites, args.seed)
+            for backend in args.backends:
+                print "Running {0} samples x {1} sites with the {2} backend".format(num_samples, num_sites, backend)
+                output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run-one',
+                                                  vcf, str(num_samples), str(num_sites), backend])
+                result = json.loads(output.strip().splitlines()[-1])
+                print "    {0:.3f} s, peak RSS {1} kb".format(result['total_wall'], result['peak_rss_kb'])
+                results.append(result)
+    document = {
+        'extractor_version': vcf_fa_extractor.__version,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'seed': args.seed,
+        'results': results,
+    }
+    with open(args.outfile, 'w') as fh:
+        json.dump(document, fh, indent=2, sort_keys=True)
+    print "Wrote {0}".format(args.outfile)
+
+
+def compare_results(old_file, new_file):
+    """Print the per stage wall time ratio new/old for every configuration present in both files"""
+    with open(old_file) as fh:
+        old = json.load(fh)
+    with open(new_file) as fh:
+        new = json.load(fh)
+    old_results = dict(((r['samples'], r['sites'], r['backend']), r) for r in old['results'])
+    print "{0:>8} {1:>9} {2:>7} {3:<32} {4:>10} {5:>10} {6:>7}".format('samples', 'sites', 'backend', 'stage', 'old s', 'new s', 'ratio')
+    for result in new['results']:
+        key = (result['samples'], result['sites'], result['backend'])
+        if key not in old_results:
+            continue
+        previous = old_results[key]
+        names = [name for name in STAGES + ['stream_input'] if name in result['stages'] and name in previous['stages']]
+        rows = [(name, previous['stages'][name]['wall'], result['stages'][name]['wall']) for name in names]
+        rows.append(('total', previous['total_wall'], result['total_wall']))
+        rows.append(('peak_rss_kb', previous['peak_rss_kb'], result['peak_rss_kb']))
+        for name, before, after in rows:
+            ratio = after / before if before else float('nan')
+            print "{0:>8} {1:>9} {2:>7} {3:<32} {4:>10.3f} {5:>10.3f} {6:>7.2f}".format(key[0], key[1], key[2], name, before, after, ratio)
+
+
+def main():
+    args = get_arguments()
+    if args.run_one:
+        vcf, num_samples, num_sites, backend = args.run_one
+        # The extractor logs to stdout, the result has to be the last line
+        print json.dumps(run_one(vcf, int(num_samples), int(num_sites), backend))
+    elif args.compare:
+        compare_results(*args.compare)
+    else:
+        run_benchmark(args)
+
+
+if __name__=='__main__':
+    main()